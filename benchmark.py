@@ -0,0 +1,279 @@
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import osmium
+import osmium.version
+from osmium.osm.mutable import Node, Relation, Way
+
+from main import PublicTransportStopExtractor
+from metrics import peak_rss_bytes
+
+
+# Number of nodes of the synthetic files per scale, the other objects are derived from it with the densities
+SCALES = {
+    'small': 20000,
+    'medium': 200000,
+    'large': 2000000,
+}
+
+# Shares of the synthetic objects, see generate_osm_file()
+DEFAULT_DENSITIES = {
+    'stop_nodes': 0.03,  # Nodes tagged as stops
+    'ways_per_node': 0.1,  # Ways per node
+    'platform_ways': 0.05,  # Ways tagged as stops
+    'relations_per_node': 0.01,  # Relations per node
+    'stop_relations': 0.3,  # Relations tagged as platform/stop_position
+    'stop_area_relations': 0.25,  # stop_area relations
+    'route_relations': 0.35,  # Route relations, the rest are relations without PuT tags
+    'nested_relations': 0.2,  # Share of PuT relations with a relation member
+}
+
+# Stages of the extraction in pipeline order (method names of PublicTransportStopExtractor)
+STAGES = ('process_relations', 'process_ways', 'process_nodes', 'compute_centroids', 'filter_region', 'add_info_stoparea_putline', 'get_results')
+
+_STOP_TAGS = (
+    {'public_transport': 'platform', 'bus': 'yes', 'highway': 'bus_stop'},
+    {'public_transport': 'stop_position', 'bus': 'yes'},
+    {'public_transport': 'stop_position', 'tram': 'yes'},
+    {'public_transport': 'platform', 'railway': 'platform'},
+    {'public_transport': 'platform', 'train': 'yes'},
+    {'public_transport': 'station', 'station': 'subway'},
+    {'public_transport': 'station', 'bus': 'yes'},
+    {'railway': 'halt'},
+    {'railway': 'tram_stop'},
+    {'railway': 'station', 'station': 'train'},
+)
+_ROUTES = ('bus', 'bus', 'bus', 'tram', 'train', 'light_rail', 'subway')
+_TRAIN_SERVICES = ('regional', 'long_distance', 'high_speed', 'commuter', 'regional;long_distance', 'unknown_service')
+
+
+def generate_osm_file(path, node_count, densities=None, seed=1, bbox=(9.0, 48.6, 9.4, 48.9)):
+    """
+    Write a synthetic OSM file with PuT stops. The same arguments always give the same file.
+    - Nodes are spread uniformly over bbox, a share of them is tagged as stops.
+    - Ways are short chains of consecutive nodes, half of them closed, a share of them is tagged as stops.
+    - Relations are stops (ways and nodes as members), stop_areas (members with names), routes (stop/platform and way
+      members, train routes with service tags) or untagged. A share of the PuT relations contains other relations,
+      mostly earlier ones and sometimes later ones, which also creates cycles.
+    :param path: Output file, the format is derived from the extension (e.g. .osm.pbf)
+    :param node_count: Number of nodes
+    :param densities: Dict overriding entries of DEFAULT_DENSITIES
+    :param seed: Seed of the random generator
+    :param bbox: (min_lon, min_lat, max_lon, max_lat) of the nodes
+    """
+    densities = {**DEFAULT_DENSITIES, **(densities or {})}
+    rng = random.Random(seed)
+    path = pathlib.Path(path)
+    if path.exists():
+        path.unlink()
+    min_lon, min_lat, max_lon, max_lat = bbox
+    writer = osmium.SimpleWriter(str(path))
+    try:
+        for node_id in range(1, node_count + 1):
+            tags = {}
+            if rng.random() < densities['stop_nodes']:
+                tags = {**rng.choice(_STOP_TAGS), 'name': f'Stop {rng.randrange(node_count // 20 + 1)}'}
+            location = (min_lon + rng.random() * (max_lon - min_lon), min_lat + rng.random() * (max_lat - min_lat))
+            writer.add_node(Node(id=node_id, location=location, tags=tags))
+
+        way_count = max(1, int(node_count * densities['ways_per_node']))
+        for way_id in range(1, way_count + 1):
+            start = rng.randint(1, max(1, node_count - 8))
+            node_refs = list(range(start, min(node_count, start + rng.randint(2, 7)) + 1))
+            if len(node_refs) >= 3 and rng.random() < 0.5:
+                node_refs.append(node_refs[0])
+            tags = {'highway': 'residential'}
+            if rng.random() < densities['platform_ways']:
+                tags = {**rng.choice(_STOP_TAGS), 'name': f'Stop {rng.randrange(node_count // 20 + 1)}'}
+            writer.add_way(Way(id=way_id, nodes=node_refs, tags=tags))
+
+        relation_count = max(1, int(node_count * densities['relations_per_node']))
+        for relation_id in range(1, relation_count + 1):
+            kind = rng.random()
+            members = []
+            if kind < densities['stop_relations']:
+                members = [('w', rng.randint(1, way_count), 'outer') for _ in range(rng.randint(1, 3))]
+                members += [('n', rng.randint(1, node_count), '') for _ in range(rng.randint(0, 2))]
+                tags = {**rng.choice(_STOP_TAGS[:5]), 'type': 'multipolygon', 'name': f'Stop {rng.randrange(node_count // 20 + 1)}'}
+                tags['public_transport'] = rng.choice(('platform', 'stop_position'))
+                role = ''
+            elif kind < densities['stop_relations'] + densities['stop_area_relations']:
+                members = [(rng.choice('nw'), 0, rng.choice(('platform', 'stop', ''))) for _ in range(rng.randint(1, 6))]
+                members = [(t, rng.randint(1, node_count) if t == 'n' else rng.randint(1, way_count), member_role) for t, _, member_role in members]
+                tags = {'type': 'public_transport', 'public_transport': 'stop_area'}
+                if rng.random() < 0.8:
+                    tags['name'] = f'Area {relation_id}'
+                role = 'platform'
+            elif kind < densities['stop_relations'] + densities['stop_area_relations'] + densities['route_relations']:
+                members = [('n', rng.randint(1, node_count), rng.choice(('stop', 'platform', 'stop_entry_only'))) for _ in range(rng.randint(2, 10))]
+                members += [('w', rng.randint(1, way_count), rng.choice(('', '', 'platform'))) for _ in range(rng.randint(1, 10))]
+                route = rng.choice(_ROUTES)
+                tags = {'type': 'route', 'route': route}
+                if route == 'train':
+                    tags['service'] = rng.choice(_TRAIN_SERVICES)
+                role = 'platform'
+            else:
+                members = [('w', rng.randint(1, way_count), 'outer')]
+                tags = {'type': 'multipolygon', 'landuse': 'grass'}
+                role = None
+            if role is not None and rng.random() < densities['nested_relations']:
+                nested_id = rng.randint(1, relation_id - 1) if relation_id > 1 and rng.random() < 0.8 else rng.randint(1, relation_count)
+                members.append(('r', nested_id, role))
+            writer.add_relation(Relation(id=relation_id, members=members, tags=tags))
+    finally:
+        writer.close()
+
+
+def _peak_rss_mb():
+    """Peak resident set size of the current process or of its largest worker process in MB (see metrics.peak_rss_bytes)."""
+    return peak_rss_bytes() / 1024 ** 2
+
+
+def _run_stages(osm_file, extractor_options, connection):
+    """Run all stages once in a fresh process and send the timings and the peak memory through the pipe."""
+    logging.disable(logging.WARNING)
+    extractor = PublicTransportStopExtractor(osm_file, **extractor_options)
+    timings = {}
+    for stage in STAGES:
+        start = time.perf_counter()
+        result = getattr(extractor, stage)()
+        timings[stage] = time.perf_counter() - start
+    connection.send({'timings': timings, 'peak_rss_mb': _peak_rss_mb(), 'stops': len(result)})
+    connection.close()
+
+
+def run_benchmark(osm_file, repeats=3, extractor_options=None):
+    """
+    Time the stages of the extraction on a file. Every repetition runs in a new process, so the peak memory of a run
+    isn't hidden by earlier runs.
+    :return: Dict with the median time of each stage, the total, the maximal peak RSS and the number of stops
+    """
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeats):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_stages, args=(str(osm_file), extractor_options or {}, sender))
+        process.start()
+        sender.close()
+        runs.append(receiver.recv())
+        process.join()
+    timings = {stage: statistics.median(run['timings'][stage] for run in runs) for stage in STAGES}
+    return {
+        'timings': timings,
+        'total': sum(timings.values()),
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+        'stops': runs[0]['stops'],
+    }
+
+
+def find_regressions(results, baseline, time_tolerance=0.2, memory_tolerance=0.2, min_seconds=0.05):
+    """
+    Compare benchmark results with a baseline (both dicts of scale -> result of run_benchmark).
+    :param time_tolerance: Allowed relative slowdown of a stage or the total
+    :param memory_tolerance: Allowed relative increase of the peak memory
+    :param min_seconds: Slowdowns smaller than this are ignored as noise
+    :return: List of messages, empty without regressions
+    """
+    regressions = []
+    for scale, result in results.items():
+        if scale not in baseline:
+            continue
+        reference = baseline[scale]
+        for stage, seconds in [*result['timings'].items(), ('total', result['total'])]:
+            reference_seconds = reference['total'] if stage == 'total' else reference['timings'].get(stage)
+            if reference_seconds is not None and seconds > reference_seconds * (1 + time_tolerance) and seconds - reference_seconds > min_seconds:
+                regressions.append(f'{scale}/{stage}: {seconds:.3f} s (baseline {reference_seconds:.3f} s, +{(seconds / reference_seconds - 1) * 100:.0f}%)')
+        if result['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + memory_tolerance):
+            regressions.append(f'{scale}/peak_rss: {result["peak_rss_mb"]:.0f} MB (baseline {reference["peak_rss_mb"]:.0f} MB)')
+        if result['stops'] != reference['stops']:
+            regressions.append(f'{scale}/stops: {result["stops"]} stops (baseline {reference["stops"]})')
+    return regressions
+
+
+def _git_commit():
+    """Commit of the working tree or None outside of a git repository."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=pathlib.Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    parser = argparse.ArgumentParser(description='Benchmark the PuT stop extraction on synthetic OSM files.')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES), help='Scales to run')
+    parser.add_argument('--repeats', default=3, type=int, help='Runs per scale, the median time of each stage is reported')
+    parser.add_argument('--seed', default=1, type=int, help='Seed of the synthetic files')
+    parser.add_argument('--density', action='append', default=[], metavar='NAME=SHARE', help=f'Override a density, one of {", ".join(DEFAULT_DENSITIES)}')
+    parser.add_argument('--pass-plan', default='native', choices=PublicTransportStopExtractor.PASS_PLANS, help='Pass plan of the extractor')
+    parser.add_argument('--workers', default=1, type=int, help='Worker processes of the extractor')
+    parser.add_argument('--data-dir', default=pathlib.Path('.benchmark_data'), type=pathlib.Path, help='Directory of the synthetic files')
+    parser.add_argument('--history', default=pathlib.Path('benchmark_history.json'), type=pathlib.Path, help='JSON file the results are appended to')
+    parser.add_argument('--baseline', default=pathlib.Path('benchmark_baseline.json'), type=pathlib.Path, help='JSON file with the baseline results')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as new baseline instead of comparing with it')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Allowed relative slowdown/memory increase before a regression is reported')
+    args = parser.parse_args()
+
+    densities = {name: float(share) for name, share in (density.split('=') for density in args.density)}
+    unknown = set(densities) - set(DEFAULT_DENSITIES)
+    if unknown:
+        parser.error(f'Unknown densities: {", ".join(sorted(unknown))}')
+    extractor_options = {'pass_plan': args.pass_plan, 'workers': args.workers}
+    args.data_dir.mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    for scale in args.scales:
+        density_suffix = ''.join(f'_{name}{share:g}' for name, share in sorted(densities.items()))
+        osm_file = args.data_dir / f'synthetic_{scale}_seed{args.seed}{density_suffix}.osm.pbf'
+        if not osm_file.exists():
+            logging.info(f'Generating {osm_file}...')
+            generate_osm_file(osm_file, SCALES[scale], densities, seed=args.seed)
+        logging.info(f'Benchmarking scale {scale} ({args.repeats} runs)...')
+        results[scale] = run_benchmark(osm_file, args.repeats, extractor_options)
+        timings = ', '.join(f'{stage} {seconds:.2f} s' for stage, seconds in results[scale]['timings'].items())
+        logging.info(f'{scale}: {timings}, total {results[scale]["total"]:.2f} s, peak RSS {results[scale]["peak_rss_mb"]:.0f} MB, {results[scale]["stops"]} stops')
+
+    entry = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'osmium': osmium.version.pyosmium_release,
+        'cpu_count': os.cpu_count(),
+        'seed': args.seed,
+        'densities': {**DEFAULT_DENSITIES, **densities},
+        'extractor_options': extractor_options,
+        'results': results,
+    }
+    history = json.loads(args.history.read_text()) if args.history.exists() else []
+    history.append(entry)
+    args.history.write_text(json.dumps(history, indent=2))
+    logging.info(f'Results appended to {args.history}.')
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(entry, indent=2))
+        logging.info(f'Results saved as baseline to {args.baseline}.')
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if baseline['seed'] != entry['seed'] or baseline['densities'] != entry['densities'] or baseline['extractor_options'] != entry['extractor_options']:
+            logging.warning('The baseline was recorded with other settings, the comparison may not be meaningful.')
+        regressions = find_regressions(results, baseline['results'], args.tolerance, args.tolerance)
+        for regression in regressions:
+            logging.error(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+        logging.info(f'No regressions compared to the baseline of {baseline["timestamp"]} ({baseline["commit"]}).')
@@ -0,0 +1,172 @@
+import hashlib
+
+
+# Kinds of PuT stops. The first kind whose tag matches decides how an element is classified:
+# - tag: (key, values) that makes an element a stop of this kind
+# - osm_types: element types the kind applies to
+# - fields: result fields copied from tags (field: key), missing tags are left out
+# - rules: name of the rule set in CLASSIFICATION_RULES that derives general_type and specific_type
+STOP_KINDS = (
+    {
+        'tag': ('railway', ('station', 'halt', 'tram_stop')),
+        'osm_types': ('node', 'way'),
+        'fields': {'osm_railway': 'railway'},
+        'rules': 'railway_station',
+    },
+    {
+        'tag': ('public_transport', ('station',)),
+        'osm_types': ('node', 'way'),
+        'fields': {'osm_railway': 'railway'},
+        'rules': 'station',
+    },
+    {
+        'tag': ('public_transport', ('platform', 'stop_position')),
+        'osm_types': ('node', 'way', 'relation'),
+        'fields': {'osm_public_transport': 'public_transport'},
+        'rules': 'stop',
+    },
+)
+
+# Rule sets deriving general_type and specific_type, the first matching rule wins:
+# - if: {key: values} the element's tags have to match, a rule without 'if' always matches
+# - general_type: general type of the stop
+# - specific_type: specific type of the stop, or specific_type_from: key of the tag whose value is the specific type
+# New modes only need new rules (e.g. {'if': {'ferry': ('yes',)}, 'general_type': 'ferry', 'specific_type': 'ferry'}).
+CLASSIFICATION_RULES = {
+    'stop': (
+        {'if': {'train': ('yes',)}, 'general_type': 'rail', 'specific_type': 'train'},
+        {'if': {'subway': ('yes',)}, 'general_type': 'rail', 'specific_type': 'subway'},
+        {'if': {'light_rail': ('yes',)}, 'general_type': 'rail', 'specific_type': 'light_rail'},
+        {'if': {'tram': ('yes',)}, 'general_type': 'rail', 'specific_type': 'tram'},
+        {'if': {'bus': ('yes',)}, 'general_type': 'bus', 'specific_type': 'bus'},
+        {'if': {'highway': ('bus_stop',)}, 'general_type': 'bus', 'specific_type': 'bus'},
+        {'if': {'railway': ('platform',)}, 'general_type': 'rail', 'specific_type': 'railway_platform'},
+        {'if': {'highway': ('platform',)}, 'general_type': 'bus', 'specific_type': 'highway_platform'},
+        {'general_type': 'unknown', 'specific_type': 'unknown'},
+    ),
+    'railway_station': (
+        {'if': {'station': ('train', 'subway', 'light_rail', 'monorail', 'funicular')}, 'general_type': 'rail', 'specific_type_from': 'station'},
+        {'general_type': 'rail', 'specific_type_from': 'railway'},
+    ),
+    'station': (
+        {'if': {'station': ('train', 'subway', 'light_rail', 'monorail', 'funicular')}, 'general_type': 'rail', 'specific_type_from': 'station'},
+        {'if': {'bus': ('yes',)}, 'general_type': 'bus', 'specific_type': 'bus'},
+        {'general_type': 'rail', 'specific_type_from': 'railway'},
+    ),
+}
+
+# Priority of train services (tag service of route=train relations), lower is more important
+SERVICE_PRIORITIES = {
+    'high_speed': 1,
+    'international': 1,
+    'long_distance': 2,
+    'national': 2,
+    'regional': 3,
+    'commuter': 4,
+    'suburban': 4,
+    'local': 5,
+    'night': 6,
+    'tourism': 7,
+    'car': 8,
+    'car_shuttle': 8,
+    'event': 9,
+}
+# Priority of routes without a known service
+DEFAULT_SERVICE_PRIORITY = 10
+
+# General type of stops with an unknown type, derived from the type of the routes serving them
+ROUTE_GENERAL_TYPES = {
+    'train': 'rail',
+    'light_rail': 'rail',
+    'tram': 'rail',
+    'funicular': 'rail',
+    'bus': 'bus',
+    'coach': 'bus',
+    'trolleybus': 'bus',
+}
+
+
+class TagClassifier:
+    """
+    Classification rules compiled for the handlers' hot path.
+
+    classify() first checks the few keys that make an element a stop, so most elements are rejected after one or two
+    tag lookups. For stops it looks up the keys the rules depend on (osmium's tags.get() runs in C++ and is cheaper than
+    iterating over the tags in Python) and returns all derived fields at once. The fields only depend on these tag
+    values, so the rules are evaluated once per distinct combination and the result is memoized.
+    """
+    def __init__(self, stop_kinds=STOP_KINDS, rules=CLASSIFICATION_RULES, service_priorities=SERVICE_PRIORITIES,
+                 default_service_priority=DEFAULT_SERVICE_PRIORITY, route_general_types=ROUTE_GENERAL_TYPES):
+        self.stop_kinds = stop_kinds
+        self.rules = rules
+        self.service_priorities = service_priorities
+        self.default_service_priority = default_service_priority
+        self.route_general_types = route_general_types
+        keys = set()
+        for kind in stop_kinds:
+            if kind['rules'] not in rules:
+                raise ValueError(f'Unknown rule set of a stop kind: {kind["rules"]}')
+            keys.add(kind['tag'][0])
+            keys.update(kind['fields'].values())
+            for rule in rules[kind['rules']]:
+                keys.update(rule.get('if', {}))
+                if 'specific_type_from' in rule:
+                    keys.add(rule['specific_type_from'])
+        # Keys the fields depend on, in a fixed order for the memo keys
+        self.keys = tuple(sorted(keys))
+        # Values of each key that make an element a stop
+        self.kind_values = {}
+        for kind in stop_kinds:
+            self.kind_values.setdefault(kind['tag'][0], set()).update(kind['tag'][1])
+        self.kind_values = tuple((key, frozenset(values)) for key, values in self.kind_values.items())
+        self.stop_tags = tuple(dict.fromkeys((kind['tag'][0], value) for kind in stop_kinds for value in kind['tag'][1]))
+        self.__memo = {}
+
+    def fingerprint(self):
+        """Hash of the rules, e.g. for cache keys."""
+        return hashlib.sha256(repr((self.stop_kinds, self.rules, self.service_priorities, self.default_service_priority)).encode()).hexdigest()
+
+    def classify(self, tags, osm_type):
+        """
+        Return the fields derived from the tags of a stop (osm_name, general_type, specific_type and the fields of its
+        stop kind) or None if the element isn't a stop.
+        :param tags: Tags of the element with a get(key) method (osmium's TagList or a dict)
+        :param osm_type: 'node', 'way' or 'relation'
+        """
+        get = tags.get
+        for key, values in self.kind_values:
+            if get(key) in values:
+                break
+        else:
+            return None
+        memo_key = (osm_type, *map(get, self.keys))
+        fields = self.__memo.get(memo_key, False)
+        if fields is False:
+            fields = self.__memo[memo_key] = self.__evaluate(dict(zip(self.keys, memo_key[1:])), osm_type)
+        if fields is None:
+            return None
+        return {'osm_name': get('name', 'N/A'), **fields}
+
+    def __evaluate(self, values, osm_type):
+        """Evaluate the rules for the relevant tag values of an element (key: value or None if the tag is missing)."""
+        for kind in self.stop_kinds:
+            key, kind_values = kind['tag']
+            if osm_type not in kind['osm_types'] or values.get(key) not in kind_values:
+                continue
+            fields = {field: values[tag_key] for field, tag_key in kind['fields'].items() if values[tag_key] is not None}
+            for rule in self.rules[kind['rules']]:
+                if all(values.get(rule_key) in rule_values for rule_key, rule_values in rule.get('if', {}).items()):
+                    fields['general_type'] = rule['general_type']
+                    fields['specific_type'] = values.get(rule['specific_type_from']) if 'specific_type_from' in rule else rule['specific_type']
+                    break
+            return fields
+        return None
+
+    def service_priority(self, service_types):
+        """
+        Return the priority of a route's service tag, the most important of several services separated by semicolons.
+        :param service_types: Value of the service tag
+        :return: Priority or None if none of the services has a priority
+        """
+        priorities = [self.service_priorities[service_type] for service_type in service_types.split(';') if service_type in self.service_priorities]
+        return min(priorities) if priorities else None
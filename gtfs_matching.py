@@ -0,0 +1,325 @@
+import argparse
+import logging
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+
+METERS_PER_DEGREE = 111320.0
+
+# GTFS route types (basic and extended) -> (general_type, specific_type) as used in the extractor's results
+GTFS_ROUTE_TYPES = {
+    0: ('rail', 'tram'),
+    1: ('rail', 'subway'),
+    2: ('rail', 'train'),
+    3: ('bus', 'bus'),
+    4: ('ferry', 'ferry'),
+    5: ('rail', 'tram'),
+    6: ('aerialway', 'aerialway'),
+    7: ('rail', 'funicular'),
+    11: ('bus', 'trolleybus'),
+    12: ('rail', 'monorail'),
+}
+GTFS_EXTENDED_ROUTE_TYPES = {
+    # First route type of each range of extended route types
+    100: ('rail', 'train'),
+    200: ('bus', 'coach'),
+    400: ('rail', 'subway'),
+    700: ('bus', 'bus'),
+    800: ('bus', 'trolleybus'),
+    900: ('rail', 'tram'),
+    1000: ('ferry', 'ferry'),
+    1200: ('ferry', 'ferry'),
+    1300: ('aerialway', 'aerialway'),
+    1400: ('rail', 'funicular'),
+}
+# OSM specific types that describe the same service as another one in the GTFS route types
+SPECIFIC_TYPE_ALIASES = {'light_rail': 'train', 'railway_platform': 'train', 'highway_platform': 'bus', 'coach': 'bus', 'trolleybus': 'bus'}
+
+# Replacements of the name normalization, applied after lowercasing
+NAME_REPLACEMENTS = (
+    ('ß', 'ss'), ('ä', 'ae'), ('ö', 'oe'), ('ü', 'ue'),
+    (r'str\.', 'strasse'), (r'\bhbf\b', 'hauptbahnhof'), (r'\bbf\b', 'bahnhof'), (r'\bpl\.', 'platz'),
+    (r'[^\w]+', ' '),
+)
+
+
+def gtfs_route_type(route_type):
+    """Return (general_type, specific_type) of a GTFS route type or ('unknown', 'unknown')."""
+    if route_type in GTFS_ROUTE_TYPES:
+        return GTFS_ROUTE_TYPES[route_type]
+    return GTFS_EXTENDED_ROUTE_TYPES.get(route_type // 100 * 100, ('unknown', 'unknown'))
+
+
+def load_gtfs_stops(gtfs_dir, route_types=True, chunk_size=5000000):
+    """
+    Read the stops and stations of a GTFS feed.
+    :param gtfs_dir: Directory with the (unzipped) GTFS files
+    :param route_types: Also collect the route types serving each stop from stop_times.txt, trips.txt and routes.txt.
+                        Stations get the route types of their child stops.
+    :param chunk_size: Rows of stop_times.txt read at once
+    :return: DataFrame with stop_id, stop_name, stop_lat, stop_lon, location_type and (with route_types) a column
+             route_types with the list of route types of each stop
+    """
+    gtfs_dir = pathlib.Path(gtfs_dir)
+    stops = pd.read_csv(gtfs_dir / 'stops.txt', dtype={'stop_id': str, 'parent_station': str}, keep_default_na=False, na_values={'stop_lat': '', 'stop_lon': ''})
+    if 'location_type' not in stops:
+        stops['location_type'] = 0
+    stops['location_type'] = pd.to_numeric(stops['location_type'], errors='coerce').fillna(0).astype(int)
+    # Stops/platforms and stations, no entrances, generic nodes or boarding areas
+    stops = stops[stops['location_type'].isin([0, 1]) & stops['stop_lat'].notna() & stops['stop_lon'].notna()].reset_index(drop=True)
+    if not route_types:
+        return stops
+
+    routes = pd.read_csv(gtfs_dir / 'routes.txt', usecols=['route_id', 'route_type'], dtype={'route_id': str})
+    trips = pd.read_csv(gtfs_dir / 'trips.txt', usecols=['trip_id', 'route_id'], dtype=str)
+    trip_route_types = trips.merge(routes, on='route_id').set_index('trip_id')['route_type']
+    stop_route_types = []
+    for stop_times in pd.read_csv(gtfs_dir / 'stop_times.txt', usecols=['trip_id', 'stop_id'], dtype=str, chunksize=chunk_size):
+        stop_times = stop_times.drop_duplicates()
+        stop_times['route_type'] = stop_times['trip_id'].map(trip_route_types)
+        stop_route_types.append(stop_times[['stop_id', 'route_type']].dropna().drop_duplicates())
+    stop_route_types = pd.concat(stop_route_types).drop_duplicates()
+    # Stations are served by the route types of their child stops
+    parents = stops.loc[stops['parent_station'].fillna('') != '', ['stop_id', 'parent_station']] if 'parent_station' in stops else pd.DataFrame(columns=['stop_id', 'parent_station'])
+    station_route_types = stop_route_types.merge(parents, on='stop_id')[['parent_station', 'route_type']].rename(columns={'parent_station': 'stop_id'})
+    stop_route_types = pd.concat([stop_route_types, station_route_types]).drop_duplicates()
+    route_type_lists = stop_route_types.groupby('stop_id')['route_type'].agg(lambda types: sorted(int(t) for t in types))
+    stops['route_types'] = stops['stop_id'].map(route_type_lists)
+    stops['route_types'] = [types if isinstance(types, list) else [] for types in stops['route_types']]
+    return stops
+
+
+def normalize_names(names):
+    """Normalize stop names for comparing them: lowercase, umlauts, common abbreviations, no punctuation."""
+    codes, unique_names = pd.factorize(pd.Series(names, dtype=object).fillna(''))
+    # Each distinct name is normalized once
+    normalized = pd.Series(unique_names, dtype=object).astype(str).str.casefold()
+    for pattern, replacement in NAME_REPLACEMENTS:
+        normalized = normalized.str.replace(pattern, replacement, regex=True)
+    normalized = normalized.str.strip().to_numpy(dtype=object)
+    return pd.Series(normalized[codes] if len(normalized) else np.full(len(codes), '', dtype=object), index=names.index if isinstance(names, pd.Series) else None, dtype=object)
+
+
+def name_signatures(names, max_length=64):
+    """
+    Return 128-bit character trigram signatures of the names as (n, 2) uint64 array: each trigram of ' name ' sets one
+    bit chosen by a multiplicative hash of its three characters. The share of common bits estimates the trigram
+    similarity and can be computed for millions of pairs with bitwise operations.
+    """
+    padded = (' ' + pd.Series(names, dtype=object).fillna('').astype(str) + ' ').str.slice(0, max_length).to_numpy(dtype=f'<U{max_length}')
+    chars = padded.view(np.uint32).reshape(len(padded), max_length).astype(np.uint64)
+    lengths = np.char.str_len(padded)
+    with np.errstate(over='ignore'):
+        hashes = chars[:, :-2] * np.uint64(0x9E3779B97F4A7C15) + chars[:, 1:-1] * np.uint64(0xC2B2AE3D27D4EB4F) + chars[:, 2:] * np.uint64(0x165667B19E3779F9)
+    bits = (hashes >> np.uint64(57)).astype(np.int64)  # 0..127
+    valid = np.arange(max_length - 2)[None, :] < (lengths - 2)[:, None]
+    signatures = np.zeros((len(padded), 2), dtype=np.uint64)
+    for word in (0, 1):
+        word_bits = np.where(valid & (bits // 64 == word), np.uint64(1) << (bits % 64).astype(np.uint64), np.uint64(0))
+        signatures[:, word] = np.bitwise_or.reduce(word_bits, axis=1)
+    return signatures
+
+
+def _signature_similarity(signatures_a, signatures_b):
+    """Overlap coefficient |a & b| / min(|a|, |b|) of trigram signatures, so a name contained in the other one (e.g. without the town) still scores high."""
+    common = np.bitwise_count(signatures_a & signatures_b).sum(axis=1)
+    smaller = np.minimum(np.bitwise_count(signatures_a).sum(axis=1), np.bitwise_count(signatures_b).sum(axis=1))
+    return np.where(smaller > 0, common / np.maximum(smaller, 1), 0.0)
+
+
+def _project(lat, lon, reference_lat):
+    """Equirectangular projection in meters, reference_lat must be the latitude farthest from the equator so x distances are never overestimated."""
+    return lon * np.cos(np.radians(reference_lat)) * METERS_PER_DEGREE, lat * METERS_PER_DEGREE
+
+
+def grid_cross_pairs(lat_a, lon_a, lat_b, lon_b, max_distance):
+    """
+    Return all pairs (i, j) of points a[i] and b[j] closer than max_distance and their distances in meters. The points b
+    are sorted into a grid with cells of max_distance, each point a only looks at its own and the 8 adjacent cells.
+    """
+    if not len(lat_a) or not len(lat_b):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    reference_lat = min(max(np.abs(lat_a).max(), np.abs(lat_b).max()), 89.0)
+    x_a, y_a = _project(lat_a, lon_a, reference_lat)
+    x_b, y_b = _project(lat_b, lon_b, reference_lat)
+    cell_x_a, cell_y_a = np.floor(x_a / max_distance).astype(np.int64), np.floor(y_a / max_distance).astype(np.int64)
+    cell_x_b, cell_y_b = np.floor(x_b / max_distance).astype(np.int64), np.floor(y_b / max_distance).astype(np.int64)
+    min_x = min(cell_x_a.min(), cell_x_b.min()) - 1
+    min_y = min(cell_y_a.min(), cell_y_b.min()) - 1
+    width = max(cell_y_a.max(), cell_y_b.max()) - min_y + 2
+    keys_a = (cell_x_a - min_x) * width + (cell_y_a - min_y)
+    keys_b = (cell_x_b - min_x) * width + (cell_y_b - min_y)
+    order_a = np.argsort(keys_a, kind='stable')
+    order_b = np.argsort(keys_b, kind='stable')
+    sorted_keys_a = keys_a[order_a]
+    sorted_keys_b = keys_b[order_b]
+
+    pairs_i, pairs_j = [], []
+    # The cells y - 1, y and y + 1 of a column have consecutive keys, so each column is one range of the sorted points b.
+    # Searching sorted keys keeps the binary searches cache friendly.
+    for dx in (-1, 0, 1):
+        starts = sorted_keys_b.searchsorted(sorted_keys_a + dx * width - 1, side='left')
+        counts = sorted_keys_b.searchsorted(sorted_keys_a + dx * width + 1, side='right') - starts
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        pairs_i.append(np.repeat(order_a, counts))
+        pairs_j.append(order_b[positions])
+    i = np.concatenate(pairs_i)
+    j = np.concatenate(pairs_j)
+    dx = (lon_a[i] - lon_b[j]) * np.cos(np.radians((lat_a[i] + lat_b[j]) / 2)) * METERS_PER_DEGREE
+    dy = (lat_a[i] - lat_b[j]) * METERS_PER_DEGREE
+    distance = np.hypot(dx, dy)
+    close = distance <= max_distance
+    return i[close], j[close], distance[close]
+
+
+def _type_scores(osm_general, osm_specific, gtfs_route_type_lists, i, j):
+    """
+    Type compatibility of the pairs: 1 if a GTFS route type has the OSM specific type, 0.75 if only the general type
+    matches, 0.5 if either side has no known type and 0 if the types contradict each other.
+    Types are compared as bit masks, each distinct type is one bit.
+    """
+    type_codes = {}
+
+    def type_bit(value, aliases=None):
+        if value is None or value != value or value == 'unknown':
+            return 0
+        value = aliases.get(value, value) if aliases else value
+        if value not in type_codes and len(type_codes) == 63:
+            raise ValueError('Too many different types for the type bit masks.')
+        return 1 << type_codes.setdefault(value, len(type_codes))
+
+    def osm_bits(values, aliases=None):
+        value_codes, unique_values = pd.factorize(pd.Series(values, dtype=object))
+        # Missing values have code -1 and get the trailing 0
+        return np.array([type_bit(value, aliases) for value in unique_values] + [0], dtype=np.int64)[value_codes]
+
+    # Bits of each distinct route type, combined per GTFS stop
+    lengths = np.fromiter((len(route_types) for route_types in gtfs_route_type_lists), dtype=np.int64, count=len(gtfs_route_type_lists))
+    flat_route_types = np.fromiter((route_type for route_types in gtfs_route_type_lists for route_type in route_types), dtype=np.int64, count=lengths.sum())
+    unique_route_types, route_type_codes = np.unique(flat_route_types, return_inverse=True)
+    route_types = [gtfs_route_type(route_type) for route_type in unique_route_types.tolist()]
+    stops = np.repeat(np.arange(len(lengths)), lengths)
+    gtfs_general = np.zeros(len(lengths), dtype=np.int64)
+    gtfs_specific = np.zeros(len(lengths), dtype=np.int64)
+    np.bitwise_or.at(gtfs_general, stops, np.array([type_bit(general) for general, _ in route_types], dtype=np.int64)[route_type_codes])
+    np.bitwise_or.at(gtfs_specific, stops, np.array([type_bit(specific, SPECIFIC_TYPE_ALIASES) for _, specific in route_types], dtype=np.int64)[route_type_codes])
+    osm_general_bits = osm_bits(osm_general)
+    osm_specific_bits = osm_bits(osm_specific, SPECIFIC_TYPE_ALIASES)
+
+    general_a, general_b = osm_general_bits[i], gtfs_general[j]
+    specific_a, specific_b = osm_specific_bits[i], gtfs_specific[j]
+    return np.select(
+        [(general_a == 0) | (general_b == 0), (specific_a & specific_b) != 0, (general_a & general_b) != 0],
+        [0.5, 1.0, 0.75],
+        default=0.0,
+    )
+
+
+def assign_one_to_one(i, j, scores):
+    """
+    Greedy one-to-one assignment of the pairs by descending score. Each round accepts the pairs that are the best
+    remaining pair of both of their stops and removes all other pairs of these stops, which gives the same result as
+    accepting the pairs one by one in score order.
+    :return: Positions of the accepted pairs
+    """
+    # Unique ranks (ties broken by position) so every stop has exactly one best pair
+    order = np.lexsort((np.arange(len(scores)), -scores))
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[order] = np.arange(len(scores))
+    remaining = np.arange(len(scores))
+    accepted = []
+    size_i = int(i.max(initial=-1)) + 1
+    size_j = int(j.max(initial=-1)) + 1
+    while len(remaining):
+        best_i = np.full(size_i, len(scores), dtype=np.int64)
+        best_j = np.full(size_j, len(scores), dtype=np.int64)
+        np.minimum.at(best_i, i[remaining], ranks[remaining])
+        np.minimum.at(best_j, j[remaining], ranks[remaining])
+        mutual = remaining[(best_i[i[remaining]] == ranks[remaining]) & (best_j[j[remaining]] == ranks[remaining])]
+        accepted.append(mutual)
+        matched_i = np.zeros(size_i, dtype=bool)
+        matched_j = np.zeros(size_j, dtype=bool)
+        matched_i[i[mutual]] = True
+        matched_j[j[mutual]] = True
+        remaining = remaining[~matched_i[i[remaining]] & ~matched_j[j[remaining]]]
+    return np.sort(np.concatenate(accepted)) if accepted else np.zeros(0, dtype=np.int64)
+
+
+def match_stops(osm_stops, gtfs_stops, max_distance=150.0, min_score=0.5, weights=(0.4, 0.4, 0.2)):
+    """
+    Match OSM stops (results of the extractor) to GTFS stops one to one.
+    Candidate pairs are all pairs closer than max_distance (grid_cross_pairs), their score is the weighted sum of
+    - distance: 1 at the same position down to 0 at max_distance
+    - name similarity of the normalized names (trigram signatures, see name_signatures)
+    - type compatibility of general_type/specific_type with the route types of the GTFS stop (see _type_scores)
+    Pairs scoring below min_score are dropped, the rest are assigned greedily by score (assign_one_to_one).
+    Stops without coordinates on either side are left out.
+    :param osm_stops: DataFrame with lat, lon, general_type, specific_type and name (or osm_name)
+    :param gtfs_stops: DataFrame from load_gtfs_stops()
+    :param weights: Weights of distance, name and type score
+    :return: DataFrame with one row per match: osm_index and gtfs_index (index labels of the inputs), osm_id,
+             osm_object_type, stop_id, distance, name_similarity, type_score and score, sorted by osm_index
+    """
+    osm_stops = osm_stops[osm_stops['lat'].notna() & osm_stops['lon'].notna()]
+    gtfs_stops = gtfs_stops[gtfs_stops['stop_lat'].notna() & gtfs_stops['stop_lon'].notna()]
+    osm_lat, osm_lon = osm_stops['lat'].to_numpy(dtype=np.float64), osm_stops['lon'].to_numpy(dtype=np.float64)
+    gtfs_lat, gtfs_lon = gtfs_stops['stop_lat'].to_numpy(dtype=np.float64), gtfs_stops['stop_lon'].to_numpy(dtype=np.float64)
+    i, j, distance = grid_cross_pairs(osm_lat, osm_lon, gtfs_lat, gtfs_lon, max_distance)
+    logging.info(f'{len(i)} candidate pairs within {max_distance} m.')
+
+    # Signatures of the unique normalized names only
+    osm_names = osm_stops['name'] if 'name' in osm_stops else osm_stops['osm_name']
+    osm_names = normalize_names(osm_names.astype(object).where(osm_names.astype(object) != 'N/A'))
+    gtfs_names = normalize_names(gtfs_stops['stop_name'])
+    name_codes, unique_names = pd.factorize(pd.concat([osm_names, gtfs_names], ignore_index=True))
+    signatures = name_signatures(unique_names)
+    osm_name_codes, gtfs_name_codes = name_codes[:len(osm_names)], name_codes[len(osm_names):]
+    name_similarity = _signature_similarity(signatures[osm_name_codes[i]], signatures[gtfs_name_codes[j]])
+    name_similarity[osm_name_codes[i] == gtfs_name_codes[j]] = 1.0
+    name_similarity[(osm_names.to_numpy()[i] == '') | (gtfs_names.to_numpy()[j] == '')] = 0.0
+
+    route_type_lists = gtfs_stops['route_types'] if 'route_types' in gtfs_stops else [[]] * len(gtfs_stops)
+    type_score = _type_scores(osm_stops['general_type'].astype(object).to_numpy(), osm_stops['specific_type'].astype(object).to_numpy(), route_type_lists, i, j)
+
+    distance_weight, name_weight, type_weight = weights
+    score = distance_weight * (1 - distance / max_distance) + name_weight * name_similarity + type_weight * type_score
+    keep = score >= min_score
+    i, j, distance, name_similarity, type_score, score = i[keep], j[keep], distance[keep], name_similarity[keep], type_score[keep], score[keep]
+    accepted = assign_one_to_one(i, j, score)
+    accepted = accepted[np.argsort(i[accepted], kind='stable')]
+    return pd.DataFrame({
+        'osm_index': osm_stops.index[i[accepted]],
+        'gtfs_index': gtfs_stops.index[j[accepted]],
+        'osm_id': osm_stops['osm_id'].to_numpy()[i[accepted]],
+        'osm_object_type': osm_stops['osm_object_type'].astype(object).to_numpy()[i[accepted]],
+        'stop_id': gtfs_stops['stop_id'].to_numpy()[j[accepted]],
+        'distance': distance[accepted],
+        'name_similarity': name_similarity[accepted],
+        'type_score': type_score[accepted],
+        'score': score[accepted],
+    })
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    parser = argparse.ArgumentParser(description='Match extracted PuT stops to the stops of a GTFS feed.')
+    parser.add_argument('osm_stops', help='Results of main.py (.csv or .parquet)')
+    parser.add_argument('gtfs_dir', help='Directory with the unzipped GTFS feed')
+    parser.add_argument('--output', default='M30_put_stops_gtfs_matches.csv', help='Output CSV with one row per match')
+    parser.add_argument('--max-distance', default=150.0, type=float, help='Maximal distance of matched stops in meters')
+    parser.add_argument('--min-score', default=0.5, type=float, help='Minimal score of a match')
+    parser.add_argument('--no-route-types', action='store_true', help="Don't read stop_times.txt for the route types of the GTFS stops")
+    args = parser.parse_args()
+
+    osm_stops = pd.read_parquet(args.osm_stops) if args.osm_stops.endswith('.parquet') else pd.read_csv(args.osm_stops, low_memory=False)
+    gtfs_stops = load_gtfs_stops(args.gtfs_dir, route_types=not args.no_route_types)
+    logging.info(f'Matching {len(osm_stops)} OSM stops to {len(gtfs_stops)} GTFS stops...')
+    matches = match_stops(osm_stops, gtfs_stops, max_distance=args.max_distance, min_score=args.min_score)
+    matches.merge(gtfs_stops[['stop_name']], left_on='gtfs_index', right_index=True).to_csv(args.output, index=False)
+    logging.info(f'{len(matches)} matches written to {args.output}.')
@@ -0,0 +1,427 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+import osmium
+
+from main import OSM_TYPE_CODES, PublicTransportStopExtractor, _decode_records, _decode_strings, _encode_records, _encode_strings, osm_key
+
+
+class _Tags(dict):
+    """Tags of a stored object. Iterates over (key, value) pairs like osmium's TagList, so the handlers can use it."""
+    def __iter__(self):
+        return iter(self.items())
+
+
+class _Location(collections.namedtuple('_Location', 'lat lon')):
+    def valid(self):
+        return True
+
+
+_Member = collections.namedtuple('_Member', 'type ref role')
+_NodeRef = collections.namedtuple('_NodeRef', 'ref')
+_Node = collections.namedtuple('_Node', 'id tags location')
+_Way = collections.namedtuple('_Way', 'id tags nodes')
+_Relation = collections.namedtuple('_Relation', 'id tags members')
+
+# Shared by all untagged objects (most referenced nodes), the handlers never change tags
+_NO_TAGS = _Tags()
+
+# Stops are stored in this order by a full run: relations in the relation pass, then ways, then nodes
+_PASS_ORDER = {OSM_TYPE_CODES['r']: 0, OSM_TYPE_CODES['w']: 1, OSM_TYPE_CODES['n']: 2}
+
+
+def _store_object(obj):
+    """Copy an osmium object into a stored object with the attributes the handlers use."""
+    tags = _Tags((tag.k, tag.v) for tag in obj.tags) or _NO_TAGS
+    if obj.is_node():
+        return _Node(obj.id, tags, _Location(obj.location.lat, obj.location.lon))
+    if obj.is_way():
+        return _Way(obj.id, tags, [_NodeRef(n.ref) for n in obj.nodes])
+    return _Relation(obj.id, tags, [_Member(m.type, m.ref, m.role) for m in obj.members])
+
+
+def _is_put_relation(tags):
+    """Relations read by the relation handlers (see IncrementalStopExtractor.extract)."""
+    return 'route' in tags or 'public_transport' in tags
+
+
+def _encode_strings_to(prefix, strings, arrays):
+    arrays[f'{prefix}/codes'], arrays[f'{prefix}/data'], arrays[f'{prefix}/offsets'] = _encode_strings(strings)
+
+
+def _decode_strings_from(prefix, arrays):
+    return _decode_strings(arrays[f'{prefix}/codes'], arrays[f'{prefix}/data'], arrays[f'{prefix}/offsets'])
+
+
+def _encode_lists(prefix, lists, arrays):
+    """Store lists of ints as offsets and values."""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(values) for values in lists], out=offsets[1:])
+    arrays[f'{prefix}/offsets'] = offsets
+    arrays[f'{prefix}/values'] = np.fromiter(itertools.chain.from_iterable(lists), dtype=np.int64, count=offsets[-1])
+
+
+def _decode_lists(prefix, arrays):
+    offsets = arrays[f'{prefix}/offsets'].tolist()
+    values = arrays[f'{prefix}/values'].tolist()
+    return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def _encode_objects(name, objects, arrays):
+    """Add stored objects (dict of ID -> object of one type) to arrays as columns '<name>/...'."""
+    objects = list(objects.values())
+    arrays[f'{name}/ids'] = np.fromiter((obj.id for obj in objects), dtype=np.int64, count=len(objects))
+    _encode_lists(f'{name}/tag_counts', [[0] * len(obj.tags) for obj in objects], arrays)
+    _encode_strings_to(f'{name}/tag_keys', [key for obj in objects for key in obj.tags.keys()], arrays)
+    _encode_strings_to(f'{name}/tag_values', [value for obj in objects for value in obj.tags.values()], arrays)
+    if name == 'nodes':
+        arrays[f'{name}/lat'] = np.fromiter((obj.location.lat for obj in objects), dtype=np.float64, count=len(objects))
+        arrays[f'{name}/lon'] = np.fromiter((obj.location.lon for obj in objects), dtype=np.float64, count=len(objects))
+    elif name == 'ways':
+        _encode_lists(f'{name}/node_refs', [[node.ref for node in obj.nodes] for obj in objects], arrays)
+    else:
+        _encode_lists(f'{name}/members', [[osm_key(member.type, member.ref) for member in obj.members] for obj in objects], arrays)
+        _encode_strings_to(f'{name}/roles', [member.role for obj in objects for member in obj.members], arrays)
+
+
+def _decode_objects(name, arrays):
+    """Inverse of _encode_objects."""
+    ids = arrays[f'{name}/ids'].tolist()
+    tag_offsets = arrays[f'{name}/tag_counts/offsets'].tolist()
+    tag_keys = _decode_strings_from(f'{name}/tag_keys', arrays)
+    tag_values = _decode_strings_from(f'{name}/tag_values', arrays)
+    tags = [_Tags(zip(tag_keys[tag_offsets[i]:tag_offsets[i + 1]], tag_values[tag_offsets[i]:tag_offsets[i + 1]])) or _NO_TAGS for i in range(len(ids))]
+    if name == 'nodes':
+        locations = map(_Location, arrays[f'{name}/lat'].tolist(), arrays[f'{name}/lon'].tolist())
+        return {obj_id: _Node(obj_id, obj_tags, location) for obj_id, obj_tags, location in zip(ids, tags, locations)}
+    if name == 'ways':
+        node_refs = _decode_lists(f'{name}/node_refs', arrays)
+        return {obj_id: _Way(obj_id, obj_tags, [_NodeRef(ref) for ref in refs]) for obj_id, obj_tags, refs in zip(ids, tags, node_refs)}
+    member_types = {code: osm_type for osm_type, code in OSM_TYPE_CODES.items() if len(osm_type) == 1}
+    roles = iter(_decode_strings_from(f'{name}/roles', arrays))
+    members = [[_Member(member_types[key % 4], key // 4, next(roles)) for key in keys] for keys in _decode_lists(f'{name}/members', arrays)]
+    return {obj_id: _Relation(obj_id, obj_tags, obj_members) for obj_id, obj_tags, obj_members in zip(ids, tags, members)}
+
+
+class _StopSubset(dict):
+    """
+    stop_data of a partial recomputation. A way extends the node refs of all relations referencing it, those of
+    relations that aren't recomputed go to a record that is thrown away.
+    """
+    def __missing__(self, key):
+        return {'osm_node_refs': []}
+
+
+class IncrementalStopExtractor(PublicTransportStopExtractor):
+    """
+    Extractor that can be updated with OSM change files (.osc) instead of re-extracting the whole file.
+
+    The extraction state keeps the current version of the objects the stops depend on: relations tagged with route or
+    public_transport, ways and nodes that are stops and ways and nodes referenced by stops. Changed ways and nodes no
+    stop depends on are only kept as node lists and coordinates, because a later change may reference them and the
+    original file has an outdated version. All other objects are unchanged since the original file and are read from
+    it with ID filters when a change makes them relevant.
+
+    A change file only recomputes the stops it affects: stops among the changed objects, stop relations referencing a
+    changed way (relation_way_refs) and stops referencing a changed node (reverse index of the node refs of the
+    stops). The relation handlers are rerun on the route and public_transport relations if one of them changed, stops
+    whose relation info changed are recomputed as well. The handlers run on the affected objects in ID order, which is
+    the order of a full run, so the results match a full extraction of the updated file.
+
+    Usage:
+        extractor = IncrementalStopExtractor(osm_file_path)
+        extractor.extract()
+        extractor.save_state(state_path)
+        ...
+        extractor = IncrementalStopExtractor.load_state(state_path)
+        extractor.apply_changes(osc_file_path)
+        extractor.save_state(state_path)
+        results_df = extractor.get_results()
+    """
+    # Increase when the layout of the saved state changes
+    STATE_VERSION = 1
+
+    def __init__(self, osm_file, region=None, classifier=None):
+        super().__init__(osm_file, pass_plan='native', region=region, classifier=classifier)
+        # Current versions of the objects the stops depend on (key: ID, value: stored object)
+        self.known_objects = {'n': {}, 'w': {}, 'r': {}}
+        # IDs of known ways and nodes changed by change files, they are detached instead of dropped when no stop needs them anymore
+        self.modified_ids = {'n': set(), 'w': set()}
+        # Changed nodes and ways no stop depends on: coordinates (lat, lon) and node refs by ID
+        self.detached_nodes = {}
+        self.detached_ways = {}
+        # IDs of objects deleted by change files, these must not be read from the original file again
+        self.deleted_ids = {'n': set(), 'w': set(), 'r': set()}
+        # Stops of relations after the relation pass (before their ways are added), the base of recomputed relation stops
+        self.relation_stops = {}
+        # All stops including those outside the region, stop_data holds the ones inside in the order of a full run
+        self.stops = {}
+        self.outside_keys = set()
+
+    def extract(self):
+        """Run the initial extraction on the OSM file and keep the state for later updates."""
+        self.__read_objects(osmium.osm.RELATION, osmium.filter.KeyFilter('route', 'public_transport'))
+        self.__read_objects(osmium.osm.WAY, osmium.filter.TagFilter(*self.classifier.stop_tags))
+        self.__read_objects(osmium.osm.NODE, osmium.filter.TagFilter(*self.classifier.stop_tags))
+        self.__update({obj_type: set(objects) for obj_type, objects in self.known_objects.items()}, initial=True)
+
+    def apply_changes(self, osc_file):
+        """
+        Update the state with an OSM change file and recompute the affected stops.
+        :param osc_file: Path to the .osc file, change files have to be applied in order
+        """
+        changed = {'n': set(), 'w': set(), 'r': set()}
+        for obj in osmium.FileProcessor(osc_file):
+            obj_type = obj.type_str()
+            changed[obj_type].add(obj.id)
+            known = self.known_objects[obj_type]
+            if obj.deleted:
+                known.pop(obj.id, None)
+                self.deleted_ids[obj_type].add(obj.id)
+                self.__detach(obj_type, obj.id, None)
+                continue
+            self.deleted_ids[obj_type].discard(obj.id)
+            stored = _store_object(obj)
+            if obj_type == 'r':
+                if _is_put_relation(stored.tags):
+                    known[obj.id] = stored
+                else:
+                    known.pop(obj.id, None)
+            elif obj.id in known or self.classifier.classify(stored.tags, 'node' if obj_type == 'n' else 'way') is not None:
+                known[obj.id] = stored
+                self.modified_ids[obj_type].add(obj.id)
+                self.__detach(obj_type, obj.id, None)
+            else:
+                self.__detach(obj_type, obj.id, stored)
+        logging.info(f'Applying {sum(map(len, changed.values()))} changed objects from {osc_file}.')
+        self.__update(changed)
+
+    def __detach(self, obj_type, obj_id, stored):
+        """Keep the node list or coordinates of a changed way or node no stop depends on, or forget them (stored None)."""
+        if obj_type == 'n':
+            if stored is None:
+                self.detached_nodes.pop(obj_id, None)
+            else:
+                self.detached_nodes[obj_id] = (stored.location.lat, stored.location.lon)
+        elif obj_type == 'w':
+            if stored is None:
+                self.detached_ways.pop(obj_id, None)
+            else:
+                self.detached_ways[obj_id] = [node.ref for node in stored.nodes]
+
+    def __update(self, changed, initial=False):
+        """
+        Recompute the stops affected by the changed objects and bring stop_data and the state up to date.
+        :param changed: Dict of object type -> IDs of the changed (created, modified or deleted) objects
+        :param initial: Whether this is the initial extraction, then all stops are computed
+        """
+        relation_code, way_code = OSM_TYPE_CODES['r'], OSM_TYPE_CODES['w']
+        affected = set()
+        if initial or any(relation_id in self.known_objects['r'] or relation_id in self.relation_members for relation_id in changed['r']):
+            previous = (self.relation_stops, self.putline_elems, self.stoparea_elems)
+            self.__run_relation_stage()
+            for old, new in zip(previous, (self.relation_stops, self.putline_elems, self.stoparea_elems)):
+                affected.update(key for key in old.keys() | new.keys() if old.get(key) != new.get(key))
+        for way_id in changed['w']:
+            affected.add(osm_key('w', way_id))
+            affected.update(osm_key('r', relation_id) for relation_id in self.relation_way_refs.get(way_id, ()))
+        affected.update(osm_key('n', node_id) for node_id in changed['n'])
+        affected.update(self.__stops_referencing(changed['n']))
+
+        recomputed = self.__recompute(affected)
+        for key in affected | recomputed.keys():
+            self.stops.pop(key, None)
+            self.outside_keys.discard(key)
+        self.stops.update(recomputed)
+        if self.region is not None:
+            keys = [key for key in recomputed if key % 4 == relation_code or key % 4 == way_code]
+            lat = np.fromiter((recomputed[key].get('lat', np.nan) for key in keys), dtype=np.float64, count=len(keys))
+            lon = np.fromiter((recomputed[key].get('lon', np.nan) for key in keys), dtype=np.float64, count=len(keys))
+            self.outside_keys.update(itertools.compress(keys, ~self.region.contains_many(lon, lat)))
+        self.__build_stop_data()
+        self.__prune()
+        logging.info(f'Recomputed {len(recomputed)} stops.')
+
+    def __run_relation_stage(self):
+        """Run the relation handlers on all known relations in ID order and keep the relation storage."""
+        stage = PublicTransportStopExtractor(self.osm_file, pass_plan=self.pass_plan, classifier=self.classifier)
+        relation_handler_routes = stage.RelationHandlerRoutes(stage)
+        relation_handler_stops_stopareas = stage.RelationHandlerStops_StopAreas(stage)
+        for relation_id in sorted(self.known_objects['r']):
+            relation = self.known_objects['r'][relation_id]
+            relation_handler_routes.relation(relation)
+            relation_handler_stops_stopareas.relation(relation)
+        stage.resolve_nested_relations()
+        self.putline_elems = stage.putline_elems
+        self.stoparea_elems = stage.stoparea_elems
+        self.relation_members = stage.relation_members
+        self.relation_way_refs = stage.relation_way_refs
+        self.relation_stops = stage.stop_data
+
+    def __recompute(self, affected):
+        """Run the way and node handlers and the postprocessing on the objects of the affected stops, return the stops."""
+        relation_code, way_code, node_code = OSM_TYPE_CODES['r'], OSM_TYPE_CODES['w'], OSM_TYPE_CODES['n']
+        subset = PublicTransportStopExtractor(self.osm_file, pass_plan=self.pass_plan, region=self.region, classifier=self.classifier)
+        subset.relation_way_refs = self.relation_way_refs
+        subset.putline_elems = self.putline_elems
+        subset.stoparea_elems = self.stoparea_elems
+        subset.stop_data = _StopSubset()
+        way_ids = {key // 4 for key in affected if key % 4 == way_code and key // 4 in self.known_objects['w']}
+        for key in sorted(key for key in affected if key % 4 == relation_code and key in self.relation_stops):
+            stop_info = self.relation_stops[key]
+            subset.stop_data[key] = dict(stop_info, osm_node_refs=list(stop_info['osm_node_refs']), osm_way_refs=list(stop_info['osm_way_refs']))
+            way_ids.update(way_id for way_id in stop_info['osm_way_refs'] if way_id in self.relation_way_refs)
+        self.__load_missing(osmium.osm.WAY, 'w', way_ids)
+
+        way_handler = subset.WayHandler(subset)
+        for way_id in sorted(way_ids):
+            if way_id in self.known_objects['w']:
+                way_handler.way(self.known_objects['w'][way_id])
+        node_handler = subset.NodeHandler(subset)
+        for node_id in sorted(key // 4 for key in affected if key % 4 == node_code and key // 4 in self.known_objects['n']):
+            node_handler.node(self.known_objects['n'][node_id], referenced=False)
+
+        node_ids = {ref for stop_info in subset.stop_data.values() for ref in stop_info.get('osm_node_refs', ())}
+        self.__load_missing(osmium.osm.NODE, 'n', node_ids)
+        nodes = [self.known_objects['n'][node_id] for node_id in node_ids if node_id in self.known_objects['n']]
+        subset.nodes_coords.add_arrays(np.fromiter((node.id for node in nodes), dtype=np.int64, count=len(nodes)),
+                                       np.fromiter((node.location.lat for node in nodes), dtype=np.float64, count=len(nodes)),
+                                       np.fromiter((node.location.lon for node in nodes), dtype=np.float64, count=len(nodes)))
+        subset.compute_centroids()
+        subset.add_info_stoparea_putline()
+        return dict(subset.stop_data)
+
+    def __node_refs(self):
+        """Keys of all stops, their number of node refs and all node refs, as arrays."""
+        keys = np.fromiter(self.stops.keys(), dtype=np.int64, count=len(self.stops))
+        node_refs = [stop_info.get('osm_node_refs') or () for stop_info in self.stops.values()]
+        counts = np.fromiter(map(len, node_refs), dtype=np.int64, count=len(node_refs))
+        return keys, counts, np.fromiter(itertools.chain.from_iterable(node_refs), dtype=np.int64, count=counts.sum())
+
+    def __stops_referencing(self, node_ids):
+        """Keys of the stops referencing any of the nodes."""
+        if not node_ids or not self.stops:
+            return set()
+        keys, counts, refs = self.__node_refs()
+        hits = np.isin(refs, np.fromiter(node_ids, dtype=np.int64, count=len(node_ids)))
+        return set(np.unique(np.repeat(keys, counts)[hits]).tolist())
+
+    def __build_stop_data(self):
+        """stop_data: the stops inside the region in the order of a full run."""
+        keys = sorted(self.stops, key=lambda key: (_PASS_ORDER[key % 4], key // 4))
+        self.stop_data = {key: self.stops[key] for key in keys if key not in self.outside_keys}
+        self.region_filtered = True
+
+    def __prune(self):
+        """Drop known ways and nodes no stop depends on anymore, changed ones are detached."""
+        keys, _, refs = self.__node_refs()
+        needed = {
+            'w': np.union1d(keys[keys % 4 == OSM_TYPE_CODES['w']] // 4, np.fromiter(self.relation_way_refs, dtype=np.int64, count=len(self.relation_way_refs))),
+            'n': np.union1d(keys[keys % 4 == OSM_TYPE_CODES['n']] // 4, refs),
+        }
+        for obj_type, needed_ids in needed.items():
+            known = self.known_objects[obj_type]
+            known_ids = np.fromiter(known, dtype=np.int64, count=len(known))
+            for obj_id in known_ids[~np.isin(known_ids, needed_ids)].tolist():
+                stored = known.pop(obj_id)
+                if obj_id in self.modified_ids[obj_type]:
+                    self.modified_ids[obj_type].discard(obj_id)
+                    self.__detach(obj_type, obj_id, stored)
+
+    def __load_missing(self, entities, obj_type, needed_ids):
+        """
+        Make needed objects known: detached ones from the state, the others from the original file (they haven't
+        changed since), unless they are deleted.
+        """
+        missing_ids = [obj_id for obj_id in needed_ids if obj_id not in self.known_objects[obj_type] and obj_id not in self.deleted_ids[obj_type]]
+        detached = self.detached_nodes if obj_type == 'n' else self.detached_ways
+        from_file = []
+        for obj_id in missing_ids:
+            if obj_id in detached:
+                value = detached.pop(obj_id)
+                self.known_objects[obj_type][obj_id] = _Node(obj_id, _NO_TAGS, _Location(*value)) if obj_type == 'n' else _Way(obj_id, _NO_TAGS, [_NodeRef(ref) for ref in value])
+                self.modified_ids[obj_type].add(obj_id)
+            else:
+                from_file.append(obj_id)
+        if from_file:
+            self.__read_objects(entities, osmium.filter.IdFilter(np.array(from_file, dtype=np.int64)))
+
+    def __read_objects(self, entities, osm_filter):
+        """Store all objects of the given type passing the filter from the original file."""
+        for obj in osmium.FileProcessor(self.osm_file, entities).with_filter(osm_filter):
+            self.known_objects[obj.type_str()][obj.id] = _store_object(obj)
+
+    def __fingerprints(self):
+        return {
+            'region': self.region.fingerprint() if self.region is not None else None,
+            'classifier': self.classifier.fingerprint(),
+        }
+
+    def save_state(self, path):
+        """
+        Save the extraction state and the results to a file: an uncompressed .npz of NumPy columns (see _encode_records)
+        with the state version, the original file and fingerprints of the region and the classifier.
+        """
+        arrays = {}
+        meta = {'version': self.STATE_VERSION, 'osm_file': str(self.osm_file), **self.__fingerprints()}
+        arrays['meta'] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+        for obj_type, name in (('n', 'nodes'), ('w', 'ways'), ('r', 'relations')):
+            _encode_objects(name, self.known_objects[obj_type], arrays)
+            arrays[f'deleted/{obj_type}'] = np.array(sorted(self.deleted_ids[obj_type]), dtype=np.int64)
+        for obj_type, ids in self.modified_ids.items():
+            arrays[f'modified/{obj_type}'] = np.array(sorted(ids), dtype=np.int64)
+        arrays['detached_nodes/ids'] = np.fromiter(self.detached_nodes, dtype=np.int64, count=len(self.detached_nodes))
+        arrays['detached_nodes/coords'] = np.array(list(self.detached_nodes.values()), dtype=np.float64).reshape(-1, 2)
+        arrays['detached_ways/ids'] = np.fromiter(self.detached_ways, dtype=np.int64, count=len(self.detached_ways))
+        _encode_lists('detached_ways/node_refs', list(self.detached_ways.values()), arrays)
+        _encode_records('stops', self.stops, arrays)
+        arrays['outside_keys'] = np.array(sorted(self.outside_keys), dtype=np.int64)
+        _encode_records('relation_stops', self.relation_stops, arrays)
+        _encode_records('putline_elems', self.putline_elems, arrays)
+        _encode_records('stoparea_elems', {key: {'name': name} for key, name in self.stoparea_elems.items()}, arrays)
+        _encode_records('relation_way_refs', {key: {'relation_ids': ids} for key, ids in self.relation_way_refs.items()}, arrays)
+        arrays['relation_members/ids'] = np.fromiter(self.relation_members, dtype=np.int64, count=len(self.relation_members))
+        _encode_lists('relation_members/members', [members.tolist() for members in self.relation_members.values()], arrays)
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as f:
+            np.savez(f, **arrays)
+        os.replace(f.name, path)
+
+    @classmethod
+    def load_state(cls, path, region=None, classifier=None):
+        """
+        Load an extractor saved with save_state().
+        :param region: The region the state was extracted with
+        :param classifier: The classifier the state was extracted with, by default one with the rules of classification.py
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        meta = json.loads(arrays['meta'].tobytes())
+        if meta['version'] != cls.STATE_VERSION:
+            raise ValueError(f'State version {meta["version"]} of {path} is not supported (expected {cls.STATE_VERSION}), run extract() again.')
+        extractor = cls(meta['osm_file'], region=region, classifier=classifier)
+        for name, fingerprint in extractor.__fingerprints().items():
+            if meta[name] != fingerprint:
+                raise ValueError(f'The {name} differs from the one the state in {path} was extracted with.')
+        for obj_type, name in (('n', 'nodes'), ('w', 'ways'), ('r', 'relations')):
+            extractor.known_objects[obj_type] = _decode_objects(name, arrays)
+            extractor.deleted_ids[obj_type] = set(arrays[f'deleted/{obj_type}'].tolist())
+        for obj_type in extractor.modified_ids:
+            extractor.modified_ids[obj_type] = set(arrays[f'modified/{obj_type}'].tolist())
+        extractor.detached_nodes = dict(zip(arrays['detached_nodes/ids'].tolist(), map(tuple, arrays['detached_nodes/coords'].tolist())))
+        extractor.detached_ways = dict(zip(arrays['detached_ways/ids'].tolist(), _decode_lists('detached_ways/node_refs', arrays)))
+        extractor.stops = _decode_records('stops', arrays)
+        extractor.outside_keys = set(arrays['outside_keys'].tolist())
+        extractor.relation_stops = _decode_records('relation_stops', arrays)
+        extractor.putline_elems = _decode_records('putline_elems', arrays)
+        extractor.stoparea_elems = {key: record['name'] for key, record in _decode_records('stoparea_elems', arrays).items()}
+        extractor.relation_way_refs = {key: record['relation_ids'] for key, record in _decode_records('relation_way_refs', arrays).items()}
+        extractor.relation_members = {relation_id: np.array(members, dtype=np.int64) for relation_id, members
+                                      in zip(arrays['relation_members/ids'].tolist(), _decode_lists('relation_members/members', arrays))}
+        extractor._IncrementalStopExtractor__build_stop_data()
+        return extractor
@@ -1,41 +1,930 @@
 import osmium
+import numpy as np
 import pandas as pd
+import argparse
+import array
+import contextlib
+import hashlib
+import inspect
+import itertools
 import logging
+import multiprocessing
+import os
 import pathlib
+import sqlite3
+import struct
+import tempfile
+
+from classification import TagClassifier
+from metrics import Metrics, bytes_read
+from region import Region, RegionSet
+
+
+# Node, way and relation IDs are separate number ranges in OSM, keys of mixed storage need the type as well
+OSM_TYPE_CODES = {'n': 0, 'w': 1, 'r': 2, 'node': 0, 'way': 1, 'relation': 2}
+
+
+def osm_key(osm_type, osm_id):
+    """
+    Pack OSM type and ID into a single int that is unique across nodes, ways and relations.
+    :param osm_type: 'n', 'w', 'r' (as in member.type) or 'node', 'way', 'relation'
+    :param osm_id: OSM ID
+    """
+    return osm_id * 4 + OSM_TYPE_CODES[osm_type]
+
+
+class IdSet:
+    """
+    Set of OSM IDs stored as a sorted int64 array (8 bytes per ID instead of ~70 bytes in a Python set).
+    Added IDs are buffered and merged into the sorted array by to_array(), so the set should be filled in one pass and
+    queried in the following ones. Single lookups (`in`) are hash lookups in a Python set that is built on the first
+    lookup and kept up to date until compact() drops it at the end of the pass, a binary search with NumPy per lookup
+    costs more than the handlers themselves.
+
+    Only the 'merged' and 'legacy' plans build that set: their node handler looks up every node of the file in
+    relation_way_node_refs, so the node pass holds a set of all way and relation node IDs (~70 bytes per ID) next to the
+    array. This is deliberate, a bisect on the array keeps 8 bytes per ID but takes ~0.9 µs instead of ~0.1 µs per node,
+    which slows these plans down by about 15 %. The 'native' plan passes the array to osmium's IdFilter and never builds it.
+    """
+    def __init__(self):
+        self._ids = np.empty(0, dtype=np.int64)
+        self._pending = array.array('q')
+        self._lookup = None
+
+    def add(self, osm_id):
+        self._pending.append(osm_id)
+        if self._lookup is not None:
+            self._lookup.add(osm_id)
+
+    def update(self, other):
+        """Add all IDs of another IdSet."""
+        self.add_array(other.to_array())
+
+    def add_array(self, ids):
+        """Add all IDs of an int64 array."""
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self._pending.frombytes(ids.tobytes())
+        if self._lookup is not None:
+            self._lookup.update(ids.tolist())
+
+    def to_array(self):
+        """Return the sorted IDs as int64 array."""
+        if self._pending:
+            self._ids = np.union1d(self._ids, np.frombuffer(self._pending, dtype=np.int64))
+            self._pending = array.array('q')
+        return self._ids
+
+    def compact(self):
+        """Merge the added IDs into the sorted array and drop the lookup set."""
+        self.to_array()
+        self._lookup = None
+
+    def __contains__(self, osm_id):
+        if self._lookup is None:
+            self._lookup = set(self.to_array().tolist())
+        return osm_id in self._lookup
+
+    def __iter__(self):
+        return iter(self.to_array().tolist())
+
+    def __len__(self):
+        return len(self.to_array())
+
+
+class CoordinateStore:
+    """
+    Node coordinates stored in parallel arrays (sorted int64 IDs, float64 lat and lon) instead of a dict of tuples.
+    Filled and queried like IdSet, if a node is stored more than once the last coordinates are kept.
+    Lookups return (lat, lon) tuples like the dict did, they use a dict of ID -> position that is built on the first
+    lookup after a change and dropped by compact(). The passes only store coordinates and compute_centroids() reads the
+    arrays, so the dict is only built for callers looking up single nodes.
+    """
+    def __init__(self):
+        self._ids = np.empty(0, dtype=np.int64)
+        self._lat = np.empty(0, dtype=np.float64)
+        self._lon = np.empty(0, dtype=np.float64)
+        self._pending_ids = array.array('q')
+        self._pending_lat = array.array('d')
+        self._pending_lon = array.array('d')
+        self._positions = None
+
+    def __setitem__(self, node_id, coords):
+        self._pending_ids.append(node_id)
+        self._pending_lat.append(coords[0])
+        self._pending_lon.append(coords[1])
+        self._positions = None
+
+    def update(self, other):
+        """Add all coordinates of another CoordinateStore, they win over coordinates already stored."""
+        self.add_arrays(*other.to_arrays())
+
+    def add_arrays(self, ids, lat, lon):
+        """Add coordinates given as arrays of node IDs, latitudes and longitudes."""
+        self._pending_ids.frombytes(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+        self._pending_lat.frombytes(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+        self._pending_lon.frombytes(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+        self._positions = None
+
+    def to_arrays(self):
+        """Return the sorted node IDs and their latitudes and longitudes as arrays."""
+        if self._pending_ids:
+            ids = np.concatenate([self._ids, np.frombuffer(self._pending_ids, dtype=np.int64)])
+            lat = np.concatenate([self._lat, np.frombuffer(self._pending_lat, dtype=np.float64)])
+            lon = np.concatenate([self._lon, np.frombuffer(self._pending_lon, dtype=np.float64)])
+            order = np.argsort(ids, kind='stable')
+            ids = ids[order]
+            # Keep the last stored entry of each ID
+            last = np.append(ids[1:] != ids[:-1], True)
+            self._ids, self._lat, self._lon = ids[last], lat[order][last], lon[order][last]
+            self._pending_ids, self._pending_lat, self._pending_lon = array.array('q'), array.array('d'), array.array('d')
+        return self._ids, self._lat, self._lon
+
+    def compact(self):
+        """Merge the added coordinates into the sorted arrays and drop the lookup dict."""
+        self.to_arrays()
+        self._positions = None
+
+    def __find(self, node_id):
+        if self._positions is None:
+            ids = self.to_arrays()[0]
+            self._positions = dict(zip(ids.tolist(), range(len(ids))))
+        return self._positions.get(node_id)
+
+    def __contains__(self, node_id):
+        return self.__find(node_id) is not None
+
+    def __getitem__(self, node_id):
+        i = self.__find(node_id)
+        if i is None:
+            raise KeyError(node_id)
+        return float(self._lat[i]), float(self._lon[i])
+
+    def __len__(self):
+        return len(self.to_arrays()[0])
+
+
+def compute_centroids_csr(offsets, node_refs, node_ids, node_lat, node_lon):
+    """
+    Compute the centroids of many ways/relations at once. Element i consists of node_refs[offsets[i]:offsets[i + 1]].
+    - Closed rings (first node == last node, at least 4 nodes, non-zero area): area centroid (shoelace formula)
+    - Open lines with non-zero length: midpoints of the segments weighted by segment length
+    - Degenerate elements (single node, zero area and length): mean of the vertices
+    Lengths are measured with longitudes scaled by cos(lat), the area centroid doesn't depend on that scaling.
+    :param offsets: int64 array of len(elements) + 1 offsets into node_refs
+    :param node_refs: int64 array of node IDs of all elements
+    :param node_ids: Sorted int64 array of the node IDs with coordinates
+    :param node_lat: Latitudes of node_ids
+    :param node_lon: Longitudes of node_ids
+    :return: Arrays of centroid latitudes and longitudes, NaN for elements without any node coordinates
+    """
+    element_count = len(offsets) - 1
+    # Look up the coordinates and drop node refs without coordinates
+    positions = np.minimum(node_ids.searchsorted(node_refs), max(len(node_ids) - 1, 0))
+    found = node_ids[positions] == node_refs if len(node_ids) else np.zeros(len(node_refs), dtype=bool)
+    element = np.repeat(np.arange(element_count), np.diff(offsets))[found]
+    refs = node_refs[found]
+    y = node_lat[positions[found]]
+    x = node_lon[positions[found]]
+
+    counts = np.bincount(element, minlength=element_count)
+    starts = np.zeros(element_count, dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    ends = starts + counts
+    has_nodes = counts > 0
+
+    # Coordinates relative to the first node of each element, keeps the precision for small areas
+    origin_x = np.where(has_nodes, x[np.minimum(starts, len(x) - 1)] if len(x) else 0.0, np.nan)
+    origin_y = np.where(has_nodes, y[np.minimum(starts, len(y) - 1)] if len(y) else 0.0, np.nan)
+    x = x - origin_x[element]
+    y = y - origin_y[element]
+
+    # Next vertex of each vertex, the last vertex of an element wraps around to its first one
+    index = np.arange(len(refs))
+    is_last = index == ends[element] - 1
+    next_index = np.where(is_last, starts[element], index + 1)
+    x_next = x[next_index]
+    y_next = y[next_index]
+
+    # Area centroid (shoelace formula)
+    cross = x * y_next - x_next * y
+    area2 = np.bincount(element, cross, minlength=element_count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area_x = np.bincount(element, (x + x_next) * cross, minlength=element_count) / (3.0 * area2)
+        area_y = np.bincount(element, (y + y_next) * cross, minlength=element_count) / (3.0 * area2)
+    first_ref = refs[np.minimum(starts, len(refs) - 1)] if len(refs) else np.zeros(element_count, dtype=np.int64)
+    last_ref = refs[np.maximum(ends - 1, 0)] if len(refs) else np.zeros(element_count, dtype=np.int64)
+    is_ring = has_nodes & (counts >= 4) & (first_ref == last_ref) & (np.abs(area2) > 1e-14)
+    # Self-overlapping rings (e.g. several rings of a relation chained together) can have a tiny net area and an
+    # area centroid far away, so area centroids are only used if they are within the bounding box of the element
+    nonempty = np.flatnonzero(has_nodes)
+    min_x, max_x, min_y, max_y = (np.full(element_count, np.nan) for _ in range(4))
+    if len(nonempty):
+        min_x[nonempty] = np.minimum.reduceat(x, starts[nonempty])
+        max_x[nonempty] = np.maximum.reduceat(x, starts[nonempty])
+        min_y[nonempty] = np.minimum.reduceat(y, starts[nonempty])
+        max_y[nonempty] = np.maximum.reduceat(y, starts[nonempty])
+    with np.errstate(invalid='ignore'):
+        is_ring &= (area_x >= min_x) & (area_x <= max_x) & (area_y >= min_y) & (area_y <= max_y)
+
+    # Length-weighted segment midpoints, without the wrap-around segment
+    cos_lat = np.cos(np.radians(origin_y))[element]
+    segment_length = np.where(is_last, 0.0, np.sqrt(((x_next - x) * cos_lat) ** 2 + (y_next - y) ** 2))
+    length = np.bincount(element, segment_length, minlength=element_count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        line_x = np.bincount(element, segment_length * (x + x_next) / 2, minlength=element_count) / length
+        line_y = np.bincount(element, segment_length * (y + y_next) / 2, minlength=element_count) / length
+        mean_x = np.bincount(element, x, minlength=element_count) / counts
+        mean_y = np.bincount(element, y, minlength=element_count) / counts
+    is_line = ~is_ring & (length > 0)
+
+    centroid_x = np.where(is_ring, area_x, np.where(is_line, line_x, mean_x)) + origin_x
+    centroid_y = np.where(is_ring, area_y, np.where(is_line, line_y, mean_y)) + origin_y
+    return centroid_y, centroid_x
+
+
+def _grid_neighbor_pairs(x, y, cell_size):
+    """
+    Return all pairs (i, j) with i < j of points in the same or in adjacent cells of a grid with the given cell size,
+    a superset of the pairs closer than cell_size. Points are sorted by cell, so the cost is linear in the number of
+    points plus the number of pairs returned.
+    """
+    cell_x = np.floor(x / cell_size).astype(np.int64)
+    cell_y = np.floor(y / cell_size).astype(np.int64)
+    cell_x -= cell_x.min(initial=0)
+    cell_y -= cell_y.min(initial=0) - 1
+    width = int(cell_y.max(initial=0)) + 2
+    cell_keys = cell_x * width + cell_y
+    order = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    keys = sorted_keys[starts]
+
+    pairs_i, pairs_j = [], []
+    # The cell itself and the adjacent cells with a larger key, so each pair of cells is visited once
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        neighbor = keys.searchsorted(keys + dx * width + dy)
+        cells = np.flatnonzero(neighbor < len(keys))
+        cells = cells[keys[neighbor[cells]] == keys[cells] + dx * width + dy]
+        neighbor = neighbor[cells]
+        size_a = ends[cells] - starts[cells]
+        size_b = ends[neighbor] - starts[neighbor]
+        counts = size_a * size_b
+        pair_cell = np.repeat(np.arange(len(cells)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        i = starts[cells][pair_cell] + local // size_b[pair_cell]
+        j = starts[neighbor][pair_cell] + local % size_b[pair_cell]
+        if dx == dy == 0:
+            keep = i < j
+            i, j = i[keep], j[keep]
+        pairs_i.append(order[i])
+        pairs_j.append(order[j])
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def _connected_components(count, i, j):
+    """Return component labels (the smallest member index) of a graph with count nodes and edges (i, j)."""
+    labels = np.arange(count)
+    while len(i):
+        # Hook the larger root of each edge onto the smaller one, then compress the paths
+        low = np.minimum(labels[i], labels[j])
+        high = np.maximum(labels[i], labels[j])
+        np.minimum.at(labels, high, low)
+        while True:
+            compressed = labels[labels]
+            if np.array_equal(compressed, labels):
+                break
+            labels = compressed
+        if np.array_equal(labels[i], labels[j]):
+            break
+    return labels
+
+
+def cluster_stops(lat, lon, names, types, max_distance):
+    """
+    Group stops closer than max_distance with compatible names and types into clusters, in near-linear time: candidate
+    pairs come from a grid with cells of max_distance (_grid_neighbor_pairs), the clusters are the connected components
+    of the accepted pairs.
+    - Named stops are linked to stops with the same name.
+    - Unnamed stops are linked to their nearest named stop. Unnamed stops without any named stop in reach are linked to
+      each other. So an unnamed stop never joins two clusters of different names.
+    - Types are compatible if they are equal or one of them is 'unknown'.
+    :param lat: Latitudes of the stops
+    :param lon: Longitudes of the stops
+    :param names: Normalized names of the stops, None for unnamed stops
+    :param types: General types of the stops
+    :param max_distance: Distance in meters
+    :return: int64 array of cluster numbers 0..n-1, numbered in order of the first stop of each cluster
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if not len(lat):
+        return np.zeros(0, dtype=np.int64)
+    meters_per_degree = 111320.0
+    # Equirectangular projection at the latitude farthest from the equator, it never overestimates distances in x, so
+    # the grid cells can't miss a pair closer than max_distance
+    reference_lat = np.radians(min(np.abs(lat).max(), 89.0))
+    x = lon * np.cos(reference_lat) * meters_per_degree
+    y = lat * meters_per_degree
+    i, j = _grid_neighbor_pairs(x, y, max_distance)
+
+    # Exact distance with the mean latitude of each pair
+    dx = (lon[i] - lon[j]) * np.cos(np.radians((lat[i] + lat[j]) / 2)) * meters_per_degree
+    dy = (lat[i] - lat[j]) * meters_per_degree
+    distance = np.hypot(dx, dy)
+    name_codes = pd.factorize(pd.Series(names, dtype=object))[0]  # -1 for unnamed stops
+    type_codes = pd.factorize(pd.Series(types, dtype=object))[0]
+    unknown = np.asarray(types, dtype=object) == 'unknown'
+    keep = (distance <= max_distance) & ((type_codes[i] == type_codes[j]) | unknown[i] | unknown[j])
+    i, j, distance = i[keep], j[keep], distance[keep]
+
+    named = name_codes >= 0
+    edges_i = [i[named[i] & named[j] & (name_codes[i] == name_codes[j])]]
+    edges_j = [j[named[i] & named[j] & (name_codes[i] == name_codes[j])]]
+    # Unnamed stops with a named stop in reach: only the nearest one
+    mixed = named[i] != named[j]
+    unnamed_stop = np.where(named[i], j, i)[mixed]
+    named_stop = np.where(named[i], i, j)[mixed]
+    order = np.lexsort((distance[mixed], unnamed_stop))
+    unnamed_stop, named_stop = unnamed_stop[order], named_stop[order]
+    nearest = np.ones(len(unnamed_stop), dtype=bool)
+    nearest[1:] = unnamed_stop[1:] != unnamed_stop[:-1]
+    edges_i.append(unnamed_stop[nearest])
+    edges_j.append(named_stop[nearest])
+    # Unnamed stops without a named stop in reach
+    orphan = ~named
+    orphan[unnamed_stop] = False
+    edges_i.append(i[orphan[i] & orphan[j]])
+    edges_j.append(j[orphan[i] & orphan[j]])
+
+    labels = _connected_components(len(lat), np.concatenate(edges_i), np.concatenate(edges_j))
+    # Labels are the smallest member index, so their order is the order of the first stops
+    return np.unique(labels, return_inverse=True)[1].astype(np.int64)
+
+
+def add_synthetic_stop_areas(results, max_distance=100.0):
+    """
+    Add synthetic stop areas for platforms and stop_positions that are not in an OSM stop_area relation (see
+    cluster_stops). Adds the columns 'synthetic_stoparea_id' (numbered from 1, missing for stops that weren't clustered)
+    and 'synthetic_stoparea_name' (most common name in the cluster, the first one on ties) to results.frame.
+    :param results: ResultColumns
+    :param max_distance: Maximal distance in meters between neighboring stops of a stop area
+    """
+    frame = results.frame
+    candidates = np.flatnonzero((frame['osm_public_transport'].isin(['platform', 'stop_position']) & ~frame['is_in_osm_stoparea'].fillna(False)
+                                 & frame['lat'].notna()).to_numpy())
+    osm_names = frame['osm_name'].iloc[candidates].astype(object)
+    osm_names = osm_names.where(osm_names != 'N/A')
+    names = osm_names.str.strip().str.casefold().replace('', None)
+    types = frame['general_type'].iloc[candidates].astype(object).fillna('unknown')
+    labels = cluster_stops(frame['lat'].to_numpy()[candidates], frame['lon'].to_numpy()[candidates], names.to_numpy(), types.to_numpy(), max_distance)
+
+    stop_area_ids = pd.Series(pd.NA, index=frame.index, dtype='Int64')
+    stop_area_ids.iloc[candidates] = labels + 1
+    frame['synthetic_stoparea_id'] = stop_area_ids
+
+    cluster_names = pd.DataFrame({'label': labels, 'name': osm_names.to_numpy()}).dropna()
+    name_counts = cluster_names.groupby(['label', 'name'], sort=False).size().reset_index(name='count')
+    name_counts = name_counts.sort_values('count', ascending=False, kind='stable').drop_duplicates('label')
+    label_names = dict(zip(name_counts['label'].tolist(), name_counts['name'].tolist()))
+    stop_area_names = pd.Series(None, index=frame.index, dtype=object)
+    stop_area_names.iloc[candidates] = [label_names.get(label) for label in labels.tolist()]
+    frame['synthetic_stoparea_name'] = stop_area_names
+
+
+def add_names_and_route_types(frame, route_general_types):
+    """
+    Add the column name and refine the types of the results as written by the script:
+    1) name: stop_area name, the OSM name if the stop is in no stop_area
+    2) general_type: unknown general types are mapped from the type of the routes serving the stop
+    3) specific_type: the type of the routes serving the stop, else the general type
+    :param frame: DataFrame of the results (ResultColumns.frame), changed in place
+    :param route_general_types: Dict of route type -> general type (TagClassifier.route_general_types)
+    """
+    frame["name"] = frame["osm_stoparea_name"].fillna(frame["osm_name"])
+    general_type = frame['general_type'].astype(object)
+    mapped_type = frame['osm_route_type'].astype(object).map(route_general_types).fillna('unknown')
+    frame['general_type'] = general_type.where(general_type != 'unknown', mapped_type).astype('category')
+    frame['specific_type'] = frame["osm_route_type"].astype(object).fillna(frame["general_type"].astype(object)).astype('category')
+
+
+def _encode_strings(strings):
+    """Dictionary-encode a list of str/None into int32 codes (-1 for None) and the categories as UTF-8 bytes + offsets."""
+    categories = {}
+    codes = np.fromiter((-1 if value is None else categories.setdefault(value, len(categories)) for value in strings), dtype=np.int32, count=len(strings))
+    encoded = [category.encode() for category in categories]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return codes, np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(codes, data, offsets):
+    """Inverse of _encode_strings."""
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    categories = [data[offsets[i]:offsets[i + 1]].decode() for i in range(len(offsets) - 1)]
+    return [None if code < 0 else categories[code] for code in codes.tolist()]
+
+
+def _encode_records(name, records, arrays):
+    """
+    Add a dict of records (key: int, value: dict of fields) to arrays as columns '<name>/<field>/...'.
+    Each field gets a mask of the records with a value and a mask of the records with None, so None survives in fields
+    of any type. Strings are dictionary-encoded, lists of ints are stored as offsets and values, bools, ints and floats
+    as arrays of their type. The values of a field must all have the same of these types.
+    """
+    arrays[f'{name}/keys'] = np.fromiter(records.keys(), dtype=np.int64, count=len(records))
+    fields = {}
+    for i, record in enumerate(records.values()):
+        for field, value in record.items():
+            fields.setdefault(field, ([], [], []))
+            if value is None:
+                fields[field][2].append(i)
+            else:
+                fields[field][0].append(i)
+                fields[field][1].append(value)
+    for field, (indices, values, none_indices) in fields.items():
+        prefix = f'{name}/{field}'
+        present = np.zeros(len(records), dtype=bool)
+        present[indices] = True
+        arrays[f'{prefix}/present'] = present
+        is_none = np.zeros(len(records), dtype=bool)
+        is_none[none_indices] = True
+        arrays[f'{prefix}/none'] = is_none
+        if not values:
+            continue
+        # bool is a subclass of int, so the exact type decides
+        value_types = {type(value) for value in values}
+        if value_types == {list}:
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in values], out=offsets[1:])
+            arrays[f'{prefix}/offsets'] = offsets
+            arrays[f'{prefix}/list'] = np.fromiter(itertools.chain.from_iterable(values), dtype=np.int64, count=offsets[-1])
+        elif value_types == {bool}:
+            arrays[f'{prefix}/bool'] = np.array(values, dtype=bool)
+        elif value_types == {int}:
+            arrays[f'{prefix}/int'] = np.array(values, dtype=np.int64)
+        elif value_types == {float}:
+            arrays[f'{prefix}/float'] = np.array(values, dtype=np.float64)
+        elif value_types == {str}:
+            arrays[f'{prefix}/codes'], arrays[f'{prefix}/data'], arrays[f'{prefix}/str_offsets'] = _encode_strings(values)
+        else:
+            raise TypeError(f'Field {field} of {name} has values of unsupported or mixed types: {sorted(t.__name__ for t in value_types)}')
+
+
+def _decode_records(name, arrays):
+    """Inverse of _encode_records: return the dict of records stored under name."""
+    keys = arrays[f'{name}/keys'].tolist()
+    records = [{} for _ in keys]
+    fields = {array_name.split('/')[1] for array_name in arrays if array_name.startswith(f'{name}/') and array_name.count('/') == 2}
+    for field in fields:
+        prefix = f'{name}/{field}'
+        if f'{prefix}/list' in arrays:
+            values_flat = arrays[f'{prefix}/list'].tolist()
+            offsets = arrays[f'{prefix}/offsets'].tolist()
+            values = [values_flat[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        elif f'{prefix}/codes' in arrays:
+            values = _decode_strings(arrays[f'{prefix}/codes'], arrays[f'{prefix}/data'], arrays[f'{prefix}/str_offsets'])
+        else:
+            values = next((arrays[f'{prefix}/{kind}'] for kind in ('bool', 'int', 'float') if f'{prefix}/{kind}' in arrays), np.zeros(0)).tolist()
+        for i, value in zip(np.flatnonzero(arrays[f'{prefix}/present']).tolist(), values):
+            records[i][field] = value
+        for i in np.flatnonzero(arrays[f'{prefix}/none']).tolist():
+            records[i][field] = None
+    return dict(zip(keys, records))
+
+
+def _hash_source(code, code_hash):
+    """
+    Add the source code of a function or class to a hash. Classes are hashed method by method: inspect.getsource()
+    parses the whole module for a class, but only reads the lines of a function.
+    """
+    if inspect.isclass(code):
+        code_hash.update(code.__qualname__.encode())
+        for member in vars(code).values():
+            member = getattr(member, '__func__', member)  # static and class methods
+            if inspect.isfunction(member) or inspect.isclass(member):
+                _hash_source(member, code_hash)
+    else:
+        code_hash.update(inspect.getsource(code).encode())
+
+
+class StageCache:
+    """
+    On-disk cache of the results of the extraction passes. Each entry is an uncompressed .npz file of NumPy columns
+    named after its key, loading it takes milliseconds. When the cache grows beyond max_bytes, the least recently used
+    entries are deleted.
+    """
+    # Increase when the layout of the cached arrays changes
+    FORMAT_VERSION = 3
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, full_hash=False):
+        """
+        :param cache_dir: Directory of the cache entries
+        :param max_bytes: Size limit of the cache
+        :param full_hash: Fingerprint input files by hashing their whole content instead of samples and the modification
+                          time (see file_fingerprint), slower but independent of file times
+        """
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.full_hash = full_hash
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def file_fingerprint(osm_file, sample_bytes=1024 ** 2, full=False):
+        """
+        Fingerprint of a file: hash of its size, its modification time and its first and last sample_bytes.
+        Reading only the samples keeps this cheap for multi-GB files, the modification time catches files changed in
+        the middle without a change of size. Touching or copying a file therefore invalidates the cache as well.
+        :param full: Hash the whole content instead of the samples and leave out the modification time
+        """
+        stat = os.stat(osm_file)
+        fingerprint = hashlib.sha256(str(stat.st_size).encode())
+        with open(osm_file, 'rb') as f:
+            if full:
+                for chunk in iter(lambda: f.read(16 * 1024 ** 2), b''):
+                    fingerprint.update(chunk)
+                return fingerprint.hexdigest()
+            fingerprint.update(str(stat.st_mtime_ns).encode())
+            fingerprint.update(f.read(sample_bytes))
+            f.seek(max(stat.st_size - sample_bytes, 0))
+            fingerprint.update(f.read(sample_bytes))
+        return fingerprint.hexdigest()
+
+    def __path(self, key):
+        return self.cache_dir / f'{key}.npz'
+
+    def load(self, key):
+        """Return the cached dict of arrays for key or None."""
+        path = self.__path(key)
+        if not path.exists():
+            return None
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        os.utime(path)  # Mark as recently used for the eviction
+        return arrays
+
+    def save(self, key, arrays):
+        """Store a dict of arrays under key and evict old entries if the cache is too large."""
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False) as f:
+            np.savez(f, **arrays)
+        os.replace(f.name, self.__path(key))
+        self.__evict()
+
+    def clear(self):
+        """Delete all cache entries."""
+        for path in self.cache_dir.glob('*.npz'):
+            path.unlink()
+
+    def __evict(self):
+        entries = sorted(self.cache_dir.glob('*.npz'), key=lambda path: path.stat().st_mtime)
+        total_bytes = sum(path.stat().st_size for path in entries)
+        for path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= path.stat().st_size
+            path.unlink()
+            logging.info(f'Evicted {path.name} from the stage cache.')
+
+
+class ResultColumns:
+    """
+    Stop results as typed columns instead of a dict of dicts.
+
+    Records are appended into typed buffers (int64/float64 arrays, dictionary codes for categorical columns, offsets and
+    values for the node/way ref lists). finish() turns them into a DataFrame `frame` with categorical columns for all but
+    the list columns, which stay in `lists` as (offsets, values, present mask). Columns added to `frame` afterwards are
+    written after the extracted ones. write() streams the results in chunks to CSV, Parquet/Arrow or GeoPackage.
+    """
+    # Column order and type of the results
+    COLUMN_TYPES = {
+        'osm_id': 'int',
+        'osm_object_type': 'category',
+        'osm_name': 'str',
+        'lat': 'float',
+        'lon': 'float',
+        'osm_way_refs': 'list',
+        'osm_node_refs': 'list',
+        'osm_public_transport': 'category',
+        'osm_railway': 'category',
+        'is_in_osm_stoparea': 'bool',
+        'osm_stoparea_name': 'str',
+        'is_in_osm_route': 'bool',
+        'osm_route_type': 'category',
+        'osm_service_type': 'category',
+        'service_priority': 'float',
+        'general_type': 'category',
+        'specific_type': 'category',
+    }
+
+    def __init__(self):
+        self.frame = None
+        self.lists = {}
+        self._buffers = {}
+        for column, column_type in self.COLUMN_TYPES.items():
+            if column_type == 'int':
+                self._buffers[column] = array.array('q')
+            elif column_type == 'float':
+                self._buffers[column] = array.array('d')
+            elif column_type == 'bool':
+                self._buffers[column] = array.array('b')  # -1 for missing values
+            elif column_type == 'str':
+                self._buffers[column] = []
+            elif column_type == 'category':
+                self._buffers[column] = (array.array('i'), {})  # Codes (-1 for missing values) and categories
+            else:
+                self._buffers[column] = (array.array('q', [0]), array.array('q'), array.array('b'))  # Offsets, values, present
+
+    @classmethod
+    def from_records(cls, records):
+        """Build the columns from an iterable of stop records (the values of stop_data)."""
+        columns = cls()
+        for record in records:
+            columns.append(record)
+        columns.finish()
+        return columns
+
+    def append(self, record):
+        """Append a stop record, missing fields become missing values."""
+        for column, column_type in self.COLUMN_TYPES.items():
+            value = record.get(column)
+            buffer = self._buffers[column]
+            if column_type == 'category':
+                codes, categories = buffer
+                codes.append(-1 if value is None else categories.setdefault(value, len(categories)))
+            elif column_type == 'list':
+                offsets, values, present = buffer
+                if value is not None:
+                    values.extend(value)
+                offsets.append(len(values))
+                present.append(value is not None)
+            elif column_type == 'float':
+                buffer.append(float('nan') if value is None else value)
+            elif column_type == 'bool':
+                buffer.append(-1 if value is None else value)
+            else:
+                buffer.append(value)
+
+    def finish(self):
+        """Convert the buffers into `frame` and `lists`."""
+        data = {}
+        for column, column_type in self.COLUMN_TYPES.items():
+            buffer = self._buffers[column]
+            if column_type == 'category':
+                codes, categories = buffer
+                data[column] = pd.Categorical.from_codes(np.frombuffer(codes, dtype=np.int32), categories=list(categories))
+            elif column_type == 'list':
+                offsets, values, present = buffer
+                self.lists[column] = (np.frombuffer(offsets, dtype=np.int64), np.frombuffer(values, dtype=np.int64), np.frombuffer(present, dtype=np.int8).astype(bool))
+            elif column_type == 'bool':
+                flags = np.frombuffer(buffer, dtype=np.int8)
+                data[column] = pd.arrays.BooleanArray(flags == 1, flags < 0)
+            elif column_type == 'str':
+                data[column] = pd.array(buffer, dtype=object)
+            else:
+                data[column] = np.frombuffer(buffer, dtype=np.int64 if column_type == 'int' else np.float64)
+        self.frame = pd.DataFrame(data)
+        self._buffers = {}
+
+    def take(self, rows):
+        """Return new ResultColumns with the given rows (array of row positions), including columns added to frame."""
+        rows = np.asarray(rows, dtype=np.int64)
+        subset = ResultColumns()
+        subset._buffers = {}
+        subset.frame = self.frame.iloc[rows].reset_index(drop=True)
+        for column, (offsets, values, present) in self.lists.items():
+            starts = offsets[rows]
+            lengths = offsets[rows + 1] - starts
+            subset_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=subset_offsets[1:])
+            positions = np.repeat(starts - subset_offsets[:-1], lengths) + np.arange(subset_offsets[-1])
+            subset.lists[column] = (subset_offsets, values[positions], present[rows])
+        return subset
+
+    @property
+    def column_order(self):
+        """Extracted columns in COLUMN_TYPES order followed by columns added to frame."""
+        return list(self.COLUMN_TYPES) + [column for column in self.frame.columns if column not in self.COLUMN_TYPES]
+
+    def __len__(self):
+        return len(self.frame)
+
+    def list_values(self, column, start=0, stop=None):
+        """Return the lists of a list column for rows start:stop as Python lists (None for missing values)."""
+        offsets, values, present = self.lists[column]
+        stop = len(self) if stop is None else stop
+        bounds = offsets[start:stop + 1].tolist()
+        values = values[bounds[0]:bounds[-1]].tolist()
+        return [values[bounds[i] - bounds[0]:bounds[i + 1] - bounds[0]] if present[start + i] else None for i in range(stop - start)]
+
+    def to_dataframe(self, start=0, stop=None, list_format=list):
+        """
+        Return rows start:stop as DataFrame in column order.
+        :param list_format: Function applied to each list of the list columns, e.g. str for CSV output
+        """
+        chunk = self.frame.iloc[start:stop]
+        data = {}
+        for column in self.column_order:
+            if column in self.lists:
+                data[column] = pd.array([None if value is None else list_format(value) for value in self.list_values(column, start, start + len(chunk))], dtype=object)
+            else:
+                data[column] = chunk[column].array
+        return pd.DataFrame(data, index=chunk.index)
+
+    def write(self, path, output_format=None, chunk_size=100000):
+        """
+        Write the results in chunks of chunk_size rows.
+        :param path: Output file
+        :param output_format: 'csv', 'parquet' (needs pyarrow) or 'gpkg', by default derived from the file extension
+        """
+        output_format = output_format or pathlib.Path(path).suffix.lstrip('.').lower()
+        if output_format == 'csv':
+            with open(path, 'w', newline='') as f:
+                for start in range(0, max(len(self), 1), chunk_size):
+                    self.to_dataframe(start, start + chunk_size, list_format=str).to_csv(f, index=False, header=start == 0)
+        elif output_format in ('parquet', 'arrow'):
+            self.__write_parquet(path, chunk_size)
+        elif output_format == 'gpkg':
+            self.__write_geopackage(path, chunk_size)
+        else:
+            raise ValueError(f'Unknown output format: {output_format}. Choose csv, parquet or gpkg.')
+
+    def __write_parquet(self, path, chunk_size):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError('Writing Parquet requires pyarrow (pip install pyarrow).') from e
+        writer = None
+        for start in range(0, max(len(self), 1), chunk_size):
+            chunk = self.frame.iloc[start:start + chunk_size]
+            arrays = {}
+            for column in self.column_order:
+                if column in self.lists:
+                    offsets, values, present = self.lists[column]
+                    chunk_offsets = offsets[start:start + len(chunk) + 1]
+                    arrays[column] = pa.LargeListArray.from_arrays(pa.array(chunk_offsets - chunk_offsets[0]), pa.array(values[chunk_offsets[0]:chunk_offsets[-1]]), mask=pa.array(~present[start:start + len(chunk)]))
+                else:
+                    arrays[column] = pa.array(chunk[column], from_pandas=True)
+            table = pa.table(arrays)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        writer.close()
+
+    @staticmethod
+    def __column_type(dtype):
+        """Type of a column added to frame as in COLUMN_TYPES, None for anything but numbers and bools."""
+        if pd.api.types.is_bool_dtype(dtype):
+            return 'bool'
+        if pd.api.types.is_integer_dtype(dtype):
+            return 'int'
+        if pd.api.types.is_float_dtype(dtype):
+            return 'float'
+        return None
+
+    def __write_geopackage(self, path, chunk_size):
+        """Write a GeoPackage with a point layer 'put_stops' in EPSG:4326, list columns are stored as text."""
+        path = pathlib.Path(path)
+        if path.exists():
+            path.unlink()
+        sql_types = {'int': 'INTEGER', 'float': 'REAL', 'bool': 'BOOLEAN'}
+        columns = self.column_order
+        column_types = {column: self.COLUMN_TYPES.get(column) or self.__column_type(self.frame[column].dtype) for column in columns}
+        column_defs = ', '.join(f'"{column}" {sql_types.get(column_types[column], "TEXT")}' for column in columns)
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA application_id = 1196444487')  # 'GPKG'
+        connection.execute('PRAGMA user_version = 10300')
+        connection.executescript(_GEOPACKAGE_SCHEMA)
+        connection.execute(f'CREATE TABLE put_stops (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom POINT, {column_defs})')
+        column_names = ', '.join(f'"{column}"' for column in columns)
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        for start in range(0, len(self), chunk_size):
+            chunk = self.to_dataframe(start, start + chunk_size, list_format=str).astype(object)
+            chunk = chunk.where(chunk.notna(), None)
+            geometries = [None if lat is None or lon is None else _geopackage_point(lon, lat) for lat, lon in zip(chunk['lat'], chunk['lon'])]
+            connection.executemany(f'INSERT INTO put_stops (geom, {column_names}) VALUES ({placeholders})',
+                                   ((geometry, *row) for geometry, row in zip(geometries, chunk.itertuples(index=False, name=None))))
+        bounds = (self.frame['lon'].min(), self.frame['lat'].min(), self.frame['lon'].max(), self.frame['lat'].max())
+        connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id) VALUES ('put_stops', 'features', 'put_stops', ?, ?, ?, ?, 4326)",
+                           [None if np.isnan(bound) else float(bound) for bound in bounds])
+        connection.execute("INSERT INTO gpkg_geometry_columns VALUES ('put_stops', 'geom', 'POINT', 4326, 0, 0)")
+        connection.commit()
+        connection.close()
+
+
+# Required metadata tables of a GeoPackage (OGC 12-128r18) with the required spatial reference systems
+_GEOPACKAGE_SCHEMA = """
+CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+INSERT INTO gpkg_spatial_ref_sys VALUES ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system');
+INSERT INTO gpkg_spatial_ref_sys VALUES ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system');
+INSERT INTO gpkg_spatial_ref_sys VALUES ('WGS 84 geodetic', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]', 'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid');
+CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name), CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name), CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+"""
+
+
+def _geopackage_point(lon, lat):
+    """GeoPackage geometry blob of a point: header (magic, version, flags: little endian without envelope, srs_id) + WKB."""
+    return b'GP' + struct.pack('<BBi', 0, 1, 4326) + struct.pack('<BIdd', 1, 1, lon, lat)
 
 
 class PublicTransportStopExtractor:
-    def __init__(self, osm_file):
+    # Pass plans for reading the OSM file:
+    # 'native': like 'merged', but ways and nodes are pre-filtered by osmium's C++ filters so only candidates reach the Python handlers
+    # 'merged': one relation-only read shared by both relation handlers, then a way-only and a node-only read
+    # 'legacy': the original four full reads (one per handler), kept to compare results row for row
+    PASS_PLANS = ('native', 'merged', 'legacy')
+    # Strategies for getting the coordinates of way nodes:
+    # 'ids': the way pass only collects node IDs (no location index), their coordinates are read in the node pass
+    # 'inline': the way pass reads all nodes into a location index and takes the way node coordinates from it,
+    #           the node pass is left with tagged nodes and nodes referenced directly by relations
+    NODE_STRATEGIES = ('ids', 'inline')
+
+    # Storage written by each pass, a parallel pass returns these from each shard and merges them in file order
+    PASS_OUTPUTS = {
+        'relations': ('putline_elems', 'stoparea_elems', 'relation_way_refs', 'relation_way_node_refs', 'relation_members'),
+        'ways': ('relation_way_node_refs', 'nodes_coords'),
+        'nodes': ('nodes_coords',),
+    }
+    # Storage read by each pass, a parallel pass hands it to every shard worker
+    PASS_INPUTS = {
+        'relations': (),
+        'ways': ('relation_way_refs',),
+        'nodes': ('relation_way_node_refs',),
+    }
+
+    # Hash of the source code of each pass, see __code_hash
+    __code_hashes = {}
+
+    # Indexes of the extractor whose sizes are reported to the metrics
+    INDEXES = ('stoparea_elems', 'putline_elems', 'relation_way_node_refs', 'relation_way_refs', 'nodes_coords', 'stop_data', 'relation_members')
+
+    def __init__(self, osm_file, pass_plan='native', node_strategy='ids', location_index='flex_mem', workers=1, cache=None, region=None, classifier=None,
+                 metrics=None):
+        """
+        :param osm_file: Path to the OSM file
+        :param pass_plan: How the file is read, see PASS_PLANS
+        :param node_strategy: How way node coordinates are gathered, see NODE_STRATEGIES. Not available for the 'legacy' plan.
+        :param location_index: osmium index type of the location index used by the 'inline' strategy, e.g. 'flex_mem',
+                               'sparse_mem_array', 'dense_mem_array' or a file-backed 'sparse_file_array,<path>' / 'dense_file_array,<path>'
+                               which keeps RAM bounded on planet-size inputs
+        :param workers: Number of worker processes. With more than one worker every pass is split by PBF block ranges
+                        and the partial results are merged in file order, giving the same results as a serial run.
+        :param cache: Optional StageCache, the results of unchanged passes are then loaded from it instead of reading the file
+        :param region: Optional Region or RegionSet, only stops inside it are extracted. Nodes are checked when they are read, ways and
+                       relations by their centroid, which is computed from all their nodes (also those outside the region),
+                       so elements crossing the border are kept or dropped the same way no matter how the file was cut.
+        :param classifier: TagClassifier deciding which elements are stops and deriving their types, by default one with
+                           the rules of classification.py
+        :param metrics: Optional Metrics measuring the stages, handler counts and index sizes. Without it, nothing is measured.
+        """
+        if pass_plan not in self.PASS_PLANS:
+            raise ValueError(f'Unknown pass plan: {pass_plan}. Choose one of {self.PASS_PLANS}.')
+        if node_strategy not in self.NODE_STRATEGIES:
+            raise ValueError(f'Unknown node strategy: {node_strategy}. Choose one of {self.NODE_STRATEGIES}.')
+        if pass_plan == 'legacy' and node_strategy != 'ids':
+            raise ValueError('The legacy pass plan only supports the node strategy ids.')
+        if workers > 1 and (pass_plan == 'legacy' or node_strategy != 'ids'):
+            raise ValueError('Parallel extraction requires a non-legacy pass plan and the node strategy ids.')
+        if workers > 1 and not str(osm_file).endswith('.pbf'):
+            raise ValueError('Parallel extraction requires a PBF file.')
         self.osm_file = osm_file  # Store the file path
-        # Storage for extracted data
+        self.pass_plan = pass_plan
+        self.node_strategy = node_strategy
+        self.location_index = location_index
+        self.workers = workers
+        self.cache = cache
+        self.region = region
+        self.classifier = classifier if classifier is not None else TagClassifier()
+        self.metrics = metrics
+        self.handler_counts = {}  # Counts of the handlers of the last pass (handler name -> counts, see __count_handlers)
+        self.__shards_done = 0  # Progress of a parallel pass in bytes
+        self.__shards_total = None
+        self.__file_fingerprint = None
+        self.__stage_keys = {}  # Stage cache key of each pass
+        self.init_storage()
+
+    def init_storage(self):
+        """Create empty storage for the extracted data."""
+        # Keys of storage holding nodes, ways and relations together are osm_key(type, ID)
+        # stoparea_elems, putline_elems and relation_way_refs stay dicts: they only hold members of stop relations, their
+        # values are records and ID lists, and they are updated by key while relations are resolved (min priority rule)
         self.stoparea_elems = {}  # OSM elements tagged in a stop_area relation with the name of the stop_area
         self.putline_elems = {}  # OSM elements tagged in a route relation with info of the route (service type)
-        self.relation_way_node_refs = set()  # PuT nodes referenced by relations or ways (key: node ID, value: list of IDs)
+        self.relation_way_node_refs = IdSet()  # IDs of PuT nodes referenced by relations or ways
         self.relation_way_refs = {}  # PuT ways referenced by relations (key: way ID, value: list of IDs). Need to be a dict with reference to the original relation
-        self.nodes_coords = {}  # Coordinates of nodes
+        self.nodes_coords = CoordinateStore()  # Coordinates of nodes
         self.stop_data = {}  # Final stop data (id, name, type, centroid)
+        self.relation_members = {}  # Relevant members of route and public_transport relations (key: relation ID, value: array of osm_key(type, ID))
+        self.region_filtered = False  # Whether filter_region() removed the ways and relations outside the region from stop_data
 
     class RelationHandlerRoutes(osmium.SimpleHandler):
         def __init__(self, parent):
             super().__init__()
             self.parent = parent
-            # prioritization of different kinds of train services
-            # TODO: Figure out what to do with passenger key...
-            self.prioritization_services = {
-                'high_speed': 1,
-                'international': 1,
-                'long_distance': 2,
-                'national': 2,
-                'regional': 3,
-                'commuter': 4,
-                'suburban': 4,
-                'local': 5,
-                'night': 6,
-                'tourism': 7,
-                'car': 8,
-                'car_shuttle': 8,
-                'event': 9,
-            }
+            self.candidates = 0  # Route relations
+            self.stored = 0  # Stop and platform members stored
 
         def relation(self, r):
             """
@@ -45,29 +934,31 @@ class PublicTransportStopExtractor:
             """
             # Process relations tagged as PuT route (line)
             if 'route' in r.tags:
+                self.candidates += 1
                 route_type = r.tags['route']
                 # assign priority to train stops
                 if route_type == 'train' and 'service' in r.tags:
                     service_types = r.tags['service']
-                    # sometimes the values are split by semicolon
-                    service_types_split = service_types.split(';')
-                    priorities = [self.prioritization_services[st] for st in service_types_split if st in self.prioritization_services]
-
-                    if priorities:
-                        priority = min(priorities)
-                    else:
-                        # print if not on the list and assign prio type 10
+                    # prioritization of different kinds of train services (classification.SERVICE_PRIORITIES)
+                    # TODO: Figure out what to do with passenger key...
+                    priority = self.parent.classifier.service_priority(service_types)
+                    if priority is None:
+                        # print if not on the list and assign the default priority
                         logging.warning(f'None of train service_type: {service_types} is in prioritization list.')
-                        priority = 10
+                        priority = self.parent.classifier.default_service_priority
                 else:
                     service_types = ''
-                    priority = 10
+                    priority = self.parent.classifier.default_service_priority
+                members = self.parent.relation_members.setdefault(r.id, array.array('q'))
                 for member in r.members:
                     if member.role == 'stop' or member.role == 'platform':
                         objtype = {'n': 'node', 'w': 'way', 'r': 'relation'}[member.type]
+                        key = osm_key(member.type, member.ref)
+                        members.append(key)
+                        self.stored += 1
                         # Check if the node is already stored and if the new service has higher priority
-                        if member.ref not in self.parent.putline_elems or self.parent.putline_elems[member.ref]['service_priority'] > priority:
-                            self.parent.putline_elems[member.ref] = {
+                        if key not in self.parent.putline_elems or self.parent.putline_elems[key]['service_priority'] > priority:
+                            self.parent.putline_elems[key] = {
                                 "osm_object_type": objtype,
                                 "osm_route_type": route_type,
                                 "osm_service_type": service_types,
@@ -78,6 +969,8 @@ class PublicTransportStopExtractor:
         def __init__(self, parent):
             super().__init__()
             self.parent = parent
+            self.candidates = 0  # Relations with a public_transport tag
+            self.stored = 0  # Stop relations stored
 
         def relation(self, r):
             """
@@ -88,8 +981,13 @@ class PublicTransportStopExtractor:
             :param r: Relation to process
             """
             put_tag = r.tags.get('public_transport')
+            # Keep the members for resolving nested relations (see resolve_nested_relations)
+            if put_tag is not None:
+                self.candidates += 1
+                self.parent.relation_members.setdefault(r.id, array.array('q')).extend(osm_key(member.type, member.ref) for member in r.members)
             # 1. Process relations tagged as put stop
-            if put_tag in ['platform', 'stop_position']:
+            fields = self.parent.classifier.classify(r.tags, 'relation')
+            if fields is not None:
                 # Init lists of nodes  and ways contained in the relation
                 node_refs = []
                 way_refs = []
@@ -105,19 +1003,14 @@ class PublicTransportStopExtractor:
                             self.parent.relation_way_refs[member.ref] = []
                         self.parent.relation_way_refs[member.ref].append(r.id)
                         way_refs.append(member.ref)
-                    elif member.type == 'r':
-                        logging.warning('relation')
-
-                # Store stop data for relation
-                relevant_service_tags = {key: value for key, value in r.tags if key in ['train', 'subway', 'light_rail', 'tram', 'railway', 'bus', 'highway']}
-                general_type, specific_type = self.parent.check_service_from_element_tags(relevant_service_tags)
-                self.parent.stop_data[r.id] = {
-                    'osm_name': r.tags.get('name', 'N/A'),
+                    # Members of nested relations are added by resolve_nested_relations()
+
+                # Store stop data for relation (fields: name, public_transport tag and service types, see classification.py)
+                self.stored += 1
+                self.parent.stop_data[osm_key('r', r.id)] = {
                     'osm_id': r.id,
                     'osm_object_type': 'relation',
-                    'osm_public_transport': put_tag,
-                    'general_type': general_type,
-                    'specific_type': specific_type,
+                    **fields,
                     'osm_node_refs': node_refs,
                     'osm_way_refs': way_refs,
                 }
@@ -126,269 +1019,729 @@ class PublicTransportStopExtractor:
             if r.tags.get('public_transport') == 'stop_area':
                 for member in r.members:
                     stop_area_name = r.tags.get('name', 'N/A')
-                    self.parent.stoparea_elems[member.ref] = stop_area_name
+                    self.parent.stoparea_elems[osm_key(member.type, member.ref)] = stop_area_name
 
-            # 3. Process relations that are tagged as members of a route relation
-            # route_relations = {k: v for k, v in self.parent.putline_elems.items() if v["osm_object_type"] == "relation"}
-            # TODO: ACHTUNG: Es kann wieder passieren, dass relations weitere relations enthalten. Das müsste bereits vorher in einem dritten relationhandler abgefangen werden, der so oft iteriert bis es keine osm_object_type mehr gibt
-            #  wenn die relation r nicht anderweitig bereits getaggt ist können die infos aus putline_elems für r übernommen werden.
+            # 3. Relations that are members of route or stop_area relations pass the route and stop_area info on to their
+            #    own members, this is done after the pass by resolve_nested_relations()
 
     class WayHandler(osmium.SimpleHandler):
-        def __init__(self, parent):
+        def __init__(self, parent, locations=None):
             super().__init__()
             self.parent = parent
+            # Location index filled with all nodes before the ways are read (node strategy 'inline')
+            self.locations = locations
+            self.candidates = 0  # Tagged ways and ways referenced by relations
+            self.stored = 0  # Stop ways stored
 
-        def way(self, w):
-            put_tag = w.tags.get('public_transport')
-            railway_tag = w.tags.get('railway')
+        def way(self, w, referenced=None):
+            """
+            :param w: Way to process
+            :param referenced: Whether the way is referenced by a stop relation, None to look it up (the native plan's
+                               ID filter already knows it)
+            """
+            fields = self.parent.classifier.classify(w.tags, 'way')
+            if referenced is None:
+                referenced = w.id in self.parent.relation_way_refs
             # Process ways that are tagged as public_transport stop OR station OR are part of a relevant relation
-            if put_tag in ['platform', 'stop_position', 'station'] or railway_tag in ['station', 'halt', 'tram_stop'] or w.id in self.parent.relation_way_refs:
+            if fields is not None or referenced:
+                self.candidates += 1
                 node_refs = []
                 for n in w.nodes:
-                    self.parent.relation_way_node_refs.add(n.ref)
+                    location = self.get_location(n.ref)
+                    if location is not None:
+                        self.parent.nodes_coords[n.ref] = (location.lat, location.lon)
+                    else:
+                        # Coordinates are read in the node pass
+                        self.parent.relation_way_node_refs.add(n.ref)
                     node_refs.append(n.ref)
-                # Store stop data for the way, whether it's tagged itself or belongs to a relation
-                # 1. Check if tagged with public_transport
-                if put_tag in ['platform', 'stop_position']:
-                    relevant_service_tags = {key: value for key, value in w.tags if key in ['train', 'subway', 'light_rail', 'tram', 'railway', 'bus', 'highway']}
-                    general_type, specific_type = self.parent.check_service_from_element_tags(relevant_service_tags)
-                    self.parent.stop_data[w.id] = {
-                        'osm_name': w.tags.get('name', 'N/A'),
+                # Store stop data for tagged ways (fields: name, public_transport/railway tag and service types, see classification.py)
+                if fields is not None:
+                    self.stored += 1
+                    self.parent.stop_data[osm_key('w', w.id)] = {
                         'osm_id': w.id,
                         'osm_object_type': 'way',
-                        'osm_public_transport': put_tag,
-                        'general_type': general_type,
-                        'specific_type': specific_type,
-                        'osm_node_refs': node_refs,
-                    }
-                # Additionally check if tagged with railway (EBO vs BOStrab), if already exists overwrites with same info + adds railway tag
-                if railway_tag in ['station', 'halt', 'tram_stop']:
-                    relevant_service_tags = {key: value for key, value in w.tags if key in ['station', 'railway']}
-                    general_type, specific_type = self.parent.check_station_service_from_element_tags(relevant_service_tags)
-                    # Store stop data for the way, whether it's tagged itself or belongs to a relation
-                    self.parent.stop_data[w.id] = {
-                        'osm_name': w.tags.get('name', 'N/A'),
-                        'osm_id': w.id,
-                        'osm_object_type': 'way',
-                        'osm_railway': railway_tag,
-                        'general_type': general_type,
-                        'specific_type': specific_type,
-                        'osm_node_refs': node_refs,
-                    }
-                elif put_tag == 'station':
-                    relevant_service_tags = {key: value for key, value in w.tags if key in ['station', 'railway', 'bus']}
-                    general_type, specific_type = self.parent.check_station_service_from_element_tags(relevant_service_tags)
-                    # Store stop data for the way, whether it's tagged itself or belongs to a relation
-                    self.parent.stop_data[w.id] = {
-                        'osm_name': w.tags.get('name', 'N/A'),
-                        'osm_id': w.id,
-                        'osm_object_type': 'way',
-                        'osm_railway': railway_tag,
-                        'general_type': general_type,
-                        'specific_type': specific_type,
+                        **fields,
                         'osm_node_refs': node_refs,
                     }
                 # Process ways that are part of a relevant relation (not elif because can be in both!)
-                if w.id in self.parent.relation_way_refs:
-                    node_refs = [n.ref for n in w.nodes]
-                    if w.id in self.parent.relation_way_refs:
-                        for r_id in self.parent.relation_way_refs[w.id]:
-                            self.parent.stop_data[r_id]['osm_node_refs'].extend(node_refs)
+                if referenced:
+                    for r_id in self.parent.relation_way_refs[w.id]:
+                        self.parent.stop_data[osm_key('r', r_id)]['osm_node_refs'].extend(node_refs)
+
+        def get_location(self, node_id):
+            """Return the location of the node from the location index or None if there is no index or no valid location."""
+            if self.locations is None:
+                return None
+            try:
+                location = self.locations.get(node_id)
+            except KeyError:
+                return None
+            return location if location.valid() else None
 
     class NodeHandler(osmium.SimpleHandler):
         def __init__(self, parent):
             super().__init__()
             self.parent = parent
+            self.candidates = 0  # Tagged nodes and nodes referenced by relations or ways
+            self.stored = 0  # Stop nodes stored (inside the region)
 
-        def node(self, n):
-            put_tag = n.tags.get('public_transport')
-            railway_tag = n.tags.get('railway')
+        def node(self, n, referenced=None):
+            """
+            :param n: Node to process
+            :param referenced: Whether the node is referenced by a stop relation or way, None to look it up (the native
+                               plan's ID filter already knows it)
+            """
+            fields = self.parent.classifier.classify(n.tags, 'node')
             # Process nodes that are either part of relations or ways, or are tagged independently as stops
-            if put_tag in ['platform', 'stop_position', 'station'] or railway_tag in ['station', 'halt', 'tram_stop'] or n.id in self.parent.relation_way_node_refs:
+            if fields is not None or (n.id in self.parent.relation_way_node_refs if referenced is None else referenced):
+                self.candidates += 1
                 # Store the coordinates of the node
                 self.parent.nodes_coords[n.id] = (n.location.lat, n.location.lon)
+                # Nodes outside the region are only needed for the centroids of ways and relations
+                if self.parent.region is not None and not self.parent.region.contains(n.location.lon, n.location.lat):
+                    return
 
-                # Directly store stop data for independently tagged nodes
-                # 1. Nodes tagged with public_transport
-                if put_tag in ['platform', 'stop_position']:
-                    relevant_service_tags = {key: value for key, value in n.tags if key in ['train', 'subway', 'light_rail', 'tram', 'railway', 'bus', 'highway']}
-                    general_type, specific_type = self.parent.check_service_from_element_tags(relevant_service_tags)
-                    self.parent.stop_data[n.id] = {
-                        'osm_name': n.tags.get('name', 'N/A'),
+                # Directly store stop data for independently tagged nodes (fields: name, public_transport/railway tag and service types, see classification.py)
+                if fields is not None:
+                    self.stored += 1
+                    self.parent.stop_data[osm_key('n', n.id)] = {
                         'osm_id': n.id,
                         'osm_object_type': 'node',
-                        'osm_public_transport': put_tag,
-                        'general_type': general_type,
-                        'specific_type': specific_type,
-                        'lat': n.location.lat,
-                        'lon': n.location.lon
-                    }
-                # 2. Alternatively check if tagged with railway (EBO vs BOStrab), if already exists overwrites with same info + adds railway tag
-                if railway_tag in ['station', 'halt', 'tram_stop']:
-                    relevant_service_tags = {key: value for key, value in n.tags if key in ['station', 'railway']}
-                    general_type, specific_type = self.parent.check_station_service_from_element_tags(relevant_service_tags)
-                    # Store stop data for the way, whether it's tagged itself or belongs to a relation
-                    self.parent.stop_data[n.id] = {
-                        'osm_name': n.tags.get('name', 'N/A'),
-                        'osm_id': n.id,
-                        'osm_object_type': 'node',
-                        'osm_railway': railway_tag,
-                        'general_type': general_type,
-                        'specific_type': specific_type,
-                        'lat': n.location.lat,
-                        'lon': n.location.lon
-                    }
-                elif put_tag == 'station':
-                    relevant_service_tags = {key: value for key, value in n.tags if key in ['station', 'railway', 'bus']}
-                    general_type, specific_type = self.parent.check_station_service_from_element_tags(relevant_service_tags)
-                    # Store stop data for the way, whether it's tagged itself or belongs to a relation
-                    self.parent.stop_data[n.id] = {
-                        'osm_name': n.tags.get('name', 'N/A'),
-                        'osm_id': n.id,
-                        'osm_object_type': 'node',
-                        'osm_railway': railway_tag,
-                        'general_type': general_type,
-                        'specific_type': specific_type,
+                        **fields,
                         'lat': n.location.lat,
                         'lon': n.location.lon
                     }
 
     def process_relations(self):
         """Run the relation handlers on the OSM file."""
+        self.__run_pass('relations', self.__process_relations_serial)
+
+    def __process_relations_serial(self):
         relation_handler_routes = self.RelationHandlerRoutes(self)
-        relation_handler_routes.apply_file(self.osm_file)  # Use the stored file path
         relation_handler_stops_stopareas = self.RelationHandlerStops_StopAreas(self)
-        relation_handler_stops_stopareas.apply_file(self.osm_file)  # Use the stored file path
+        counter = None
+        if self.pass_plan == 'legacy':
+            relation_handler_routes.apply_file(self.osm_file)  # Use the stored file path
+            relation_handler_stops_stopareas.apply_file(self.osm_file)  # Use the stored file path
+        else:
+            # Both handlers only write to their own storage, so they can share a single read
+            counter = self.__apply_handlers(osmium.osm.RELATION, relation_handler_routes, relation_handler_stops_stopareas)
+        self.__count_handlers(counter.relations if counter is not None else None, relation_handler_routes, relation_handler_stops_stopareas)
+
+    def resolve_nested_relations(self):
+        """
+        Resolve relations nested in route, stop_area and stop relations in memory, using the members kept in
+        relation_members during the relation pass:
+        - Stop relations get the nodes and ways of the relations they contain (at any depth) for their centroid.
+        - Route info is passed on from relation members of routes to everything they contain. As for direct members,
+          the route with the highest priority (min value) wins.
+        - stop_area names are passed on from relation members of stop_areas to everything they contain, unless an object
+          is a direct member of a named stop_area itself.
+        Members of relations without route or public_transport tags are not known and not resolved.
+        """
+        relation_code = OSM_TYPE_CODES['r']
+        relation_ids = {key // 4 for key in itertools.chain(self.putline_elems, self.stoparea_elems) if key % 4 == relation_code}
+        relation_ids.update(info['osm_id'] for info in self.stop_data.values() if info['osm_object_type'] == 'relation')
+        descendants = self.__relation_descendants(sorted(relation_ids))
+
+        # Stop relations containing relations
+        for key, stop_info in self.stop_data.items():
+            if stop_info['osm_object_type'] != 'relation' or not any(member % 4 == relation_code for member in self.relation_members.get(stop_info['osm_id'], ())):
+                continue
+            known_nodes = set(stop_info['osm_node_refs'])
+            known_ways = set(stop_info['osm_way_refs'])
+            for member in descendants[stop_info['osm_id']]:
+                member_id, member_code = divmod(member, 4)
+                if member_code == OSM_TYPE_CODES['n'] and member_id not in known_nodes:
+                    known_nodes.add(member_id)
+                    self.relation_way_node_refs.add(member_id)
+                    stop_info['osm_node_refs'].append(member_id)
+                elif member_code == OSM_TYPE_CODES['w'] and member_id not in known_ways:
+                    known_ways.add(member_id)
+                    self.relation_way_refs.setdefault(member_id, []).append(stop_info['osm_id'])
+                    stop_info['osm_way_refs'].append(member_id)
+
+        object_types = {OSM_TYPE_CODES['n']: 'node', OSM_TYPE_CODES['w']: 'way', relation_code: 'relation'}
+        # Route info of relation members
+        for key, route_info in sorted((key, info) for key, info in self.putline_elems.items() if key % 4 == relation_code):
+            for member in descendants.get(key // 4, ()):
+                if member not in self.putline_elems or self.putline_elems[member]['service_priority'] > route_info['service_priority']:
+                    self.putline_elems[member] = dict(route_info, osm_object_type=object_types[member % 4])
+
+        # stop_area names of relation members, direct members of named stop_areas keep their name
+        inherited_names = {}
+        for key, name in sorted(self.stoparea_elems.items()):
+            if key % 4 == relation_code and name != 'N/A':
+                for member in descendants.get(key // 4, ()):
+                    inherited_names.setdefault(member, name)
+        for member, name in inherited_names.items():
+            if self.stoparea_elems.get(member, 'N/A') == 'N/A':
+                self.stoparea_elems[member] = name
+
+    def __relation_descendants(self, relation_ids):
+        """
+        Return a dict relation ID -> keys of all objects contained in the relation directly or through nested relations
+        (in member order, without duplicates and without the relation itself) for the given relations and all relations
+        nested in them. Relations containing each other (cycles) are found as strongly connected components with
+        Tarjan's algorithm, every component is resolved once and its results are reused by all relations containing it.
+        """
+        relation_code = OSM_TYPE_CODES['r']
+        members = self.relation_members
+
+        def nested(relation_id):
+            return iter([member // 4 for member in members[relation_id] if member % 4 == relation_code and member // 4 in members])
+
+        descendants = {}
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        for root in relation_ids:
+            if root in index or root not in members:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, nested(root))]
+            while work:
+                relation_id, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, nested(child)))
+                        break
+                    if child in on_stack:
+                        lowlink[relation_id] = min(lowlink[relation_id], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent_id = work[-1][0]
+                        lowlink[parent_id] = min(lowlink[parent_id], lowlink[relation_id])
+                    if lowlink[relation_id] == index[relation_id]:
+                        component = []
+                        while not component or component[-1] != relation_id:
+                            component.append(stack.pop())
+                            on_stack.discard(component[-1])
+                        # Nested components are finished before the components containing them
+                        contained = {}
+                        for component_id in reversed(component):
+                            for member in members[component_id].tolist():
+                                contained[member] = None
+                                if member % 4 == relation_code and member // 4 in descendants:
+                                    contained.update(dict.fromkeys(descendants[member // 4]))
+                        for component_id in component:
+                            own_key = osm_key('r', component_id)
+                            descendants[component_id] = [member for member in contained if member != own_key]
+        return descendants
 
     def process_ways(self):
         """Run the way handler on the OSM file."""
-        way_handler = self.WayHandler(self)
-        way_handler.apply_file(self.osm_file, locations=True)  # Use the stored file path
+        self.__run_pass('ways', self.__process_ways_serial)
+
+    def __process_ways_serial(self):
+        counter = None
+        if self.pass_plan == 'legacy':
+            way_handler = self.WayHandler(self)
+            way_handler.apply_file(self.osm_file, locations=True)  # Use the stored file path
+        elif self.node_strategy == 'inline':
+            locations = osmium.index.create_map(self.location_index)
+            way_handler = self.WayHandler(self, locations)
+            if self.pass_plan == 'native':
+                self.__apply_prefiltered(osmium.osm.WAY, way_handler.way, self.relation_way_refs, locations)
+            else:
+                location_handler = osmium.NodeLocationsForWays(locations)
+                location_handler.apply_nodes_to_ways = False  # The way handler looks up the locations itself
+                counter = self.__apply_handlers(osmium.osm.NODE | osmium.osm.WAY, location_handler, way_handler)
+        else:
+            # The way handler only stores node IDs, so neither nodes nor a location index are needed here
+            way_handler = self.WayHandler(self)
+            if self.pass_plan == 'native':
+                self.__apply_prefiltered(osmium.osm.WAY, way_handler.way, self.relation_way_refs)
+            else:
+                counter = self.__apply_handlers(osmium.osm.WAY, way_handler)
+        self.__count_handlers(counter.ways if counter is not None else None, way_handler)
 
     def process_nodes(self):
         """Run the node handler on the OSM file."""
+        self.__run_pass('nodes', self.__process_nodes_serial)
+
+    def __process_nodes_serial(self):
         node_handler = self.NodeHandler(self)
-        node_handler.apply_file(self.osm_file, locations=True)  # Use the stored file path
+        counter = None
+        if self.pass_plan == 'legacy':
+            node_handler.apply_file(self.osm_file, locations=True)  # Use the stored file path
+        elif self.pass_plan == 'native':
+            self.__apply_prefiltered(osmium.osm.NODE, node_handler.node, self.relation_way_node_refs)
+        else:
+            counter = self.__apply_handlers(osmium.osm.NODE, node_handler)
+        self.__count_handlers(counter.nodes if counter is not None else None, node_handler)
 
-    @staticmethod
-    def check_service_from_element_tags(tags):
-        # tag_lookup = {
-        #     'train': 'train',
-        #     'subway': 'subway',
-        #     'light_rail': 'light_rail',
-        #     'tram': 'tram',
-        #     'railway': 'railway_platform',
-        #     'bus': 'bus',
-        #     'highway': 'highway_platform'
-        # }
-        tag_lookup = {
-            # tag: [general_type, specific_type]
-            'train': ['rail', 'train'],
-            'subway': ['rail', 'subway'],
-            'light_rail': ['rail', 'light_rail'],
-            'tram': ['rail', 'tram'],
-            'bus': ['bus', 'bus']
+    def __count_handlers(self, seen, *handlers):
+        """
+        Store the counts of the handlers of a pass in handler_counts.
+        :param seen: Number of elements of the pass' type passed to the handlers, None if not counted (without metrics,
+                     and in the legacy and native plans, whose readers and C++ filters don't report the elements they read).
+                     The counts then have no 'seen' entry, so the metrics don't report a value that wasn't measured.
+        """
+        counted = {'seen': seen} if seen is not None else {}
+        self.handler_counts = {type(handler).__name__: {**counted, 'candidates': handler.candidates, 'stored': handler.stored} for handler in handlers}
+
+    def __run_pass(self, pass_name, process_serial):
+        """
+        Run a pass serially or on a process pool. With a stage cache, the results of the pass are loaded from the cache
+        if the input file, the code of the pass and the results of the previous passes are unchanged, otherwise they are
+        saved to it after the pass.
+        :param pass_name: 'relations', 'ways' or 'nodes'
+        :param process_serial: Method running the pass serially
+        """
+        progress = None
+        if self.metrics is not None:
+            progress = self.__parallel_progress if self.workers > 1 else self.__serial_progress(pass_name)
+        with self.measure(pass_name, progress) as record:
+            if self.cache is not None:
+                key = self.__stage_key(pass_name)
+                arrays = self.cache.load(key)
+                if arrays is not None:
+                    self.restore_storage(arrays)
+                    logging.info(f'Loaded results of the {pass_name} pass from the stage cache.')
+                    if record is not None:
+                        record['cached'] = True
+                    return
+            if self.workers > 1:
+                self.__process_parallel(pass_name)
+            else:
+                process_serial()
+            if pass_name == 'relations':
+                # Needs the members of all relations, so a parallel pass resolves them after merging the shards
+                self.resolve_nested_relations()
+            self.compact_storage()
+            if self.cache is not None:
+                self.cache.save(key, self.storage_arrays())
+            if record is not None:
+                record['cached'] = False
+                record['handlers'] = self.handler_counts
+
+    @contextlib.contextmanager
+    def measure(self, stage, progress=None):
+        """
+        Measure a stage with the extractor's metrics and record the index sizes after it. Does nothing without metrics.
+        :param stage: Name of the stage, e.g. 'compute_centroids'
+        :param progress: Optional callable returning (bytes done, total bytes) of the stage, see Metrics.measure()
+        :return: Context manager yielding the record of the stage in the metrics, or None without metrics
+        """
+        if self.metrics is None:
+            yield None
+            return
+        with self.metrics.measure(stage, progress) as record:
+            yield record
+        self.metrics.record_index_sizes((name, len(getattr(self, name))) for name in self.INDEXES)
+
+    def __serial_progress(self, pass_name):
+        """
+        Return a progress callable for a serial pass: bytes read by the process since the start of the pass and the
+        size of the file times the number of times the pass reads it. None if the bytes read aren't available.
+        """
+        start = bytes_read()
+        if start is None or not isinstance(self.osm_file, (str, os.PathLike)):
+            return None
+        if self.pass_plan == 'legacy':
+            # One read per handler
+            reads = 2 if pass_name == 'relations' else 1
+        elif self.pass_plan == 'native' and pass_name != 'relations':
+            # Two filtered readers, see __apply_prefiltered
+            reads = 2
+        else:
+            reads = 1
+        total = os.path.getsize(self.osm_file) * reads
+        # Readers read ahead, so the bytes read may exceed the total shortly before the end
+        return lambda: (min(bytes_read() - start, total), total)
+
+    def __parallel_progress(self):
+        """Progress of a parallel pass: bytes of the shards merged so far and of all shards."""
+        return self.__shards_done, self.__shards_total
+
+    def run_serial_pass(self, pass_name):
+        """Run a pass serially without stage cache and postprocessing, e.g. on a shard of the file."""
+        {'relations': self.__process_relations_serial, 'ways': self.__process_ways_serial, 'nodes': self.__process_nodes_serial}[pass_name]()
+        self.compact_storage()
+
+    def compact_storage(self):
+        """Merge the IDs and coordinates added during a pass into their sorted arrays and drop their lookup tables."""
+        self.relation_way_node_refs.compact()
+        self.nodes_coords.compact()
+
+    def __stage_key(self, pass_name):
+        """
+        Key of the results of a pass in the stage cache: hash of the input file fingerprint, the source code of the
+        pass' handlers and the key of the previous pass (whose results the pass builds on). Computed once per pass.
+        """
+        if pass_name in self.__stage_keys:
+            return self.__stage_keys[pass_name]
+        if self.__file_fingerprint is None:
+            self.__file_fingerprint = self.cache.file_fingerprint(self.osm_file, full=self.cache.full_hash)
+        key = hashlib.sha256()
+        region_fingerprint = self.region.fingerprint() if self.region is not None else None
+        key.update(f'{StageCache.FORMAT_VERSION}:{pass_name}:{self.__file_fingerprint}:{region_fingerprint}:{self.classifier.fingerprint()}'.encode())
+        key.update(self.__code_hash(pass_name).encode())
+        previous_pass = {'relations': None, 'ways': 'relations', 'nodes': 'ways'}[pass_name]
+        if previous_pass is not None:
+            key.update(self.__stage_key(previous_pass).encode())
+        self.__stage_keys[pass_name] = key.hexdigest()
+        return self.__stage_keys[pass_name]
+
+    def __code_hash(self, pass_name):
+        """Hash of the source code of a pass, computed once per process."""
+        code_hashes = PublicTransportStopExtractor.__code_hashes
+        if pass_name not in code_hashes:
+            pass_code = {
+                'relations': (self.RelationHandlerRoutes, self.RelationHandlerStops_StopAreas, self.__process_relations_serial, self.resolve_nested_relations,
+                              self.__relation_descendants),
+                'ways': (self.WayHandler, self.__process_ways_serial),
+                'nodes': (self.NodeHandler, self.__process_nodes_serial),
+            }[pass_name]
+            # Code of all passes: which objects reach the handlers (readers, native filters, shards) and how the
+            # results are stored and cached
+            shared_code = (self.__run_pass, self.__apply_handlers, self.__apply_prefiltered, self.__process_parallel, self.__merge_shard_result,
+                           self.run_serial_pass, self.compact_storage, self.init_storage, self.storage_arrays, self.restore_storage,
+                           IdSet, CoordinateStore, _StopDataLog, _read_varint, _scan_pbf_blocks, _init_shard_worker, _process_shard,
+                           _encode_strings, _decode_strings, _encode_records, _decode_records, TagClassifier, osm_key)
+            code_hash = hashlib.sha256()
+            for code in (*pass_code, *shared_code):
+                _hash_source(code, code_hash)
+            code_hashes[pass_name] = code_hash.hexdigest()
+        return code_hashes[pass_name]
+
+    def storage_arrays(self):
+        """Return the storage as a dict of NumPy arrays (see _encode_records)."""
+        arrays = {}
+        arrays['relation_way_node_refs/ids'] = self.relation_way_node_refs.to_array()
+        arrays['nodes_coords/ids'], arrays['nodes_coords/lat'], arrays['nodes_coords/lon'] = self.nodes_coords.to_arrays()
+        _encode_records('stop_data', self.stop_data, arrays)
+        _encode_records('putline_elems', self.putline_elems, arrays)
+        _encode_records('stoparea_elems', {key: {'name': name} for key, name in self.stoparea_elems.items()}, arrays)
+        _encode_records('relation_way_refs', {key: {'relation_ids': ids} for key, ids in self.relation_way_refs.items()}, arrays)
+        _encode_records('relation_members', {key: {'members': members.tolist()} for key, members in self.relation_members.items()}, arrays)
+        return arrays
+
+    def restore_storage(self, arrays):
+        """Replace the storage by the contents of a dict of arrays created by storage_arrays()."""
+        self.init_storage()
+        self.relation_way_node_refs.add_array(arrays['relation_way_node_refs/ids'])
+        self.nodes_coords.add_arrays(arrays['nodes_coords/ids'], arrays['nodes_coords/lat'], arrays['nodes_coords/lon'])
+        self.stop_data = _decode_records('stop_data', arrays)
+        self.putline_elems = _decode_records('putline_elems', arrays)
+        self.stoparea_elems = {key: record['name'] for key, record in _decode_records('stoparea_elems', arrays).items()}
+        self.relation_way_refs = {key: record['relation_ids'] for key, record in _decode_records('relation_way_refs', arrays).items()}
+        self.relation_members = {key: array.array('q', record['members']) for key, record in _decode_records('relation_members', arrays).items()}
+
+    def __apply_handlers(self, entities, *handlers):
+        """
+        Read the OSM file once and pass every object to all given handlers.
+        Only the given entity types are decoded, blocks with other types are skipped by the reader.
+        :param entities: osmium entity bits to read (e.g. osmium.osm.RELATION)
+        :param handlers: Handlers applied in the given order to each object
+        :return: _ElementCounter with the number of objects read, only with metrics (it costs a Python call per object)
+        """
+        counter = _ElementCounter() if self.metrics is not None else None
+        with osmium.io.Reader(self.osm_file, entities) as reader:
+            if counter is None:
+                osmium.apply(reader, *handlers)
+            else:
+                osmium.apply(reader, counter, *handlers)
+        return counter
+
+    def __apply_prefiltered(self, entities, callback, ref_ids, locations=None):
+        """
+        Pass only candidate objects to the callback: objects carrying one of the classifier's stop tags or whose ID is in ref_ids.
+        Both checks run in osmium's C++ filters on two readers of the file. Their streams are merged by ID, so the callback
+        sees each candidate once and in file order, all other objects are never converted to Python objects. The callback
+        also gets whether the object passed the ID filter, so the handler doesn't need to look up the ID again.
+        :param entities: osmium entity bits to read (osmium.osm.WAY or osmium.osm.NODE)
+        :param callback: Handler callback to call for each candidate with the object and whether it is in ref_ids (e.g. WayHandler.way)
+        :param ref_ids: IDs referenced by previously processed relations or ways (IdSet or dict keyed by ID)
+        :param locations: Optional location index, the first reader then also reads all nodes into it. The nodes come
+                          before any candidate in the file, so the index is complete once the first candidate is returned.
+        """
+        if locations is None:
+            tagged = osmium.FileProcessor(self.osm_file, entities)
+        else:
+            tagged = osmium.FileProcessor(self.osm_file, entities | osmium.osm.NODE).with_locations(locations)
+            tagged.with_filter(osmium.filter.EntityFilter(entities))
+        tagged.with_filter(osmium.filter.TagFilter(*self.classifier.stop_tags))
+        ids = ref_ids.to_array() if isinstance(ref_ids, IdSet) else np.fromiter(ref_ids, dtype=np.int64, count=len(ref_ids))
+        referenced = osmium.FileProcessor(self.osm_file, entities).with_filter(osmium.filter.IdFilter(ids))
+        candidates = 0
+        for tagged_obj, referenced_obj in osmium.zip_processors(tagged, referenced):
+            callback(tagged_obj if tagged_obj is not None else referenced_obj, referenced_obj is not None)
+            candidates += 1
+        logging.debug(f'{candidates} candidates passed the native filters.')
+
+    def __process_parallel(self, pass_name):
+        """
+        Run a pass on a process pool. The data blocks of the PBF file are split into contiguous shards, each worker runs
+        the serial pass on one shard and the partial results are merged in shard (= file) order.
+        :param pass_name: 'relations', 'ways' or 'nodes'
+        """
+        blocks = _scan_pbf_blocks(self.osm_file)
+        header_blocks = [(start, end) for blob_type, start, end in blocks if blob_type == 'OSMHeader']
+        data_blocks = [(start, end) for blob_type, start, end in blocks if blob_type == 'OSMData']
+        # Several shards per worker to even out the load, e.g. relation blocks are much faster to process than node blocks
+        shard_count = min(len(data_blocks), self.workers * 4) or 1
+        shards = []
+        for i in range(shard_count):
+            shard_blocks = data_blocks[i * len(data_blocks) // shard_count:(i + 1) * len(data_blocks) // shard_count]
+            if shard_blocks:
+                shards.append((shard_blocks[0][0], shard_blocks[-1][1]))
+        context = {
+            'osm_file': self.osm_file,
+            'header_range': header_blocks[0],
+            'pass_name': pass_name,
+            'pass_plan': self.pass_plan,
+            'region': self.region,
+            'classifier': self.classifier,
+            'count_elements': self.metrics is not None,
+            'inputs': {name: getattr(self, name) for name in self.PASS_INPUTS[pass_name]},
         }
-        # Vsys-Check
-        for tag, result in tag_lookup.items():
-            if tags.get(tag) == 'yes':
-                return result[0], result[1]
-        # bus_stop check
-        if tags.get('highway') == 'bus_stop':
-            return 'bus', 'bus'
-        # platform check
-        for tag, result in {'railway': ['rail', 'railway_platform'], 'highway': ['bus', 'highway_platform']}.items():
-            if tags.get(tag) == 'platform':
-                return result[0], result[1]
-
-        return 'unknown', 'unknown'
+        self.handler_counts = {}
+        self.__shards_done = 0
+        self.__shards_total = sum(end - start for start, end in shards)
+        with multiprocessing.Pool(self.workers, initializer=_init_shard_worker, initargs=(context,)) as pool:
+            # imap returns the results in shard order, which keeps the merge deterministic
+            for shard_range, shard_result in zip(shards, pool.imap(_process_shard, shards)):
+                self.__merge_shard_result(pass_name, shard_result)
+                self.__shards_done += shard_range[1] - shard_range[0]
+
+    def __merge_shard_result(self, pass_name, shard_result):
+        """Merge the partial results of a shard into the storage as if the shard had been processed serially."""
+        for action, key, value in shard_result['stop_data']:
+            if action == 'set':
+                self.stop_data[key] = value
+            else:
+                self.stop_data[key]['osm_node_refs'].extend(value)
+        for name in self.PASS_OUTPUTS[pass_name]:
+            partial = shard_result[name]
+            if name == 'putline_elems':
+                # Same rule as in RelationHandlerRoutes: the first route with the highest priority (min value) wins
+                for ref, info in partial.items():
+                    if ref not in self.putline_elems or self.putline_elems[ref]['service_priority'] > info['service_priority']:
+                        self.putline_elems[ref] = info
+            elif name == 'relation_way_refs':
+                for way_id, relation_ids in partial.items():
+                    self.relation_way_refs.setdefault(way_id, []).extend(relation_ids)
+            else:
+                getattr(self, name).update(partial)
+        for handler, counts in shard_result['handler_counts'].items():
+            total = self.handler_counts.setdefault(handler, dict.fromkeys(counts, 0))
+            for kind, count in counts.items():
+                total[kind] = total[kind] + count if count is not None and total[kind] is not None else None
 
-    @staticmethod
-    def check_station_service_from_element_tags(tags):
-        if tags.get('station') in ['train', 'subway', 'light_rail', 'monorail', 'funicular']:
-            return 'rail', tags.get('station')
-        elif tags.get('bus') == 'yes':
-            return 'bus', 'bus'
-        return 'rail', tags.get('railway')
-
-    # TODO: This is not the actual centroid, just the mean of all involved vertices. Most likely within the area but not at the real centroid! See calculate_centroid_vectorized for possible np function to calculate from locations
     def compute_centroids(self):
-        """ Compute centroids for ways and relations after node processing. """
-        for stop_id, stop_info in self.stop_data.items():
-            if stop_info['osm_object_type'] == 'relation' or stop_info['osm_object_type'] == 'way':
-                node_coords = []
-
-                # Collect node coordinates from relation's or way's node references
-                for node_ref in stop_info.get('osm_node_refs', []):
-                    if node_ref in self.nodes_coords:
-                        node_coords.append(self.nodes_coords[node_ref])
-
-                # for way_ref in stop_info.get('way_refs', []):
-                #     if way_ref in self.way_node_refs:
-                #         for node_ref in self.way_node_refs[way_ref]:
-                #             if node_ref in self.nodes_coords:
-                #                 node_coords.append(self.nodes_coords[node_ref])
-
-                # Calculate the centroid for this relation or way
-                if node_coords:
-                    centroid_lat, centroid_lon = self.__compute_centroid(node_coords)
-                    stop_info['lat'] = centroid_lat
-                    stop_info['lon'] = centroid_lon
+        """
+        Compute centroids for ways and relations after node processing.
+        The node refs of all ways and relations are packed into CSR arrays and the centroids are computed in one
+        vectorized pass by compute_centroids_csr(). Node refs without coordinates are ignored.
+        """
+        stop_keys = [key for key, stop_info in self.stop_data.items() if stop_info['osm_object_type'] == 'relation' or stop_info['osm_object_type'] == 'way']
+        stops = [self.stop_data[key] for key in stop_keys]
+        node_refs_lists = [stop_info.get('osm_node_refs', []) for stop_info in stops]
+        lengths = np.fromiter((len(node_refs) for node_refs in node_refs_lists), dtype=np.int64, count=len(stops))
+        offsets = np.zeros(len(stops) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        node_refs = np.fromiter(itertools.chain.from_iterable(node_refs_lists), dtype=np.int64, count=offsets[-1])
 
-    @staticmethod
-    def __compute_centroid(coords):
-        """ Compute the centroid of a list of (lat, lon) coordinates. """
-        if not coords:
-            return None, None
-        lat_sum = sum(coord[0] for coord in coords)
-        lon_sum = sum(coord[1] for coord in coords)
-        count = len(coords)
-        return (lat_sum / count, lon_sum / count)
-
-    # def calculate_centroid_vectorized(nodes):
-    #     # Extract coordinates into numpy arrays for efficient vector operations
-    #     coords = np.array([(node.location.x, node.location.y) for node in nodes])
-    #
-    #     x = coords[:, 0]
-    #     y = coords[:, 1]
-    #
-    #     # Shift the coordinates for vectorized cross-product calculation
-    #     x_shift = np.roll(x, -1)
-    #     y_shift = np.roll(y, -1)
-    #
-    #     # Compute area (A) and the centroids
-    #     cross = x * y_shift - x_shift * y
-    #     A = np.sum(cross) / 2.0
-    #     Cx = np.sum((x + x_shift) * cross) / (6.0 * A)
-    #     Cy = np.sum((y + y_shift) * cross) / (6.0 * A)
-    #
-    #     return Cx, Cy
+        centroid_lat, centroid_lon = compute_centroids_csr(offsets, node_refs, *self.nodes_coords.to_arrays())
+        for stop_info, lat, lon in zip(stops, centroid_lat.tolist(), centroid_lon.tolist()):
+            # NaN if none of the nodes has coordinates
+            if lat == lat:
+                stop_info['lat'] = lat
+                stop_info['lon'] = lon
+
+    def filter_region(self):
+        """
+        Remove ways and relations whose centroid (see compute_centroids()) is outside the region or that have no
+        coordinates. Until then they are kept with all their nodes, because their centroid needs all of them. Nodes
+        outside the region are never stored as stops by the node pass. Does nothing without a region.
+        get_result_columns() runs it if it hasn't run yet, so ways and relations outside the region never get into the results.
+        """
+        self.region_filtered = True
+        if self.region is None:
+            return
+        stop_keys = [key for key, stop_info in self.stop_data.items() if stop_info['osm_object_type'] == 'relation' or stop_info['osm_object_type'] == 'way']
+        lat = np.fromiter((self.stop_data[key].get('lat', np.nan) for key in stop_keys), dtype=np.float64, count=len(stop_keys))
+        lon = np.fromiter((self.stop_data[key].get('lon', np.nan) for key in stop_keys), dtype=np.float64, count=len(stop_keys))
+        inside = self.region.contains_many(lon, lat)
+        for key in itertools.compress(stop_keys, ~inside):
+            del self.stop_data[key]
 
     def add_info_stoparea_putline(self):
         # Iterate over the dictionary and update names and putline info
         # lookup the stoparea name based on node_id and replace if not 'N/A'
-        for obj_id, info in self.stop_data.items():
-            if obj_id in self.stoparea_elems and self.stoparea_elems[obj_id] != 'N/A':
+        # All three dicts are keyed by osm_key(type, ID), so nodes, ways and relations with the same ID don't mix up
+        for obj_key, info in self.stop_data.items():
+            if obj_key in self.stoparea_elems and self.stoparea_elems[obj_key] != 'N/A':
                 info['is_in_osm_stoparea'] = True
-                info['osm_stoparea_name'] = self.stoparea_elems[obj_id]
+                info['osm_stoparea_name'] = self.stoparea_elems[obj_key]
             else:
                 info['is_in_osm_stoparea'] = False
-            if obj_id in self.putline_elems:
-                # TODO: nodes, ways und relations haben ihre eigenen ID-Reihen sind also nicht global eindeutig. Das könnte zu Problemen führen und eine Typenunterscheidung erfordern
-                if info["osm_object_type"] == self.putline_elems[obj_id]["osm_object_type"]:
-                    info["is_in_osm_route"] = True
-                    info["osm_route_type"] = self.putline_elems[obj_id]["osm_route_type"]
-                    info["osm_service_type"] = self.putline_elems[obj_id]["osm_service_type"]
-                    info["service_priority"] = self.putline_elems[obj_id]["service_priority"]
+            if obj_key in self.putline_elems:
+                info["is_in_osm_route"] = True
+                info["osm_route_type"] = self.putline_elems[obj_key]["osm_route_type"]
+                info["osm_service_type"] = self.putline_elems[obj_key]["osm_service_type"]
+                info["service_priority"] = self.putline_elems[obj_key]["service_priority"]
             else:
                 info["is_in_osm_route"] = False
 
+    def get_result_columns(self, release=False):
+        """
+        Return the processed stop data (including centroids) as ResultColumns. Runs filter_region() if it hasn't run yet.
+        :param release: Remove each record from stop_data once it is converted, so the records and the columns don't
+                        both exist in full (stop_data is empty afterwards)
+        """
+        if not self.region_filtered:
+            self.filter_region()
+        if release:
+            return ResultColumns.from_records(self.stop_data.pop(key) for key in list(self.stop_data))
+        return ResultColumns.from_records(self.stop_data.values())
+
     def get_results(self):
         """ Return the processed stop data (including centroids). """
-        # Convert to DataFrame
-        results_df = pd.DataFrame.from_dict(self.stop_data, orient='index')
-        results_df = results_df[["osm_id", "osm_object_type", "osm_name", "lat", "lon", "osm_way_refs", "osm_node_refs", "osm_public_transport", "osm_railway", "is_in_osm_stoparea", "osm_stoparea_name", "is_in_osm_route", "osm_route_type", "osm_service_type", "service_priority", "general_type", "specific_type"]]
-        return results_df
+        return self.get_result_columns().to_dataframe()
+
+    def get_region_result_columns(self, results=None):
+        """
+        Split the results by the regions of the RegionSet the extractor was created with. A stop is part of the results
+        of every region containing it.
+        :param results: ResultColumns to split (e.g. with added columns), by default get_result_columns()
+        :return: Dict of region name -> ResultColumns
+        """
+        if not isinstance(self.region, RegionSet):
+            raise ValueError('Splitting the results by region requires an extractor created with a RegionSet.')
+        results = self.get_result_columns() if results is None else results
+        assignment = self.region.assign_many(results.frame['lon'].to_numpy(), results.frame['lat'].to_numpy())
+        return {name: results.take(rows) for name, rows in assignment.items()}
+
+
+class _ElementCounter:
+    """Handler counting the objects read, passed to osmium.apply() before the extractor's handlers."""
+    def __init__(self):
+        self.nodes = 0
+        self.ways = 0
+        self.relations = 0
+
+    def node(self, n):
+        self.nodes += 1
+
+    def way(self, w):
+        self.ways += 1
+
+    def relation(self, r):
+        self.relations += 1
+
+
+class _StopDataLog(dict):
+    """
+    stop_data of a shard worker. Records every assignment and every extension of node refs of stops stored in
+    previous shards, so the parent process can replay them in file order and ends up with the same stop_data as a serial run.
+    """
+    def __init__(self):
+        super().__init__()
+        self.log = []
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.log.append(('set', key, value))
+
+    def __missing__(self, key):
+        # Stop stored by a previous shard (e.g. a relation extended by its ways), collect the node refs to append
+        value = {'osm_node_refs': []}
+        super().__setitem__(key, value)
+        self.log.append(('extend', key, value['osm_node_refs']))
+        return value
+
+
+def _read_varint(buffer, pos):
+    """Decode a protobuf varint starting at pos and return the value and the position after it."""
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return result, pos
+
+
+def _scan_pbf_blocks(osm_file):
+    """
+    Return the blocks of a PBF file as a list of (blob type, start byte, end byte).
+    Each block is a 4 byte length, a BlobHeader (protobuf with the blob type in field 1 and the blob size in field 3)
+    and the blob. Only the BlobHeaders are decoded, the blobs are skipped.
+    """
+    blocks = []
+    with open(osm_file, 'rb') as f:
+        start = 0
+        while True:
+            length_bytes = f.read(4)
+            if len(length_bytes) < 4:
+                break
+            header_length = struct.unpack('>I', length_bytes)[0]
+            header = f.read(header_length)
+            blob_type = None
+            blob_size = 0
+            pos = 0
+            while pos < header_length:
+                key, pos = _read_varint(header, pos)
+                field, wire_type = key >> 3, key & 0x07
+                if wire_type == 2:
+                    value_length, pos = _read_varint(header, pos)
+                    if field == 1:
+                        blob_type = header[pos:pos + value_length].decode()
+                    pos += value_length
+                else:
+                    value, pos = _read_varint(header, pos)
+                    if field == 3:
+                        blob_size = value
+            f.seek(blob_size, 1)
+            end = start + 4 + header_length + blob_size
+            blocks.append((blob_type, start, end))
+            start = end
+    return blocks
+
+
+_shard_context = {}
+
+
+def _init_shard_worker(context):
+    """Store the pass context (file, pass settings and the storage read by the pass) once per worker process."""
+    _shard_context.update(context)
+
+
+def _process_shard(shard_range):
+    """
+    Run a pass on the header block and the data blocks within shard_range of the PBF file.
+    :param shard_range: (start byte, end byte) of a contiguous range of data blocks
+    :return: Dict with the stop_data log and the storage written by the pass
+    """
+    with open(_shard_context['osm_file'], 'rb') as f:
+        header_start, header_end = _shard_context['header_range']
+        f.seek(header_start)
+        buffer = f.read(header_end - header_start)
+        f.seek(shard_range[0])
+        buffer += f.read(shard_range[1] - shard_range[0])
+    pass_name = _shard_context['pass_name']
+    extractor = PublicTransportStopExtractor(osmium.io.FileBuffer(buffer, 'pbf'), pass_plan=_shard_context['pass_plan'], region=_shard_context['region'],
+                                            classifier=_shard_context['classifier'], metrics=Metrics() if _shard_context['count_elements'] else None)
+    for name, value in _shard_context['inputs'].items():
+        setattr(extractor, name, value)
+    extractor.stop_data = _StopDataLog()
+    extractor.run_serial_pass(pass_name)
+    shard_result = {name: getattr(extractor, name) for name in PublicTransportStopExtractor.PASS_OUTPUTS[pass_name]}
+    shard_result['stop_data'] = extractor.stop_data.log
+    shard_result['handler_counts'] = extractor.handler_counts
+    return shard_result
 
 
 if __name__ == '__main__':
@@ -403,9 +1756,50 @@ if __name__ == '__main__':
 
     working_dir = pathlib.Path.cwd()
 
-    osm_file_path = working_dir / '20250218_all_stuttgart_Untersuchungsraum.osm.pbf'
+    parser = argparse.ArgumentParser(description='Extract PuT stops from an OSM file.')
+    parser.add_argument('--no-cache', action='store_true', help='Neither read nor write the stage cache')
+    parser.add_argument('--clear-cache', action='store_true', help='Delete all entries of the stage cache before running')
+    parser.add_argument('--cache-dir', default=working_dir / '.stop_cache', type=pathlib.Path, help='Directory of the stage cache')
+    parser.add_argument('--cache-max-mb', default=2048, type=int, help='Size limit of the stage cache in MB')
+    parser.add_argument('--cache-full-hash', action='store_true', help='Detect changes of the input file by hashing all of it instead of samples and its modification time')
+    parser.add_argument('--output', default='M30_put_stops_processed.csv', help='Output file, .csv, .parquet or .gpkg')
+    parser.add_argument('--osm-file', default=working_dir / '20250218_all_stuttgart_Untersuchungsraum.osm.pbf', type=pathlib.Path, help='Input OSM file')
+    parser.add_argument('--cluster-distance', type=float, help='Group platforms and stop_positions without stop_area relation into synthetic stop areas, '
+                                                                'with this maximal distance in meters between neighboring stops')
+    region_group = parser.add_mutually_exclusive_group()
+    region_group.add_argument('--region', help='Only extract stops inside this region: GeoJSON file with (multi)polygons or a bounding box min_lon,min_lat,max_lon,max_lat')
+    region_group.add_argument('--regions', help='Extract several regions in one run: GeoJSON file with one (multi)polygon feature per region, named by the property "name". '
+                                                'One output file per region is written, named like --output with the region name appended.')
+    parser.add_argument('--metrics', type=pathlib.Path, help='Write metrics of the run (durations, bytes read, peak memory, handler counts, index sizes) '
+                                                             'to this file, in the Prometheus text format for .prom files and as JSON otherwise')
+    parser.add_argument('--progress-interval', type=float, help='Log the progress of the running pass with throughput and ETA every this many seconds')
+    parser.add_argument('--workers', default=1, type=int, help='Number of worker processes, more than one splits every pass by PBF block ranges (PBF files only)')
+    args = parser.parse_args()
+
+    # The cache (and its directory) is only created if it is used or cleared
+    stage_cache = None
+    if not args.no_cache or args.clear_cache:
+        stage_cache = StageCache(args.cache_dir, args.cache_max_mb * 1024 ** 2, args.cache_full_hash)
+    if args.clear_cache:
+        stage_cache.clear()
+
+    region = None
+    if args.region is not None:
+        region = Region.from_bbox(*map(float, args.region.split(','))) if args.region.count(',') == 3 else Region.from_geojson(args.region)
+    elif args.regions is not None:
+        # Invalid region names are rejected here, before any output file is written
+        try:
+            region = RegionSet.from_geojson(args.regions)
+        except ValueError as error:
+            parser.error(f'--regions: {error}')
+
+    # Metrics are only collected if they are written or progress is logged
+    metrics = Metrics(args.progress_interval) if args.metrics is not None or args.progress_interval is not None else None
+
+    osm_file_path = args.osm_file
     # Pass the file path directly when creating an instance of the class
-    extractor = PublicTransportStopExtractor(osm_file_path)
+    extractor = PublicTransportStopExtractor(osm_file_path, workers=args.workers, cache=None if args.no_cache else stage_cache, region=region,
+                                            metrics=metrics)
 
     # Process the OSM file in sequence:
 
@@ -432,10 +1826,16 @@ if __name__ == '__main__':
 
     logger.info('Postprocessing data...')
     # After processing, compute centroids for relations and ways using node coordinates.
-    extractor.compute_centroids()
+    with extractor.measure('compute_centroids'):
+        extractor.compute_centroids()
+
+    # Ways and relations outside the region are only dropped now, their centroids need all their nodes
+    with extractor.measure('filter_region'):
+        extractor.filter_region()
 
     # If possible add the name from the stoparea relations for later aggragation (in QGIS)
-    extractor.add_info_stoparea_putline()
+    with extractor.measure('add_info_stoparea_putline'):
+        extractor.add_info_stoparea_putline()
 
     # Column descriptions for results_df:
     # 'name': Name of the public transport stop or station. If not available, defaults to 'N/A'.
@@ -450,18 +1850,31 @@ if __name__ == '__main__':
     # 'is_in_route': Boolean indicating if the stop is part of a public transport route relation (True if in a route, False otherwise).
     # 'route_type': Type of the route the stop belongs to (e.g., 'train', 'bus', etc.), if applicable.
     # 'service_priority': Priority of the public transport service type (for train routes, based on service type like high-speed, regional, etc.).
-    results_df = extractor.get_results()
-
-    # temporary processing of information
-    # 1) Create 'name' column from stopareas and fill with osm_name if stoparea is na
-    results_df["name"] = results_df["osm_stoparea_name"].fillna(results_df["osm_name"])
-    # 2) Update 'general_type' if unknown with mapped values from 'osm_route_type'
-    type_map = {"train": "rail", "light_rail": "rail", "tram": "rail", "funicular": "rail", "bus": "bus", "coach": "bus", "trolleybus": "bus"}
-    results_df['general_type'] = results_df.apply(lambda row: type_map.get(row['osm_route_type'], 'unknown') if row['general_type'] == 'unknown' else row['general_type'], axis=1)
-    # 3) Update 'specific_type' from 'osm_route_type' and 'general_type'
-    results_df['specific_type'] = results_df["osm_route_type"].fillna(results_df["general_type"])
-
-    # Write the DataFrame to a CSV file
-    csv_file_raw = "M30_put_stops_processed.csv"
-    results_df.to_csv(csv_file_raw, index=False)
-    logger.info(f'CSV file with extracted PuT data created successfully: {working_dir / csv_file_raw}')
+    with extractor.measure('get_results'):
+        results = extractor.get_result_columns(release=True)
+    results_df = results.frame
+
+    # temporary processing of information: name, general_type and specific_type (see add_names_and_route_types)
+    add_names_and_route_types(results_df, extractor.classifier.route_general_types)
+
+    # Synthetic stop areas for stops without stop_area relation, their name is used if there is no stoparea name
+    if args.cluster_distance is not None:
+        with extractor.measure('cluster_stops'):
+            add_synthetic_stop_areas(results, args.cluster_distance)
+        results_df['name'] = results_df['osm_stoparea_name'].fillna(results_df['synthetic_stoparea_name']).fillna(results_df['osm_name'])
+
+    # Write the results (format from the file extension: csv, parquet or gpkg)
+    with extractor.measure('write_output'):
+        if args.regions is not None:
+            output = pathlib.Path(args.output)
+            for region_name, region_results in extractor.get_region_result_columns(results).items():
+                region_output = output.with_name(f'{output.stem}_{region_name}{output.suffix}')
+                region_results.write(region_output)
+                logger.info(f'File with extracted PuT data of region {region_name} ({len(region_results)} stops) created successfully: {working_dir / region_output}')
+        else:
+            results.write(args.output)
+            logger.info(f'File with extracted PuT data created successfully: {working_dir / args.output}')
+
+    if args.metrics is not None:
+        metrics.write(args.metrics)
+        logger.info(f'Metrics written to {args.metrics}.')
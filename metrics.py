@@ -0,0 +1,156 @@
+import contextlib
+import datetime
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+
+
+def bytes_read():
+    """Bytes read by the process so far (rchar of /proc/self/io, including all threads) or None if not available."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process or of its largest child process (e.g. a worker), in bytes."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _escape_label_value(value):
+    """Escape backslashes, double quotes and line feeds of a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_duration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+class Metrics:
+    """
+    Metrics of an extraction run: duration, bytes read and peak memory of each stage, element counts of the handlers
+    and the sizes of the extractor's indexes.
+
+    An extractor without Metrics doesn't collect anything beyond a few counters of the handlers. With Metrics, every
+    stage is measured and, with a progress interval, a background thread logs the progress of the running stage
+    with throughput and ETA, so the handlers' hot paths are never involved.
+    """
+    PROMETHEUS_PREFIX = 'osm_put_stop_extractor'
+
+    def __init__(self, progress_interval=None):
+        """
+        :param progress_interval: Seconds between progress messages of a running stage, None to log no progress
+        """
+        self.progress_interval = progress_interval
+        self.stages = {}
+        self.index_sizes = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage, progress=None):
+        """
+        Measure a stage (e.g. a pass over the file). The record of the stage is yielded, so the caller can add
+        entries (e.g. handler counts).
+        :param stage: Name of the stage
+        :param progress: Optional callable returning (bytes done, total bytes) of the stage, used for the progress
+                         messages. Without it, the bytes read by the process are reported.
+        """
+        start_bytes = bytes_read()
+        if progress is None and start_bytes is not None:
+            progress = lambda: (bytes_read() - start_bytes, None)
+        record = self.stages[stage] = {}
+        start = time.perf_counter()
+        stop = threading.Event()
+        reporter = None
+        if self.progress_interval is not None:
+            reporter = threading.Thread(target=self.__report_progress, args=(stage, start, progress, stop), daemon=True)
+            reporter.start()
+        try:
+            yield record
+        finally:
+            stop.set()
+            if reporter is not None:
+                reporter.join()
+            record['seconds'] = time.perf_counter() - start
+            if progress is not None:
+                record['bytes_read'] = progress()[0]
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            logging.info(f'{stage} took {record["seconds"]:.1f} s, peak RSS {record["peak_rss_bytes"] / 1024 ** 2:.0f} MB.')
+
+    def __report_progress(self, stage, start, progress, stop):
+        """Log the progress of a stage every progress_interval seconds until stop is set."""
+        while not stop.wait(self.progress_interval):
+            elapsed = time.perf_counter() - start
+            message = f'{stage}: running for {_format_duration(elapsed)}'
+            if progress is not None:
+                done, total = progress()
+                throughput = done / elapsed / 1024 ** 2
+                if total:
+                    eta = (total - done) / (done / elapsed) if done else float('inf')
+                    message += (f', {done / 1024 ** 2:.0f} of {total / 1024 ** 2:.0f} MB ({done / total:.0%}), {throughput:.1f} MB/s, '
+                                f'ETA {_format_duration(eta) if eta != float("inf") else "unknown"}')
+                else:
+                    message += f', {done / 1024 ** 2:.0f} MB read, {throughput:.1f} MB/s'
+            logging.info(message)
+
+    def record_index_sizes(self, sizes):
+        """Store the current sizes of the extractor's indexes (dict of name -> number of entries)."""
+        self.index_sizes = dict(sizes)
+
+    def to_dict(self):
+        return {'stages': self.stages, 'index_sizes': self.index_sizes, 'peak_rss_bytes': peak_rss_bytes()}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format (e.g. for the node exporter's textfile collector)."""
+        prefix = self.PROMETHEUS_PREFIX
+        metrics = {
+            'stage_seconds': ('gauge', 'Duration of an extraction stage', []),
+            'stage_bytes_read': ('gauge', 'Bytes read during an extraction stage', []),
+            'stage_peak_rss_bytes': ('gauge', 'Peak resident set size at the end of an extraction stage', []),
+            'stage_cached': ('gauge', 'Whether the results of a pass were loaded from the stage cache', []),
+            'handler_elements': ('gauge', 'Elements seen, candidates matched and stops stored by a handler', []),
+            'index_size': ('gauge', 'Number of entries of an index of the extractor', []),
+            'peak_rss_bytes': ('gauge', 'Peak resident set size of the process or of its largest worker', []),
+        }
+        for stage, record in self.stages.items():
+            metrics['stage_seconds'][2].append(({'stage': stage}, record['seconds']))
+            if record.get('bytes_read') is not None:
+                metrics['stage_bytes_read'][2].append(({'stage': stage}, record['bytes_read']))
+            metrics['stage_peak_rss_bytes'][2].append(({'stage': stage}, record['peak_rss_bytes']))
+            if 'cached' in record:
+                metrics['stage_cached'][2].append(({'stage': stage}, int(record['cached'])))
+            for handler, counts in record.get('handlers', {}).items():
+                for kind, count in counts.items():
+                    if count is not None:
+                        metrics['handler_elements'][2].append(({'stage': stage, 'handler': handler, 'kind': kind}, count))
+        for index, size in self.index_sizes.items():
+            metrics['index_size'][2].append(({'index': index}, size))
+        metrics['peak_rss_bytes'][2].append(({}, peak_rss_bytes()))
+
+        lines = []
+        for name, (metric_type, description, samples) in metrics.items():
+            if not samples:
+                continue
+            lines.append(f'# HELP {prefix}_{name} {description}')
+            lines.append(f'# TYPE {prefix}_{name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape_label_value(label)}"' for key, label in labels.items())
+                lines.append(f'{prefix}_{name}{{{label_text}}} {value}' if label_text else f'{prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to a file, in the Prometheus text format for .prom files and as JSON otherwise."""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus() if str(path).endswith('.prom') else self.to_json())
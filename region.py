@@ -0,0 +1,241 @@
+import hashlib
+import json
+import re
+
+import numpy as np
+
+
+class Region:
+    """
+    Region of interest given by one or more polygons (with holes) in lon/lat.
+
+    Point-in-polygon tests use a prepared grid over the bounding box of the region: cells entirely inside or outside the
+    region answer directly, only points in cells crossed by the boundary are tested against the edges overlapping their
+    grid row (even-odd rule, so holes and multipolygons need no special handling).
+    """
+    def __init__(self, polygons, grid_size=128):
+        """
+        :param polygons: List of polygons, each a list of rings (outer ring first, then holes), each ring a list of (lon, lat)
+        :param grid_size: Number of grid cells per axis
+        """
+        all_edges = []
+        for polygon in polygons:
+            for ring in polygon:
+                ring = [tuple(map(float, point)) for point in ring]
+                if ring[0] != ring[-1]:
+                    ring.append(ring[0])
+                all_edges.extend((x1, y1, x2, y2) for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]))
+        # Horizontal edges never cross the horizontal ray of the exact test, but they still bound grid cells
+        edges = [edge for edge in all_edges if edge[1] != edge[3]]
+        if not edges:
+            raise ValueError('The region needs at least one polygon with a non-zero area.')
+        self.edges = np.array(edges, dtype=np.float64)
+        x = self.edges[:, [0, 2]]
+        y = self.edges[:, [1, 3]]
+        self.min_lon, self.max_lon = x.min(), x.max()
+        self.min_lat, self.max_lat = y.min(), y.max()
+        self.grid_size = grid_size
+        self.cell_width = (self.max_lon - self.min_lon) / grid_size or 1.0
+        self.cell_height = (self.max_lat - self.min_lat) / grid_size or 1.0
+
+        # Edges overlapping each grid row, used for the exact test
+        row_min = self.__rows(y.min(axis=1))
+        row_max = self.__rows(y.max(axis=1))
+        self.row_edges = [[] for _ in range(grid_size)]
+        for edge_index, (first_row, last_row) in enumerate(zip(row_min.tolist(), row_max.tolist())):
+            for row in range(first_row, last_row + 1):
+                self.row_edges[row].append(edge_index)
+        self.row_edges = [np.array(indices, dtype=np.int64) for indices in self.row_edges]
+        self.row_edge_tuples = [[tuple(edge) for edge in self.edges[indices].tolist()] for indices in self.row_edges]
+
+        # Cell states: 1 inside, 0 outside, -1 crossed by the boundary
+        boundary = np.zeros((grid_size, grid_size), dtype=bool)
+        for x1, y1, x2, y2 in all_edges:
+            # Mark the cells of the bounding box of each edge, a cheap superset of the cells the edge crosses
+            boundary[self.__rows(min(y1, y2)):self.__rows(max(y1, y2)) + 1, self.__columns(min(x1, x2)):self.__columns(max(x1, x2)) + 1] = True
+        rows, columns = np.nonzero(~boundary)
+        centers_lon = self.min_lon + (columns + 0.5) * self.cell_width
+        centers_lat = self.min_lat + (rows + 0.5) * self.cell_height
+        self.cells = np.full((grid_size, grid_size), -1, dtype=np.int8)
+        self.cells[rows, columns] = self.__contains_exact(centers_lon, centers_lat, rows)
+
+    @classmethod
+    def from_geojson(cls, path, **kwargs):
+        """Create a region from a GeoJSON file with Polygon/MultiPolygon geometries (geometry, Feature or FeatureCollection)."""
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(_geojson_polygons(data), **kwargs)
+
+    @classmethod
+    def from_bbox(cls, min_lon, min_lat, max_lon, max_lat, **kwargs):
+        """Create a rectangular region from a bounding box."""
+        return cls([[[(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat)]]], **kwargs)
+
+    def fingerprint(self):
+        """Hash of the region's edges, e.g. for cache keys."""
+        return hashlib.sha256(self.edges.tobytes()).hexdigest()
+
+    def __rows(self, lat):
+        return np.clip(((np.asarray(lat) - self.min_lat) / self.cell_height).astype(np.int64), 0, self.grid_size - 1)
+
+    def __columns(self, lon):
+        return np.clip(((np.asarray(lon) - self.min_lon) / self.cell_width).astype(np.int64), 0, self.grid_size - 1)
+
+    def __contains_exact(self, lon, lat, rows):
+        """Even-odd test of points against the edges of their grid rows."""
+        inside = np.zeros(len(lon), dtype=bool)
+        for row in np.unique(rows).tolist():
+            points = np.flatnonzero(rows == row)
+            edges = self.edges[self.row_edges[row]]
+            if not len(edges):
+                continue
+            x1, y1, x2, y2 = (edges[:, i][None, :] for i in range(4))
+            px = lon[points][:, None]
+            py = lat[points][:, None]
+            crosses = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+            inside[points] = crosses.sum(axis=1) % 2 == 1
+        return inside
+
+    def contains_many(self, lon, lat):
+        """Return a boolean array which of the points (arrays of lon and lat) are inside the region, NaN coordinates are outside."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            in_bbox = (lon >= self.min_lon) & (lon <= self.max_lon) & (lat >= self.min_lat) & (lat <= self.max_lat)
+        result = np.zeros(len(lon), dtype=bool)
+        candidates = np.flatnonzero(in_bbox)
+        rows = self.__rows(lat[candidates])
+        states = self.cells[rows, self.__columns(lon[candidates])]
+        result[candidates] = states == 1
+        boundary = states == -1
+        result[candidates[boundary]] = self.__contains_exact(lon[candidates[boundary]], lat[candidates[boundary]], rows[boundary])
+        return result
+
+    def contains(self, lon, lat):
+        """Return whether a single point is inside the region."""
+        if not (self.min_lon <= lon <= self.max_lon and self.min_lat <= lat <= self.max_lat):
+            return False
+        row = min(int((lat - self.min_lat) / self.cell_height), self.grid_size - 1)
+        state = self.cells[row, min(int((lon - self.min_lon) / self.cell_width), self.grid_size - 1)]
+        if state != -1:
+            return bool(state)
+        inside = False
+        for x1, y1, x2, y2 in self.row_edge_tuples[row]:
+            if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+
+class RegionSet:
+    """
+    Set of named regions which can be used like a single Region (covering all of them) and assigns points to every
+    region containing them.
+
+    A grid over the bounding box of all regions is the spatial index: each cell knows the regions whose bounding box
+    overlaps it, so a point is only tested against the polygons of those regions.
+    """
+    def __init__(self, regions, grid_size=64):
+        """
+        :param regions: Dict of region name -> Region
+        :param grid_size: Number of index grid cells per axis
+        """
+        if not regions:
+            raise ValueError('A region set needs at least one region.')
+        self.names = list(regions)
+        self.regions = list(regions.values())
+        self.min_lon = min(region.min_lon for region in self.regions)
+        self.max_lon = max(region.max_lon for region in self.regions)
+        self.min_lat = min(region.min_lat for region in self.regions)
+        self.max_lat = max(region.max_lat for region in self.regions)
+        self.grid_size = grid_size
+        self.cell_width = (self.max_lon - self.min_lon) / grid_size or 1.0
+        self.cell_height = (self.max_lat - self.min_lat) / grid_size or 1.0
+        # cell_regions[row * grid_size + column, i]: bounding box of region i overlaps the cell
+        self.cell_regions = np.zeros((grid_size, grid_size, len(self.regions)), dtype=bool)
+        for i, region in enumerate(self.regions):
+            rows = self.__cells(np.array([region.min_lat, region.max_lat]), self.min_lat, self.cell_height)
+            columns = self.__cells(np.array([region.min_lon, region.max_lon]), self.min_lon, self.cell_width)
+            self.cell_regions[rows[0]:rows[1] + 1, columns[0]:columns[1] + 1, i] = True
+        self.cell_regions = self.cell_regions.reshape(grid_size * grid_size, len(self.regions))
+        self.cell_region_indices = [tuple(np.flatnonzero(cell).tolist()) for cell in self.cell_regions]
+
+    @classmethod
+    def from_geojson(cls, path, name_property='name', **kwargs):
+        """
+        Create a region set from a GeoJSON FeatureCollection with one (multi)polygon feature per region.
+        Features with the same name form one region, features without the name property are named by their index.
+        The names become part of file names: path separators and characters not allowed in file names are replaced by
+        '_', names that only collide after that (or in case) get a suffix '_2', '_3', ... Names that are empty after
+        that raise a ValueError.
+        """
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        polygons = {}
+        names = {}
+        for i, feature in enumerate(data['features']):
+            raw_name = str((feature.get('properties') or {}).get(name_property, i))
+            if raw_name not in names:
+                names[raw_name] = _unique_file_name(raw_name, {name.casefold() for name in names.values()})
+            polygons.setdefault(names[raw_name], []).extend(_geojson_polygons(feature))
+        return cls({name: Region(region_polygons) for name, region_polygons in polygons.items()}, **kwargs)
+
+    def fingerprint(self):
+        """Hash of the names and edges of all regions, e.g. for cache keys."""
+        return hashlib.sha256(''.join(f'{name}:{region.fingerprint()};' for name, region in zip(self.names, self.regions)).encode()).hexdigest()
+
+    def __cells(self, values, minimum, cell_size):
+        return np.clip(((values - minimum) / cell_size).astype(np.int64), 0, self.grid_size - 1)
+
+    def assign_many(self, lon, lat):
+        """Return a dict of region name -> positions of the points (arrays of lon and lat) inside the region."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            in_bbox = (lon >= self.min_lon) & (lon <= self.max_lon) & (lat >= self.min_lat) & (lat <= self.max_lat)
+        candidates = np.flatnonzero(in_bbox)
+        cells = self.__cells(lat[candidates], self.min_lat, self.cell_height) * self.grid_size + self.__cells(lon[candidates], self.min_lon, self.cell_width)
+        assignment = {}
+        for i, (name, region) in enumerate(zip(self.names, self.regions)):
+            region_candidates = candidates[self.cell_regions[cells, i]]
+            assignment[name] = region_candidates[region.contains_many(lon[region_candidates], lat[region_candidates])]
+        return assignment
+
+    def contains_many(self, lon, lat):
+        """Return a boolean array which of the points are inside any of the regions."""
+        inside = np.zeros(len(lon), dtype=bool)
+        for positions in self.assign_many(lon, lat).values():
+            inside[positions] = True
+        return inside
+
+    def contains(self, lon, lat):
+        """Return whether a single point is inside any of the regions."""
+        if not (self.min_lon <= lon <= self.max_lon and self.min_lat <= lat <= self.max_lat):
+            return False
+        row = min(int((lat - self.min_lat) / self.cell_height), self.grid_size - 1)
+        column = min(int((lon - self.min_lon) / self.cell_width), self.grid_size - 1)
+        return any(self.regions[i].contains(lon, lat) for i in self.cell_region_indices[row * self.grid_size + column])
+
+
+def _unique_file_name(name, used):
+    """Return name usable as part of a file name and not in used (casefolded names)."""
+    file_name = re.sub(r'[\x00-\x1f<>:"/\\|?*]', '_', name).strip(' .')
+    if not file_name:
+        raise ValueError(f'Region name {name!r} cannot be used in a file name.')
+    unique_name, number = file_name, 1
+    while unique_name.casefold() in used:
+        number += 1
+        unique_name = f'{file_name}_{number}'
+    return unique_name
+
+
+def _geojson_polygons(data):
+    """Return the polygons (lists of rings) of a GeoJSON object."""
+    if data['type'] == 'FeatureCollection':
+        return [polygon for feature in data['features'] for polygon in _geojson_polygons(feature)]
+    if data['type'] == 'Feature':
+        return _geojson_polygons(data['geometry'])
+    if data['type'] == 'Polygon':
+        return [data['coordinates']]
+    if data['type'] == 'MultiPolygon':
+        return data['coordinates']
+    raise ValueError(f'Unsupported GeoJSON type for a region: {data["type"]}')
@@ -0,0 +1,468 @@
+import argparse
+import functools
+import http.server
+import json
+import logging
+import pathlib
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+
+METERS_PER_DEGREE = 111320.0
+
+
+def _distances(lat_a, lon_a, lat_b, lon_b):
+    """Distances in meters between the points a and b (equirectangular at the mean latitude of each pair)."""
+    dx = (lon_a - lon_b) * np.cos(np.radians((lat_a + lat_b) / 2)) * METERS_PER_DEGREE
+    dy = (lat_a - lat_b) * METERS_PER_DEGREE
+    return np.hypot(dx, dy)
+
+
+def _sort_pairs(q, d):
+    """Order sorting pairs by query q and then by distance d, a single sort of a float key is much faster than np.lexsort."""
+    if not len(q):
+        return np.zeros(0, dtype=np.int64)
+    return np.argsort(q * (d.max() + 1.0) + d)
+
+
+class StopIndex:
+    """
+    Spatial index of extracted stops for batched nearest-stop and radius queries.
+
+    The stops are sorted by general_type, specific_type and the cell of a grid in an equirectangular projection, so each
+    pair of types is a contiguous partition of the arrays and each grid column within a partition a contiguous range of
+    keys. A query looks up the key ranges of the columns around its cell with binary searches, for k nearest stops the
+    searched square is doubled until it is guaranteed to contain the k nearest. Queries for several types search the
+    matching partitions one after another and merge their results. All arrays are plain NumPy arrays, an index saved
+    with save() is memory-mapped by load(), so many processes share one copy and opening it takes milliseconds.
+    """
+    # Increase when the layout of the saved arrays changes
+    FORMAT_VERSION = 1
+    ARRAYS = ('lat', 'lon', 'keys', 'osm_id', 'osm_object_type', 'name_data', 'name_offsets')
+    # Pairs of queries and stops that cost about as much as searching one grid column
+    BRUTE_FORCE_PAIRS = 256
+
+    def __init__(self, arrays, meta):
+        """
+        Use from_frame(), from_file(), from_extractor() or load() to create an index.
+        :param arrays: Dict of the arrays in ARRAYS
+        :param meta: Dict with the grid parameters, the partitions and the object types
+        """
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.meta = meta
+        self.reference_lat = meta['reference_lat']
+        self.cell_size = meta['cell_size']
+        self.min_cell_x, self.min_cell_y = meta['min_cell']
+        self.grid_columns, self.grid_rows = meta['grid_shape']
+        self.partitions = [tuple(partition) for partition in meta['partitions']]
+        self.object_types = meta['object_types']
+        self.__partition_ends = np.array([end for _, _, _, end in self.partitions], dtype=np.int64)
+
+    @classmethod
+    def from_frame(cls, frame, cell_size=250.0):
+        """
+        Build an index from the results of the extractor. Stops without coordinates are left out.
+        :param frame: DataFrame with osm_id, osm_object_type, lat, lon, general_type, specific_type and name (or osm_name)
+        :param cell_size: Edge length of the grid cells in meters
+        """
+        frame = frame[frame['lat'].notna() & frame['lon'].notna()]
+        lat = frame['lat'].to_numpy(dtype=np.float64)
+        lon = frame['lon'].to_numpy(dtype=np.float64)
+        general_type = frame['general_type'].astype(object).fillna('unknown').astype(str).to_numpy()
+        specific_type = frame['specific_type'].astype(object).fillna('unknown').astype(str).to_numpy()
+
+        # Projection at the latitude farthest from the equator, it never overestimates distances in x (see _search_factor)
+        reference_lat = float(min(np.abs(lat).max(), 89.0)) if len(lat) else 0.0
+        cell_x = np.floor(lon * np.cos(np.radians(reference_lat)) * METERS_PER_DEGREE / cell_size).astype(np.int64)
+        cell_y = np.floor(lat * METERS_PER_DEGREE / cell_size).astype(np.int64)
+        min_cell = (int(cell_x.min()), int(cell_y.min())) if len(lat) else (0, 0)
+        columns, rows = cell_x - min_cell[0], cell_y - min_cell[1]
+        grid_shape = (int(columns.max()) + 1, int(rows.max()) + 1) if len(lat) else (0, 0)
+        keys = columns * grid_shape[1] + rows
+
+        general_codes, general_names = pd.factorize(general_type, sort=True)
+        specific_codes, specific_names = pd.factorize(specific_type, sort=True)
+        order = np.lexsort((keys, specific_codes, general_codes))
+        type_pairs = general_codes[order] * len(specific_names) + specific_codes[order]
+        starts = np.flatnonzero(np.r_[True, type_pairs[1:] != type_pairs[:-1]]) if len(order) else np.zeros(0, dtype=np.int64)
+        ends = np.r_[starts[1:], len(order)]
+        partitions = [(str(general_names[pair // len(specific_names)]), str(specific_names[pair % len(specific_names)]), int(start), int(end))
+                      for pair, start, end in zip(type_pairs[starts].tolist(), starts.tolist(), ends.tolist())]
+
+        object_type_codes, object_types = pd.factorize(frame['osm_object_type'].astype(object).to_numpy()[order], sort=True)
+        names = frame['name'] if 'name' in frame else frame['osm_name']
+        encoded = [name.encode() for name in names.astype(object).where(names.notna(), 'N/A').astype(str).to_numpy()[order].tolist()]
+        name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+
+        arrays = {
+            'lat': lat[order],
+            'lon': lon[order],
+            'keys': keys[order],
+            'osm_id': frame['osm_id'].to_numpy(dtype=np.int64)[order],
+            'osm_object_type': object_type_codes.astype(np.int8),
+            'name_data': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'name_offsets': name_offsets,
+        }
+        meta = {
+            'format_version': cls.FORMAT_VERSION,
+            'reference_lat': reference_lat,
+            'cell_size': float(cell_size),
+            'min_cell': min_cell,
+            'grid_shape': grid_shape,
+            'partitions': partitions,
+            'object_types': [str(object_type) for object_type in object_types],
+        }
+        return cls(arrays, meta)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Build an index from a results file of main.py (.csv or .parquet)."""
+        path = str(path)
+        frame = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path, low_memory=False)
+        return cls.from_frame(frame, **kwargs)
+
+    @classmethod
+    def from_extractor(cls, extractor, **kwargs):
+        """Build an index from the results of an extractor, with names and types as main.py writes them."""
+        # Imported here, so querying a saved index doesn't need osmium
+        from main import add_names_and_route_types
+
+        frame = extractor.get_result_columns().frame
+        add_names_and_route_types(frame, extractor.classifier.route_general_types)
+        return cls.from_frame(frame, **kwargs)
+
+    def save(self, directory):
+        """Save the index as .npy files and meta.json in a directory."""
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(directory / f'{name}.npy', getattr(self, name))
+        (directory / 'meta.json').write_text(json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, directory):
+        """Open an index saved with save(), the arrays are memory-mapped."""
+        directory = pathlib.Path(directory)
+        meta = json.loads((directory / 'meta.json').read_text())
+        if meta['format_version'] != cls.FORMAT_VERSION:
+            raise ValueError(f'Unsupported format version of the stop index in {directory}: {meta["format_version"]}.')
+        return cls({name: np.load(directory / f'{name}.npy', mmap_mode='r') for name in cls.ARRAYS}, meta)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def types(self):
+        """Return the (general_type, specific_type) pairs in the index and their number of stops."""
+        return {(general, specific): end - start for general, specific, start, end in self.partitions}
+
+    def __ranges(self, general_type, specific_type):
+        """Index ranges of the partitions matching the types (None matches all). Each is sorted by key on its own."""
+        return [(start, end) for general, specific, start, end in self.partitions
+                if (general_type is None or general == general_type) and (specific_type is None or specific == specific_type)]
+
+    def __query_cells(self, lat, lon):
+        """Grid column and row of the query points (may be outside of the grid)."""
+        cell_x = np.floor(lon * np.cos(np.radians(self.reference_lat)) * METERS_PER_DEGREE / self.cell_size).astype(np.int64)
+        cell_y = np.floor(lat * METERS_PER_DEGREE / self.cell_size).astype(np.int64)
+        return cell_x - self.min_cell_x, cell_y - self.min_cell_y
+
+    def __sorted_queries(self, lat, lon):
+        """
+        Return the positions of the valid query points (without NaN) sorted by grid cell, their coordinates, grid
+        columns and rows. Sorted queries keep the binary searches in the sorted keys cache friendly.
+        """
+        valid = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+        columns, rows = self.__query_cells(lat[valid], lon[valid])
+        order = np.argsort(columns * self.grid_rows + rows, kind='stable')
+        valid, columns, rows = valid[order], columns[order], rows[order]
+        return valid, lat[valid], lon[valid], columns, rows
+
+    def _search_factor(self, lat):
+        """
+        Factor of the grid distance that is at least the real distance for the query points. The grid distance in x
+        is measured at the reference latitude, so it is only smaller than the real one for queries closer to a pole.
+        """
+        return np.minimum(1.0, np.cos(np.radians(np.minimum(np.abs(lat), 89.0))) / np.cos(np.radians(self.reference_lat)))
+
+    def __candidates(self, columns, rows, start, end, cells):
+        """
+        Return the pairs (query position, stop index) of the stops in start:end in the disk of radius cells (one per
+        query) around the cell of each query, and whether the pairs are all pairs of queries and stops. Every stop
+        closer than cells * cell_size (scaled by the search factor) to a query is paired with it.
+        """
+        if not len(columns):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), True
+        # Only columns of the grid, the disk may reach far beyond it
+        max_cells = int(cells.max())
+        column_offsets = range(max(-max_cells, -int(columns.max())), min(max_cells, self.grid_columns - 1 - int(columns.min())) + 1)
+        if (end - start) * len(columns) <= len(column_offsets) * self.BRUTE_FORCE_PAIRS:
+            # Few stops in a large disk (e.g. a rare type): pairing all is cheaper than searching each column
+            return np.repeat(np.arange(len(columns)), end - start), np.tile(np.arange(start, end), len(columns)), True
+        sorted_keys = self.keys[start:end]
+        pairs_q, pairs_p = [], []
+        for dx in column_offsets:
+            column = columns + dx
+            # A stop in this column is at least (|dx| - 1) cells away horizontally, so the rows within the disk are
+            # the ones less than sqrt(cells² - (|dx| - 1)²) cells away vertically
+            gap = max(abs(dx) - 1, 0)
+            queries = np.flatnonzero((cells >= abs(dx)) & (column >= 0) & (column < self.grid_columns))
+            if not len(queries):
+                continue
+            half_height = np.ceil(np.sqrt(cells[queries] ** 2 - gap ** 2)).astype(np.int64)
+            first_row = np.maximum(rows[queries] - half_height, 0)
+            last_row = np.minimum(rows[queries] + half_height, self.grid_rows - 1)
+            # The rows of a column are consecutive keys, so each column is one range of the sorted keys
+            column_keys = column[queries] * self.grid_rows
+            starts = sorted_keys.searchsorted(column_keys + first_row, side='left')
+            counts = np.maximum(sorted_keys.searchsorted(column_keys + last_row, side='right') - starts, 0)
+            positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+            pairs_q.append(np.repeat(queries, counts))
+            pairs_p.append(positions + start)
+        if not pairs_q:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), False
+        return np.concatenate(pairs_q), np.concatenate(pairs_p), False
+
+    def __nearest_in_range(self, lat, lon, k, max_distance, start, end):
+        """k nearest stops in start:end of each query, see nearest()."""
+        indices = np.full((len(lat), k), -1, dtype=np.int64)
+        distances = np.full((len(lat), k), np.inf)
+        valid, lat, lon, columns, rows = self.__sorted_queries(lat, lon)
+        search_factor = self._search_factor(lat)
+        # Queries outside of the grid start at the distance of the grid (in cells), so their disk just reaches it
+        outside_columns = np.maximum(np.maximum(-columns, columns - (self.grid_columns - 1)), 0)
+        outside_rows = np.maximum(np.maximum(-rows, rows - (self.grid_rows - 1)), 0)
+        offset = np.floor(np.hypot(np.maximum(outside_columns - 1, 0), np.maximum(outside_rows - 1, 0))).astype(np.int64)
+        # Farthest cell of the grid, the disk covers the grid once it reaches it
+        farthest_columns = np.maximum(columns, self.grid_columns - 1 - columns)
+        farthest_rows = np.maximum(rows, self.grid_rows - 1 - rows)
+        remaining = np.arange(len(valid))
+        # Start with the disk expected to hold k stops if the stops of the partition were spread evenly over the grid,
+        # a disk too small costs another round, one too large more candidates. Only this part grows each round, so
+        # the disk of a query far outside of the grid doesn't grow beyond the part of the grid close to it.
+        stops_per_cell = (end - start) / (self.grid_columns * self.grid_rows)
+        radius = max(1, int(np.ceil(np.sqrt(k / stops_per_cell / np.pi))))
+        while len(remaining):
+            cells = offset[remaining] + radius
+            q, p, all_pairs = self.__candidates(columns[remaining], rows[remaining], start, end, cells)
+            d = _distances(lat[remaining[q]], lon[remaining[q]], self.lat[p], self.lon[p])
+            order = _sort_pairs(q, d)
+            q, p, d = q[order], p[order], d[order]
+            counts = np.bincount(q, minlength=len(remaining))
+            first = np.cumsum(counts) - counts
+            rank = np.arange(len(q)) - first[q]
+            kth_distance = np.full(len(remaining), np.inf)
+            has_k = counts >= k
+            kth_distance[has_k] = d[first[has_k] + k - 1]
+            # Every stop outside the disk is farther away than covered, so the k nearest candidates are the k nearest
+            # stops once the k-th is within it. Also done: the disk covers max_distance or the whole grid.
+            covered = cells * self.cell_size * search_factor[remaining]
+            covers_grid = ((farthest_columns[remaining] <= cells)
+                           & (np.maximum(farthest_columns[remaining] - 1, 0) ** 2 + farthest_rows[remaining] ** 2 <= cells ** 2))
+            done = (kth_distance <= covered) | (covered >= max_distance) | covers_grid | all_pairs
+            keep = (rank < k) & done[q] & (d <= max_distance)
+            indices[valid[remaining[q[keep]]], rank[keep]] = p[keep]
+            distances[valid[remaining[q[keep]]], rank[keep]] = d[keep]
+            remaining = remaining[~done]
+            radius *= 2
+        return indices, distances
+
+    def nearest(self, lat, lon, k=1, max_distance=np.inf, general_type=None, specific_type=None):
+        """
+        Return the k nearest stops of each query point.
+        :param lat: Latitudes of the query points (array or scalar)
+        :param lon: Longitudes of the query points
+        :param k: Number of stops per query, at least 1
+        :param max_distance: Only stops within this distance in meters
+        :param general_type: Only stops of this general_type, None for all
+        :param specific_type: Only stops of this specific_type, None for all
+        :return: Arrays of stop indices (-1 if there are fewer than k stops) and distances in meters (inf), both of
+                 shape (number of queries, k), sorted by distance. See stops() for the data of the indices.
+        """
+        if k < 1:
+            raise ValueError(f'k must be at least 1, got {k}')
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        indices = np.full((len(lat), k), -1, dtype=np.int64)
+        distances = np.full((len(lat), k), np.inf)
+        for range_number, (start, end) in enumerate(self.__ranges(general_type, specific_type)):
+            range_indices, range_distances = self.__nearest_in_range(lat, lon, k, max_distance, start, end)
+            if range_number == 0:
+                indices, distances = range_indices, range_distances
+                continue
+            # Merge with the k nearest of the previous ranges
+            indices = np.concatenate([indices, range_indices], axis=1)
+            distances = np.concatenate([distances, range_distances], axis=1)
+            order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+            indices = np.take_along_axis(indices, order, axis=1)
+            distances = np.take_along_axis(distances, order, axis=1)
+        return indices, distances
+
+    def within(self, lat, lon, radius, general_type=None, specific_type=None):
+        """
+        Return all stops within a radius of each query point.
+        :param radius: Radius in meters
+        :return: CSR arrays offsets, indices and distances: the stops of query i are indices[offsets[i]:offsets[i + 1]],
+                 sorted by distance
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        valid, valid_lat, valid_lon, columns, rows = self.__sorted_queries(lat, lon)
+        cells = np.ceil(radius / (self.cell_size * self._search_factor(valid_lat))).astype(np.int64)
+        pairs_q, pairs_p, pairs_d = [], [], []
+        for start, end in self.__ranges(general_type, specific_type):
+            q, p, _ = self.__candidates(columns, rows, start, end, cells)
+            d = _distances(valid_lat[q], valid_lon[q], self.lat[p], self.lon[p])
+            close = d <= radius
+            pairs_q.append(valid[q[close]])
+            pairs_p.append(p[close])
+            pairs_d.append(d[close])
+        q = np.concatenate(pairs_q) if pairs_q else np.zeros(0, dtype=np.int64)
+        p = np.concatenate(pairs_p) if pairs_p else np.zeros(0, dtype=np.int64)
+        d = np.concatenate(pairs_d) if pairs_d else np.zeros(0)
+        order = _sort_pairs(q, d)
+        offsets = np.zeros(len(lat) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(q, minlength=len(lat)), out=offsets[1:])
+        return offsets, p[order], d[order]
+
+    def stop_columns(self, indices):
+        """Return the data of the stops with the given indices (e.g. from nearest() or within()) as a dict of lists."""
+        indices = np.asarray(indices, dtype=np.int64)
+        partition = self.__partition_ends.searchsorted(indices, side='right').tolist()
+        name_data = self.name_data
+        name_starts = self.name_offsets[indices].tolist()
+        name_ends = self.name_offsets[indices + 1].tolist()
+        return {
+            'osm_id': self.osm_id[indices].tolist(),
+            'osm_object_type': [self.object_types[code] for code in self.osm_object_type[indices].tolist()],
+            'name': [name_data[start:end].tobytes().decode() for start, end in zip(name_starts, name_ends)],
+            'general_type': [self.partitions[i][0] for i in partition],
+            'specific_type': [self.partitions[i][1] for i in partition],
+            'lat': self.lat[indices].tolist(),
+            'lon': self.lon[indices].tolist(),
+        }
+
+    def stops(self, indices):
+        """Return the data of the stops with the given indices as a DataFrame."""
+        return pd.DataFrame(self.stop_columns(indices))
+
+
+def make_server(index, host='127.0.0.1', port=8080, cache_size=100000):
+    """
+    Create the HTTP server answering stop queries. Port 0 picks a free port (see server.server_address).
+    Responses of single queries are kept in an LRU cache.
+    - GET /nearest?lat=..&lon=..[&k=1][&max_distance=..][&general_type=..][&specific_type=..]
+    - GET /within?lat=..&lon=..&radius=..[&general_type=..][&specific_type=..]
+    - POST /nearest or /within with a JSON object of the same parameters, lat and lon as lists (batch, not cached)
+    - GET /types: the types in the index and their number of stops
+    Responses are JSON, with a list of stops (osm_id, osm_object_type, name, general_type, specific_type, lat, lon,
+    distance) per query.
+    """
+    def query(kind, params):
+        """Run a query with the parameters of a request, lat and lon are lists. Returns the list of results per query."""
+        lat = np.asarray(params['lat'], dtype=np.float64)
+        lon = np.asarray(params['lon'], dtype=np.float64)
+        types = {'general_type': params.get('general_type'), 'specific_type': params.get('specific_type')}
+        if kind == 'nearest':
+            max_distance = float(params['max_distance']) if params.get('max_distance') is not None else np.inf
+            indices, distances = index.nearest(lat, lon, int(params.get('k', 1)), max_distance, **types)
+            found = indices >= 0
+            offsets = np.zeros(len(lat) + 1, dtype=np.int64)
+            np.cumsum(found.sum(axis=1), out=offsets[1:])
+            indices, distances = indices[found], distances[found]
+        else:
+            offsets, indices, distances = index.within(lat, lon, float(params['radius']), **types)
+        # Records of all results at once, then split by query
+        columns = index.stop_columns(indices)
+        columns['distance'] = distances.tolist()
+        records = [dict(zip(columns, values)) for values in zip(*columns.values())]
+        offsets = offsets.tolist()
+        return [records[offsets[i]:offsets[i + 1]] for i in range(len(lat))]
+
+    @functools.lru_cache(maxsize=cache_size)
+    def cached_query(kind, query_string):
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(query_string).items()}
+        params['lat'], params['lon'] = [params['lat']], [params['lon']]
+        return json.dumps(query(kind, params)[0]).encode()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        # Keep connections open, clients sending many single queries would otherwise spend most time connecting.
+        # Headers and body are separate writes, without TCP_NODELAY each response waits for the client's delayed ACK.
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == '/types':
+                self.respond(200, json.dumps([{'general_type': general, 'specific_type': specific, 'stops': count}
+                                              for (general, specific), count in index.types().items()]).encode())
+            elif url.path in ('/nearest', '/within'):
+                try:
+                    self.respond(200, cached_query(url.path[1:], url.query))
+                except (KeyError, ValueError) as e:
+                    self.respond(400, json.dumps({'error': f'Invalid query: {e!r}'}).encode())
+            else:
+                self.respond(404, json.dumps({'error': 'Unknown path'}).encode())
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path not in ('/nearest', '/within'):
+                self.respond(404, json.dumps({'error': 'Unknown path'}).encode())
+                return
+            try:
+                params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                self.respond(200, json.dumps(query(url.path[1:], params)).encode())
+            except (KeyError, ValueError, TypeError) as e:
+                self.respond(400, json.dumps({'error': f'Invalid query: {e!r}'}).encode())
+
+        def respond(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return http.server.ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(index, host='127.0.0.1', port=8080, cache_size=100000):
+    """Answer queries over HTTP until interrupted, see make_server() for the requests."""
+    with make_server(index, host, port, cache_size) as server:
+        logging.info(f'Serving {len(index)} stops on http://{host}:{port}/')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    parser = argparse.ArgumentParser(description='Nearest-stop queries over the extracted PuT stops.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Build an index from a results file of main.py')
+    build_parser.add_argument('results', help='Results of main.py (.csv or .parquet)')
+    build_parser.add_argument('index_dir', type=pathlib.Path, help='Directory the index is written to')
+    build_parser.add_argument('--cell-size', default=250.0, type=float, help='Edge length of the grid cells in meters')
+    serve_parser = subparsers.add_parser('serve', help='Answer queries over HTTP')
+    serve_parser.add_argument('index_dir', type=pathlib.Path, help='Directory of an index built with build')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    serve_parser.add_argument('--port', default=8080, type=int, help='Port to listen on')
+    serve_parser.add_argument('--cache-size', default=100000, type=int, help='Number of responses in the LRU cache')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        stop_index = StopIndex.from_file(args.results, cell_size=args.cell_size)
+        stop_index.save(args.index_dir)
+        logging.info(f'Index of {len(stop_index)} stops in {len(stop_index.partitions)} type partitions written to {args.index_dir}.')
+    else:
+        serve(StopIndex.load(args.index_dir), args.host, args.port, args.cache_size)
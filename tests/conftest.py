@@ -0,0 +1,17 @@
+import pathlib
+import sys
+
+import pytest
+
+# The modules of the script live in the repository root
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+from benchmark import generate_osm_file  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def osm_file(tmp_path_factory):
+    """Small synthetic PBF file with stops, ways, nested relations and routes (see benchmark.generate_osm_file)."""
+    path = tmp_path_factory.mktemp('osm') / 'synthetic.osm.pbf'
+    generate_osm_file(path, 20000, seed=7)
+    return path
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from main import compute_centroids_csr
+
+# Origin of the test shapes, offsets are given in units of 0.001°
+LAT, LON = 50.0, 10.0
+SCALE = 0.001
+
+
+def centroids(elements, coords):
+    """
+    Run compute_centroids_csr on elements given as lists of node IDs.
+    :param coords: Dict of node ID -> (x, y) offsets from the origin in units of SCALE
+    :return: Arrays of the centroid offsets (x, y) from the origin in units of SCALE
+    """
+    offsets = np.zeros(len(elements) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(element) for element in elements])
+    node_refs = np.array([ref for element in elements for ref in element], dtype=np.int64)
+    node_ids = np.array(sorted(coords), dtype=np.int64)
+    node_lat = np.array([LAT + coords[node_id][1] * SCALE for node_id in node_ids])
+    node_lon = np.array([LON + coords[node_id][0] * SCALE for node_id in node_ids])
+    lat, lon = compute_centroids_csr(offsets, node_refs, node_ids, node_lat, node_lon)
+    return (lon - LON) / SCALE, (lat - LAT) / SCALE
+
+
+def line_centroid(points):
+    """Length-weighted segment midpoints, with longitudes scaled by cos(lat) of the first point for the lengths."""
+    x, y = np.array(points, dtype=float).T
+    cos_lat = np.cos(np.radians(LAT + y[0] * SCALE))
+    length = np.hypot(np.diff(x) * cos_lat, np.diff(y))
+    return np.sum(length * (x[1:] + x[:-1]) / 2) / length.sum(), np.sum(length * (y[1:] + y[:-1]) / 2) / length.sum()
+
+
+def area_centroid(points):
+    x, y = np.array(points, dtype=float).T
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area2 = cross.sum()
+    return np.sum((x[:-1] + x[1:]) * cross) / (3 * area2), np.sum((y[:-1] + y[1:]) * cross) / (3 * area2)
+
+
+def test_closed_square():
+    coords = {1: (0, 0), 2: (2, 0), 3: (2, 2), 4: (0, 2)}
+    x, y = centroids([[1, 2, 3, 4, 1], [1, 4, 3, 2, 1]], coords)
+    np.testing.assert_allclose(x, [1, 1])
+    np.testing.assert_allclose(y, [1, 1])
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_non_convex_l_shape(reverse):
+    coords = {1: (0, 0), 2: (2, 0), 3: (2, 1), 4: (1, 1), 5: (1, 2), 6: (0, 2)}
+    ring = [1, 2, 3, 4, 5, 6, 1]
+    x, y = centroids([ring[::-1] if reverse else ring], coords)
+    # Rectangles [0, 2] x [0, 1] (area 2) and [0, 1] x [1, 2] (area 1)
+    np.testing.assert_allclose(x, [(2 * 1 + 1 * 0.5) / 3])
+    np.testing.assert_allclose(y, [(2 * 0.5 + 1 * 1.5) / 3])
+    # Not the mean of the vertices
+    assert not np.isclose(x[0], np.mean([coords[ref][0] for ref in ring[:-1]]))
+
+
+def test_open_polyline_with_unequal_segments():
+    coords = {1: (0, 0), 2: (6, 0), 3: (6, 1), 4: (6, 4)}
+    x, y = centroids([[1, 2, 3], [1, 2, 3, 4]], coords)
+    expected = [line_centroid([coords[ref] for ref in refs]) for refs in ([1, 2, 3], [1, 2, 3, 4])]
+    np.testing.assert_allclose(x, [point[0] for point in expected])
+    np.testing.assert_allclose(y, [point[1] for point in expected])
+    # The longitudes are scaled for the lengths: at 50° the horizontal segment counts 6 * cos(50°) ≈ 3.86
+    np.testing.assert_allclose(x[0], 6 * np.cos(np.radians(LAT)) * 3 / (6 * np.cos(np.radians(LAT)) + 1) + 6 / (6 * np.cos(np.radians(LAT)) + 1))
+
+
+def test_single_node_and_zero_length_elements():
+    coords = {1: (3, 4), 2: (3, 4), 3: (5, 4)}
+    x, y = centroids([[1], [1, 1, 1], [1, 2], [1, 2, 1, 2, 1]], coords)
+    np.testing.assert_allclose(x, [3, 3, 3, 3])
+    np.testing.assert_allclose(y, [4, 4, 4, 4])
+    # A closed ring of three nodes is a line back and forth, no area
+    x, y = centroids([[1, 3, 1]], coords)
+    np.testing.assert_allclose([x[0], y[0]], [4, 4])
+
+
+def test_relation_with_cancelling_rings_uses_line_centroid():
+    # A counter-clockwise square and a clockwise rectangle of almost the same area chained together, so the net area is
+    # tiny and its area centroid lies far outside of the element
+    coords = {1: (0, 0), 2: (1, 0), 3: (1, 1), 4: (0, 1), 5: (0.5, 0), 6: (0.5, 0.999), 7: (1.5, 0.999), 8: (1.5, 0)}
+    refs = [1, 2, 3, 4, 1, 5, 6, 7, 8, 5, 1]
+    points = [coords[ref] for ref in refs]
+    area_x, area_y = area_centroid(points)
+    assert not (0 <= area_x <= 1.5 and 0 <= area_y <= 1)
+    x, y = centroids([refs], coords)
+    np.testing.assert_allclose([x[0], y[0]], line_centroid(points))
+    assert 0 <= x[0] <= 1.5 and 0 <= y[0] <= 1
+
+    # Rings cancelling out exactly have no area at all
+    x, y = centroids([[1, 2, 3, 4, 1, 4, 3, 2, 1]], coords)
+    np.testing.assert_allclose([x[0], y[0]], [0.5, 0.5])
+
+
+def test_missing_node_coordinates():
+    coords = {1: (0, 0), 2: (2, 0), 3: (2, 2), 4: (0, 2)}
+    # Missing nodes are left out, elements without any coordinates get NaN
+    x, y = centroids([[1, 99, 2], [98, 99], [], [1, 2, 3, 4, 97, 1], [3]], coords)
+    np.testing.assert_allclose(x, [1, np.nan, np.nan, 1, 2])
+    np.testing.assert_allclose(y, [0, np.nan, np.nan, 1, 2])
+    # No node coordinates at all
+    x, y = centroids([[1, 2], [3]], {})
+    assert np.isnan(x).all() and np.isnan(y).all()
@@ -0,0 +1,28 @@
+import numpy as np
+
+from main import cluster_stops
+
+
+def test_all_named():
+    # No unnamed stop, so no unnamed stop has a named one in reach
+    assert cluster_stops([48, 48.0001], [9, 9], ['a', 'a'], ['bus', 'bus'], 100).tolist() == [0, 0]
+    assert cluster_stops([48, 48.0001], [9, 9], ['a', 'b'], ['bus', 'bus'], 100).tolist() == [0, 1]
+
+
+def test_all_unnamed():
+    labels = cluster_stops([48, 48.0001, 48.1], [9, 9, 9], [None, None, None], ['bus', 'bus', 'bus'], 100)
+    assert labels.tolist() == [0, 0, 1]
+
+
+def test_unnamed_stops_join_nearest_named_stop():
+    lat = [48, 48.0003, 48.0005, 48.0008]
+    labels = cluster_stops(lat, [9] * 4, ['a', None, 'b', None], ['bus', 'bus', 'bus', 'unknown'], 100)
+    assert labels.tolist() == [0, 1, 1, 1]
+
+
+def test_isolated_stops():
+    lat = [48, 48.01, 48.02]
+    labels = cluster_stops(lat, [9] * 3, ['a', 'a', None], ['bus', 'bus', 'bus'], 100)
+    assert labels.tolist() == [0, 1, 2]
+    assert cluster_stops([48], [9], [None], ['bus'], 100).tolist() == [0]
+    assert cluster_stops(np.zeros(0), np.zeros(0), [], [], 100).tolist() == []
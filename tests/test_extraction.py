@@ -0,0 +1,52 @@
+import pytest
+
+from main import PublicTransportStopExtractor
+from region import Region
+
+
+def extract(osm_file, **options):
+    extractor = PublicTransportStopExtractor(osm_file, **options)
+    extractor.process_relations()
+    extractor.process_ways()
+    extractor.process_nodes()
+    extractor.compute_centroids()
+    extractor.filter_region()
+    extractor.add_info_stoparea_putline()
+    return extractor.get_results()
+
+
+@pytest.fixture(scope='module')
+def reference(osm_file):
+    return extract(osm_file, pass_plan='legacy')
+
+
+@pytest.mark.parametrize('options', [
+    {'pass_plan': 'merged'},
+    {'pass_plan': 'native'},
+    {'pass_plan': 'merged', 'node_strategy': 'inline'},
+    {'pass_plan': 'native', 'node_strategy': 'inline'},
+    {'pass_plan': 'merged', 'workers': 2},
+    {'pass_plan': 'native', 'workers': 2},
+    {'pass_plan': 'native', 'workers': 3},
+])
+def test_pass_plans_match_legacy(osm_file, reference, options):
+    results = extract(osm_file, **options)
+    assert len(results) > 0
+    assert results.equals(reference)
+
+
+def test_region_without_filter_region_call(osm_file, reference):
+    # Module users may still call the steps without filter_region(), the results must not contain anything outside the region
+    lat, lon = reference['lat'], reference['lon']
+    region = Region.from_bbox(lon.min(), lat.min(), (lon.min() + lon.max()) / 2, lat.max())
+    extractor = PublicTransportStopExtractor(osm_file, region=region)
+    extractor.process_relations()
+    extractor.process_ways()
+    extractor.process_nodes()
+    extractor.compute_centroids()
+    extractor.add_info_stoparea_putline()
+    results = extractor.get_results()
+    assert results.equals(extract(osm_file, region=region))
+    assert region.contains_many(results['lon'].to_numpy(), results['lat'].to_numpy()).all()
+    assert len(results[results['osm_object_type'] != 'node']) > 0
+    assert len(results) < len(reference)
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_matching import METERS_PER_DEGREE, assign_one_to_one, grid_cross_pairs, load_gtfs_stops, match_stops, normalize_names
+
+
+def brute_force_pairs(lat_a, lon_a, lat_b, lon_b, max_distance):
+    i, j = np.meshgrid(np.arange(len(lat_a)), np.arange(len(lat_b)), indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    dx = (lon_a[i] - lon_b[j]) * np.cos(np.radians((lat_a[i] + lat_b[j]) / 2)) * METERS_PER_DEGREE
+    dy = (lat_a[i] - lat_b[j]) * METERS_PER_DEGREE
+    distance = np.hypot(dx, dy)
+    close = distance <= max_distance
+    return i[close], j[close], distance[close]
+
+
+@pytest.mark.parametrize('max_distance', [50.0, 150.0, 1000.0])
+def test_grid_cross_pairs_matches_brute_force(max_distance):
+    rng = np.random.default_rng(1)
+    lat_a, lon_a = 48.7 + rng.random(400) * 0.05, 9.1 + rng.random(400) * 0.08
+    lat_b, lon_b = 48.7 + rng.random(300) * 0.05, 9.1 + rng.random(300) * 0.08
+    # Points at the same position and on cell borders
+    lat_b[:20], lon_b[:20] = lat_a[:20], lon_a[:20]
+    i, j, distance = grid_cross_pairs(lat_a, lon_a, lat_b, lon_b, max_distance)
+    expected_i, expected_j, expected_distance = brute_force_pairs(lat_a, lon_a, lat_b, lon_b, max_distance)
+    order = np.lexsort((j, i))
+    np.testing.assert_array_equal(i[order], expected_i)
+    np.testing.assert_array_equal(j[order], expected_j)
+    np.testing.assert_allclose(distance[order], expected_distance)
+
+
+def test_grid_cross_pairs_empty():
+    i, j, distance = grid_cross_pairs(np.zeros(0), np.zeros(0), np.array([48.0]), np.array([9.0]), 100.0)
+    assert len(i) == len(j) == len(distance) == 0
+
+
+def sequential_greedy(i, j, scores):
+    """Accept the pairs one by one by descending score (ties by position) if both stops are still free."""
+    used_i, used_j, accepted = set(), set(), []
+    for position in sorted(range(len(scores)), key=lambda position: (-scores[position], position)):
+        if i[position] not in used_i and j[position] not in used_j:
+            used_i.add(i[position])
+            used_j.add(j[position])
+            accepted.append(position)
+    return sorted(accepted)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_assign_one_to_one_matches_sequential_greedy(seed):
+    rng = np.random.default_rng(seed)
+    count = 2000
+    i = rng.integers(0, 300, count)
+    j = rng.integers(0, 250, count)
+    # Few distinct scores, so there are many ties
+    scores = rng.integers(0, 20, count) / 20
+    assert assign_one_to_one(i, j, scores).tolist() == sequential_greedy(i.tolist(), j.tolist(), scores.tolist())
+
+
+def test_assign_one_to_one_empty():
+    assert len(assign_one_to_one(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))) == 0
+
+
+def test_normalize_names():
+    names = pd.Series(['Königstraße', 'Stuttgart Hbf', 'Hauptstr.', 'Bf Feuerbach', 'Berliner Pl. (Mitte)', 'Schloßstr.', None, 'MÜHLE'])
+    assert normalize_names(names).tolist() == [
+        'koenigstrasse', 'stuttgart hauptbahnhof', 'hauptstrasse', 'bahnhof feuerbach', 'berliner platz mitte', 'schlossstrasse', '', 'muehle']
+    # Abbreviations only as whole words
+    assert normalize_names(['Hbfweg', 'Kurbfad']).tolist() == ['hbfweg', 'kurbfad']
+
+
+@pytest.fixture
+def gtfs_dir(tmp_path):
+    files = {
+        'stops.txt': [
+            'stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station',
+            'S1,Stuttgart Hbf,48.7840,9.1815,1,',
+            'P1,Stuttgart Hbf,48.7841,9.1816,0,S1',
+            'P2,Stuttgart Hbf,48.7842,9.1817,0,S1',
+            'E1,Stuttgart Hbf Eingang,48.7839,9.1814,2,S1',
+            'B1,Königstr.,48.7800,9.1790,0,',
+            'N1,Ohne Position,,,0,',
+            'X1,Fernhalt,49.0000,9.5000,0,',
+        ],
+        'routes.txt': ['route_id,route_type', 'R2,2', 'R3,3', 'R0,0'],
+        'trips.txt': ['trip_id,route_id', 'T2,R2', 'T3,R3', 'T0,R0'],
+        'stop_times.txt': ['trip_id,stop_id', 'T2,P1', 'T0,P2', 'T3,B1', 'T3,X1', 'T0,P2'],
+    }
+    for name, lines in files.items():
+        (tmp_path / name).write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return tmp_path
+
+
+def test_load_gtfs_stops(gtfs_dir):
+    stops = load_gtfs_stops(gtfs_dir).set_index('stop_id')
+    # No entrances and no stops without position
+    assert stops.index.tolist() == ['S1', 'P1', 'P2', 'B1', 'X1']
+    # The station inherits the route types of its child stops
+    assert stops['route_types'].to_dict() == {'S1': [0, 2], 'P1': [2], 'P2': [0], 'B1': [3], 'X1': [3]}
+    assert 'route_types' not in load_gtfs_stops(gtfs_dir, route_types=False)
+
+
+def osm_stops():
+    return pd.DataFrame({
+        'osm_id': [1, 2, 3, 4, 5],
+        'osm_object_type': ['relation', 'node', 'node', 'node', 'way'],
+        'lat': [48.78405, 48.78412, 48.78005, 48.7700, np.nan],
+        'lon': [9.1815, 9.18162, 9.1790, 9.1700, np.nan],
+        'general_type': ['rail', 'rail', 'bus', 'rail', 'bus'],
+        'specific_type': ['train', 'train', 'bus', 'tram', 'bus'],
+        'name': ['Stuttgart Hauptbahnhof', 'Stuttgart Hbf', 'Königstraße', 'Irgendwo', 'Ohne Position'],
+    })
+
+
+def test_match_stops(gtfs_dir):
+    gtfs_stops = load_gtfs_stops(gtfs_dir)
+    matches = match_stops(osm_stops(), gtfs_stops)
+    assert list(zip(matches['osm_id'], matches['stop_id'])) == [(1, 'S1'), (2, 'P1'), (3, 'B1')]
+    assert matches['osm_index'].tolist() == [0, 1, 2]
+    assert gtfs_stops.loc[matches['gtfs_index'], 'stop_id'].tolist() == ['S1', 'P1', 'B1']
+    # The station serves trains only through its child stop
+    assert matches.set_index('stop_id').loc['S1', 'type_score'] == 1.0
+    assert (matches['name_similarity'] == 1.0).all()
+    assert (matches['distance'] < 20).all()
+
+
+@pytest.mark.filterwarnings('error')
+def test_match_stops_ignores_gtfs_stops_without_position(gtfs_dir):
+    gtfs_stops = load_gtfs_stops(gtfs_dir)
+    gtfs_stops = pd.concat([gtfs_stops, pd.DataFrame({'stop_id': ['N2'], 'stop_name': ['Stuttgart Hbf'], 'stop_lat': [np.nan], 'stop_lon': [np.nan],
+                                                     'location_type': [0], 'route_types': [[2]]})], ignore_index=True)
+    matches = match_stops(osm_stops(), gtfs_stops)
+    assert matches['stop_id'].tolist() == ['S1', 'P1', 'B1']
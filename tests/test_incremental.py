@@ -0,0 +1,105 @@
+import random
+
+import numpy as np
+import osmium
+import pytest
+from osmium.osm.mutable import Node, Relation, Way
+
+from incremental import IncrementalStopExtractor
+from region import Region
+from test_extraction import extract
+
+
+def read_objects(osm_file):
+    objects = {'n': {}, 'w': {}, 'r': {}}
+    for obj in osmium.FileProcessor(osm_file):
+        if obj.is_node():
+            objects['n'][obj.id] = (dict(obj.tags), (obj.location.lon, obj.location.lat))
+        elif obj.is_way():
+            objects['w'][obj.id] = (dict(obj.tags), [node.ref for node in obj.nodes])
+        else:
+            objects['r'][obj.id] = (dict(obj.tags), [(member.type, member.ref, member.role) for member in obj.members])
+    return objects
+
+
+def write_changes(path, nodes, ways, relations):
+    """Write a change file, objects are mutable osmium objects or IDs of deleted objects."""
+    writer = osmium.SimpleWriter(str(path))
+    for objects, add, cls in ((nodes, writer.add_node, Node), (ways, writer.add_way, Way), (relations, writer.add_relation, Relation)):
+        for obj in sorted(objects, key=lambda obj: obj if isinstance(obj, int) else obj.id):
+            add(cls(id=obj, version=3, visible=False) if isinstance(obj, int) else obj)
+    writer.close()
+
+
+def apply_to_file(osm_file, osc_file, path):
+    reader = osmium.MergeInputReader()
+    reader.add_file(str(osc_file))
+    with osmium.io.Reader(str(osm_file)) as base:
+        writer = osmium.io.Writer(str(path))
+        reader.apply_to_reader(base, writer)
+        writer.close()
+
+
+def changes(osm_file, osc_file, seed, extra_ways=()):
+    """Random changes to stops, stop geometries and relations, return the IDs of moved nodes no way references."""
+    rng = random.Random(seed)
+    objects = read_objects(osm_file)
+    stop_nodes = sorted(node_id for node_id, (tags, _) in objects['n'].items() if 'public_transport' in tags)
+    way_nodes = {ref for _, refs in objects['w'].values() for ref in refs}
+    free_nodes = sorted(set(objects['n']) - way_nodes - set(stop_nodes))
+    stop_relations = sorted(relation_id for relation_id, (tags, _) in objects['r'].items() if tags.get('public_transport') in ('platform', 'stop_position'))
+    route_relations = sorted(relation_id for relation_id, (tags, _) in objects['r'].items() if 'route' in tags)
+    new_node_id = max(objects['n']) + 1
+    other_ways = sorted(set(objects['w']) - {way_id for way_id, _ in extra_ways})
+
+    nodes = [Node(id=node_id, version=2, location=(lon + 0.001, lat), tags=dict(tags, name='Renamed'))
+             for node_id in rng.sample(stop_nodes, 10) for tags, (lon, lat) in [objects['n'][node_id]]]
+    nodes += rng.sample(sorted(set(stop_nodes) - {node.id for node in nodes}), 5)
+    moved = rng.sample(sorted(way_nodes), 50) + rng.sample(free_nodes, 5)
+    nodes += [Node(id=node_id, version=2, location=(lon, lat + 0.0005), tags=tags) for node_id in moved for tags, (lon, lat) in [objects['n'][node_id]]]
+    nodes.append(Node(id=new_node_id, version=1, location=objects['n'][stop_nodes[0]][1], tags={'public_transport': 'platform', 'bus': 'yes', 'name': 'New'}))
+    ways = [Way(id=way_id, version=2, nodes=refs[:-1] + [new_node_id], tags=tags) for way_id in rng.sample(other_ways, 10) for tags, refs in [objects['w'][way_id]]]
+    ways += [Way(id=way_id, version=2, nodes=refs, tags=dict(tags, public_transport='platform', bus='yes')) for way_id, refs in extra_ways for tags in [objects['w'][way_id][0]]]
+    relations = [Relation(id=relation_id, version=2, members=members + [('w', rng.choice(other_ways), 'outer')], tags=tags)
+                 for relation_id in rng.sample(stop_relations, 5) for tags, members in [objects['r'][relation_id]]]
+    relations += rng.sample(route_relations, 3)
+    relations.append(Relation(id=max(objects['r']) + 1, version=1, members=[('n', new_node_id, 'platform')], tags={'public_transport': 'stop_area', 'name': 'New Area'}))
+    write_changes(osc_file, nodes, ways, relations)
+    return moved[-5:], other_ways
+
+
+@pytest.mark.parametrize('region', [None, 'bbox'])
+def test_apply_changes_matches_full_extraction(osm_file, tmp_path, region):
+    if region == 'bbox':
+        lat, lon = np.array([location for _, location in read_objects(osm_file)['n'].values()]).T[::-1]
+        region = Region.from_bbox(lon.min(), lat.min(), (lon.min() + lon.max()) / 2, lat.max())
+    extractor = IncrementalStopExtractor(osm_file, region=region)
+    extractor.extract()
+    assert extractor.get_results().equals(extract(osm_file, region=region))
+
+    # The second change file makes ways out of nodes moved by the first one without being referenced by any stop
+    current, moved = osm_file, None
+    for k in (1, 2):
+        extra_ways = [] if moved is None else [(way_ids[0], moved), (way_ids[1], moved[:2])]
+        moved, way_ids = changes(current, tmp_path / f'changes{k}.osc', seed=k, extra_ways=extra_ways)
+        apply_to_file(current, tmp_path / f'changes{k}.osc', tmp_path / f'updated{k}.osm.pbf')
+        current = tmp_path / f'updated{k}.osm.pbf'
+
+        extractor.save_state(tmp_path / 'state.npz')
+        extractor = IncrementalStopExtractor.load_state(tmp_path / 'state.npz', region=region)
+        extractor.apply_changes(tmp_path / f'changes{k}.osc')
+        assert extractor.get_results().equals(extract(current, region=region))
+
+
+def test_load_state_checks_version_and_region(osm_file, tmp_path):
+    extractor = IncrementalStopExtractor(osm_file)
+    extractor.extract()
+    extractor.save_state(tmp_path / 'state.npz')
+    with pytest.raises(ValueError, match='region'):
+        IncrementalStopExtractor.load_state(tmp_path / 'state.npz', region=Region.from_bbox(0, 0, 1, 1))
+    with np.load(tmp_path / 'state.npz') as npz:
+        arrays = dict(npz)
+    arrays['meta'] = np.frombuffer(arrays['meta'].tobytes().replace(b'"version": 1', b'"version": 0'), dtype=np.uint8)
+    np.savez(tmp_path / 'old.npz', **arrays)
+    with pytest.raises(ValueError, match='version'):
+        IncrementalStopExtractor.load_state(tmp_path / 'old.npz')
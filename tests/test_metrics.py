@@ -0,0 +1,101 @@
+import json
+import math
+import re
+
+import pytest
+
+from main import PublicTransportStopExtractor
+from metrics import Metrics
+
+METRIC_NAME = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\\n]|\\[\\"n])*)"')
+SAMPLE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)')
+
+
+def parse_prometheus(text):
+    """
+    Parse the Prometheus text format, checking that every sample has a TYPE and valid metric and label names.
+    :return: Dict of metric name -> type and list of (metric name, labels, value) samples
+    """
+    types = {}
+    samples = []
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            assert METRIC_NAME.fullmatch(line.split(' ')[2])
+        elif line.startswith('# TYPE '):
+            _, _, name, metric_type = line.split(' ')
+            assert METRIC_NAME.fullmatch(name)
+            assert metric_type in ('counter', 'gauge', 'histogram', 'summary', 'untyped')
+            assert name not in types
+            types[name] = metric_type
+        else:
+            match = SAMPLE.fullmatch(line)
+            assert match, line
+            name, label_text, value = match.groups()
+            assert name in types, f'{name} has no TYPE line before its samples'
+            labels = {}
+            if label_text:
+                pairs = LABEL.findall(label_text)
+                assert ','.join(f'{key}="{label}"' for key, label in pairs) == label_text, line
+                labels = dict(pairs)
+            value = float(value)
+            assert not math.isnan(value), line
+            samples.append((name, labels, value))
+    return types, samples
+
+
+def run(osm_file, metrics, **options):
+    extractor = PublicTransportStopExtractor(osm_file, metrics=metrics, **options)
+    extractor.process_relations()
+    extractor.process_ways()
+    extractor.process_nodes()
+    for stage in ('compute_centroids', 'add_info_stoparea_putline'):
+        with extractor.measure(stage):
+            getattr(extractor, stage)()
+    with extractor.measure('get_results'):
+        return extractor.get_results()
+
+
+@pytest.mark.parametrize('options', [{'pass_plan': 'native'}, {'pass_plan': 'merged'}, {'pass_plan': 'native', 'workers': 2}])
+def test_metrics_output(osm_file, tmp_path, options):
+    metrics = Metrics()
+    run(osm_file, metrics, **options)
+    metrics.write(tmp_path / 'metrics.prom')
+    metrics.write(tmp_path / 'metrics.json')
+
+    types, samples = parse_prometheus((tmp_path / 'metrics.prom').read_text(encoding='utf-8'))
+    prefix = Metrics.PROMETHEUS_PREFIX
+    assert all(name.startswith(prefix + '_') for name in types)
+    stages = ['relations', 'ways', 'nodes', 'compute_centroids', 'add_info_stoparea_putline', 'get_results']
+    assert [labels['stage'] for name, labels, _ in samples if name == f'{prefix}_stage_seconds'] == stages
+    index_sizes = {labels['index']: value for name, labels, value in samples if name == f'{prefix}_index_size'}
+    assert set(index_sizes) == set(PublicTransportStopExtractor.INDEXES)
+    assert index_sizes['stop_data'] > 0
+    assert [value for name, _, value in samples if name == f'{prefix}_peak_rss_bytes'][0] > 0
+
+    handler_samples = {(labels['stage'], labels['handler'], labels['kind']): value for name, labels, value in samples if name == f'{prefix}_handler_elements'}
+    assert handler_samples[('nodes', 'NodeHandler', 'stored')] > 0
+    # The native plan's C++ filters don't report the elements they read, so there is no 'seen' sample for the ways and nodes
+    native = options['pass_plan'] == 'native'
+    for pass_name, handler in (('relations', 'RelationHandlerRoutes'), ('ways', 'WayHandler'), ('nodes', 'NodeHandler')):
+        assert ((pass_name, handler, 'seen') in handler_samples) == (pass_name == 'relations' or not native)
+
+    data = json.loads((tmp_path / 'metrics.json').read_text(encoding='utf-8'))
+    assert set(data) == {'stages', 'index_sizes', 'peak_rss_bytes'}
+    assert list(data['stages']) == stages
+    for stage, record in data['stages'].items():
+        assert {'seconds', 'peak_rss_bytes'} <= set(record)
+    for pass_name in ('relations', 'ways', 'nodes'):
+        for counts in data['stages'][pass_name]['handlers'].values():
+            assert set(counts) == ({'candidates', 'stored'} if native and pass_name != 'relations' else {'seen', 'candidates', 'stored'})
+            assert all(value is not None for value in counts.values())
+    assert set(data['index_sizes']) == set(PublicTransportStopExtractor.INDEXES)
+
+
+def test_prometheus_escapes_label_values():
+    metrics = Metrics()
+    with metrics.measure('a "quoted" \\ stage\nname') as record:
+        record['handlers'] = {'Handler': {'seen': None, 'stored': 3}}
+    types, samples = parse_prometheus(metrics.to_prometheus())
+    assert {labels.get('stage') for _, labels, _ in samples} >= {'a \\"quoted\\" \\\\ stage\\nname'}
+    assert [labels['kind'] for name, labels, _ in samples if name.endswith('_handler_elements')] == ['stored']
@@ -0,0 +1,87 @@
+import pytest
+
+from classification import DEFAULT_SERVICE_PRIORITY, SERVICE_PRIORITIES
+from main import PublicTransportStopExtractor, osm_key
+
+# Relations (members as (type, ref, role)):
+# - Routes r10 (bus) and r11 (train, long_distance) both contain the platform relation r20, the bus route also contains
+#   node 7 directly, the regional train r12 contains way 100 directly
+# - Platform relation r20 contains way 100 and the platform relation r22, which contains node 7 and way 101
+# - stop_area r30 ("Hauptbahnhof") contains r20 and node 8, stop_area r31 ("Nebenhalt") contains node 7 directly
+# - stop_area r40 ("Kreis") and platform relation r41 contain each other, r40 also contains node 9, r41 way 102
+RELATIONS = {
+    10: ({'type': 'route', 'route': 'bus'}, [('r', 20, 'platform'), ('n', 7, 'stop')]),
+    11: ({'type': 'route', 'route': 'train', 'service': 'long_distance'}, [('r', 20, 'platform')]),
+    12: ({'type': 'route', 'route': 'train', 'service': 'regional'}, [('w', 100, 'platform')]),
+    20: ({'public_transport': 'platform', 'bus': 'yes', 'name': 'Steig A'}, [('w', 100, ''), ('r', 22, '')]),
+    22: ({'public_transport': 'platform', 'bus': 'yes', 'name': 'Steig B'}, [('n', 7, ''), ('w', 101, '')]),
+    30: ({'public_transport': 'stop_area', 'name': 'Hauptbahnhof'}, [('r', 20, 'platform'), ('n', 8, 'stop')]),
+    31: ({'public_transport': 'stop_area', 'name': 'Nebenhalt'}, [('n', 7, 'stop')]),
+    40: ({'public_transport': 'stop_area', 'name': 'Kreis'}, [('r', 41, 'platform'), ('n', 9, 'stop')]),
+    41: ({'public_transport': 'platform', 'bus': 'yes', 'name': 'Steig C'}, [('r', 40, ''), ('w', 102, '')]),
+}
+WAYS = {100: [1, 2], 101: [3, 4], 102: [5, 6]}
+MEMBER_TYPES = {'n': 'node', 'w': 'way', 'r': 'relation'}
+
+
+def tags_xml(tags):
+    return ''.join(f'<tag k="{key}" v="{value}"/>' for key, value in tags.items())
+
+
+@pytest.fixture
+def osm_file(tmp_path):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    lines += [f'<node id="{node_id}" version="1" lat="{48.7 + node_id * 0.001}" lon="{9.1 + node_id * 0.001}"/>' for node_id in range(1, 10)]
+    for way_id, refs in WAYS.items():
+        nodes_xml = ''.join(f'<nd ref="{ref}"/>' for ref in refs)
+        lines.append(f'<way id="{way_id}" version="1">{nodes_xml}</way>')
+    for relation_id, (tags, members) in RELATIONS.items():
+        members_xml = ''.join(f'<member type="{MEMBER_TYPES[member_type]}" ref="{ref}" role="{role}"/>' for member_type, ref, role in members)
+        lines.append(f'<relation id="{relation_id}" version="1">{members_xml}{tags_xml(tags)}</relation>')
+    lines.append('</osm>')
+    path = tmp_path / 'nested.osm'
+    path.write_text('\n'.join(lines), encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize('pass_plan', ['legacy', 'merged', 'native'])
+def test_resolve_nested_relations(osm_file, pass_plan):
+    extractor = PublicTransportStopExtractor(osm_file, pass_plan=pass_plan)
+    extractor.process_relations()
+
+    # Route info: the highest priority (min value) wins, whether direct or inherited at any depth
+    routes = {key: (info['osm_route_type'], info['service_priority']) for key, info in extractor.putline_elems.items()}
+    long_distance = ('train', SERVICE_PRIORITIES['long_distance'])
+    assert routes == {
+        osm_key('r', 20): long_distance,
+        osm_key('w', 100): long_distance,
+        osm_key('r', 22): long_distance,
+        osm_key('n', 7): long_distance,
+        osm_key('w', 101): long_distance,
+    }
+    assert extractor.putline_elems[osm_key('w', 101)]['osm_object_type'] == 'way'
+    assert extractor.putline_elems[osm_key('r', 22)]['osm_service_type'] == 'long_distance'
+    assert SERVICE_PRIORITIES['long_distance'] < SERVICE_PRIORITIES['regional'] < DEFAULT_SERVICE_PRIORITY
+
+    # stop_area names reach nested members at any depth, an own stop_area membership wins, the cycle ends
+    assert extractor.stoparea_elems == {
+        osm_key('r', 20): 'Hauptbahnhof',
+        osm_key('w', 100): 'Hauptbahnhof',
+        osm_key('r', 22): 'Hauptbahnhof',
+        osm_key('w', 101): 'Hauptbahnhof',
+        osm_key('n', 7): 'Nebenhalt',
+        osm_key('n', 8): 'Hauptbahnhof',
+        osm_key('r', 41): 'Kreis',
+        # Through the cycle, r40 is contained in its own member r41
+        osm_key('r', 40): 'Kreis',
+        osm_key('n', 9): 'Kreis',
+        osm_key('w', 102): 'Kreis',
+    }
+
+    # Stop relations get the nodes and ways of the relations they contain
+    stops = {info['osm_id']: info for info in extractor.stop_data.values()}
+    assert sorted(stops) == [20, 22, 41]
+    assert (stops[20]['osm_node_refs'], stops[20]['osm_way_refs']) == ([7], [100, 101])
+    assert (stops[22]['osm_node_refs'], stops[22]['osm_way_refs']) == ([7], [101])
+    assert (stops[41]['osm_node_refs'], stops[41]['osm_way_refs']) == ([9], [102])
+    assert {way_id: sorted(relation_ids) for way_id, relation_ids in extractor.relation_way_refs.items()} == {100: [20], 101: [20, 22], 102: [41]}
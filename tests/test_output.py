@@ -0,0 +1,96 @@
+import sqlite3
+import struct
+
+import pandas as pd
+import pytest
+
+from main import PublicTransportStopExtractor, add_synthetic_stop_areas
+
+# Smaller than the number of rows and not a divisor of it, so the last chunk is a partial one
+CHUNK_SIZE = 37
+
+
+@pytest.fixture(scope='module')
+def extractor(osm_file):
+    extractor = PublicTransportStopExtractor(osm_file)
+    extractor.process_relations()
+    extractor.process_ways()
+    extractor.process_nodes()
+    extractor.compute_centroids()
+    extractor.add_info_stoparea_putline()
+    return extractor
+
+
+@pytest.fixture(scope='module')
+def result_columns(extractor):
+    columns = extractor.get_result_columns()
+    # Columns added to the frame are written after the extracted ones
+    add_synthetic_stop_areas(columns)
+    assert columns.frame['synthetic_stoparea_id'].notna().any() and columns.frame['synthetic_stoparea_id'].isna().any()
+    assert len(columns) > 3 * CHUNK_SIZE and len(columns) % CHUNK_SIZE
+    return columns
+
+
+def test_write_csv(extractor, result_columns, tmp_path):
+    # Same file as writing the DataFrame of get_results() at once
+    extractor.get_result_columns().write(tmp_path / 'stops.csv', chunk_size=CHUNK_SIZE)
+    assert (tmp_path / 'stops.csv').read_text() == extractor.get_results().to_csv(index=False)
+    result_columns.write(tmp_path / 'stops.csv', chunk_size=CHUNK_SIZE)
+    assert (tmp_path / 'stops.csv').read_text() == result_columns.to_dataframe().to_csv(index=False)
+
+
+def test_write_parquet(result_columns, tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    result_columns.write(tmp_path / 'stops.parquet', chunk_size=CHUNK_SIZE)
+    parquet_file = pq.ParquetFile(tmp_path / 'stops.parquet')
+    assert parquet_file.metadata.num_row_groups == -(-len(result_columns) // CHUNK_SIZE)
+    table = parquet_file.read()
+    assert table.column_names == result_columns.column_order
+    assert table.schema.field('osm_way_refs').type == pa.large_list(pa.int64())
+    assert table.schema.field('osm_node_refs').type == pa.large_list(pa.int64())
+    expected = result_columns.to_dataframe()
+    for column in table.column_names:
+        values = table.column(column).to_pylist()
+        if column in result_columns.lists:
+            assert values == expected[column].tolist()
+        else:
+            assert values == [None if pd.isna(value) else value for value in expected[column].astype(object)], column
+
+
+def test_write_geopackage(result_columns, tmp_path):
+    result_columns.write(tmp_path / 'stops.gpkg', chunk_size=CHUNK_SIZE)
+    connection = sqlite3.connect(tmp_path / 'stops.gpkg')
+    try:
+        assert connection.execute('PRAGMA application_id').fetchone()[0] == 1196444487
+        assert connection.execute('SELECT * FROM gpkg_geometry_columns').fetchall() == [('put_stops', 'geom', 'POINT', 4326, 0, 0)]
+        bounds = connection.execute("SELECT min_x, min_y, max_x, max_y, srs_id FROM gpkg_contents WHERE table_name = 'put_stops'").fetchone()
+        frame = result_columns.frame
+        assert bounds == (frame['lon'].min(), frame['lat'].min(), frame['lon'].max(), frame['lat'].max(), 4326)
+
+        cursor = connection.execute('SELECT * FROM put_stops ORDER BY fid')
+        names = [description[0] for description in cursor.description]
+        assert names == ['fid', 'geom', *result_columns.column_order]
+        rows = cursor.fetchall()
+    finally:
+        connection.close()
+
+    expected = result_columns.to_dataframe(list_format=str)
+    assert len(rows) == len(expected)
+    assert [row[0] for row in rows] == list(range(1, len(rows) + 1))
+    for row, (_, expected_row) in zip(rows, expected.iterrows()):
+        record = dict(zip(names, row))
+        if pd.isna(expected_row['lat']):
+            assert record['geom'] is None
+        else:
+            # Header: magic, version, flags, srs_id, then WKB point
+            assert record['geom'][:8] == b'GP' + struct.pack('<BBi', 0, 1, 4326)
+            assert struct.unpack('<BIdd', record['geom'][8:]) == (1, 1, expected_row['lon'], expected_row['lat'])
+        for column in result_columns.column_order:
+            value = expected_row[column]
+            if pd.isna(value):
+                assert record[column] is None, column
+            elif result_columns.COLUMN_TYPES.get(column) == 'bool':
+                assert record[column] == int(value), column
+            else:
+                assert record[column] == value, column
@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+from region import RegionSet
+
+
+def write_regions(path, names):
+    features = [{
+        'type': 'Feature',
+        'properties': {'name': name},
+        'geometry': {'type': 'Polygon', 'coordinates': [[[i, 0], [i + 1, 0], [i + 1, 1], [i, 1]]]},
+    } for i, name in enumerate(names)]
+    path.write_text(json.dumps({'type': 'FeatureCollection', 'features': features}), encoding='utf-8')
+    return path
+
+
+def test_region_names_are_file_names(tmp_path):
+    path = write_regions(tmp_path / 'regions.geojson', ['Stuttgart/Nord', 'Stuttgart_Nord', 'Mitte', 'mitte', 'Mitte', 'Ost?'])
+    region_set = RegionSet.from_geojson(path)
+    assert region_set.names == ['Stuttgart_Nord', 'Stuttgart_Nord_2', 'Mitte', 'mitte_2', 'Ost_']
+    # Features with the same name still form one region
+    assert region_set.regions[2].min_lon == 2 and region_set.regions[2].max_lon == 5
+
+
+def test_invalid_region_name_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='file name'):
+        RegionSet.from_geojson(write_regions(tmp_path / 'regions.geojson', ['Nord', '..']))
@@ -0,0 +1,68 @@
+import os
+
+from main import IdSet, PublicTransportStopExtractor, StageCache, _decode_records, _encode_records
+
+
+def test_records_round_trip_with_none():
+    records = {
+        4: {'ids': [1, 2], 'flag': True, 'count': 3, 'value': 1.5, 'name': 'a'},
+        9: {'ids': None, 'flag': None, 'count': None, 'value': None, 'name': None},
+        13: {'flag': False},
+    }
+    arrays = {}
+    _encode_records('records', records, arrays)
+    assert _decode_records('records', arrays) == records
+
+
+def test_fingerprint_detects_change_of_same_size(tmp_path):
+    path = tmp_path / 'file.pbf'
+    content = bytearray(os.urandom(4 * 1024 ** 2))
+    path.write_bytes(content)
+    before = StageCache.file_fingerprint(path)
+    full_before = StageCache.file_fingerprint(path, full=True)
+    content[2 * 1024 ** 2] ^= 0xff
+    path.write_bytes(content)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert StageCache.file_fingerprint(path) != before
+    assert StageCache.file_fingerprint(path, full=True) != full_before
+
+
+def test_cached_passes_give_same_results(osm_file, tmp_path):
+    cache = StageCache(tmp_path / 'cache')
+    results = []
+    index_sizes = []
+    for _ in range(2):
+        extractor = PublicTransportStopExtractor(osm_file, cache=cache)
+        extractor.process_relations()
+        extractor.process_ways()
+        extractor.process_nodes()
+        index_sizes.append({name: len(getattr(extractor, name)) for name in extractor.INDEXES})
+        extractor.compute_centroids()
+        extractor.filter_region()
+        extractor.add_info_stoparea_putline()
+        results.append(extractor.get_results())
+    assert len(list((tmp_path / 'cache').glob('*.npz'))) == 3
+    assert results[1].equals(results[0])
+    assert index_sizes[1] == index_sizes[0]
+    assert index_sizes[0]['relation_members'] > 0
+
+
+def test_stage_key_covers_code_feeding_the_handlers(osm_file, tmp_path, monkeypatch):
+    cache = StageCache(tmp_path / 'cache')
+
+    def stage_keys():
+        monkeypatch.setattr(PublicTransportStopExtractor, '_PublicTransportStopExtractor__code_hashes', {})
+        extractor = PublicTransportStopExtractor(osm_file, cache=cache)
+        return [extractor._PublicTransportStopExtractor__stage_key(pass_name) for pass_name in ('relations', 'ways', 'nodes')]
+
+    before = stage_keys()
+    assert stage_keys() == before
+
+    # A change of the ID lookups decides which objects reach the handlers, so it invalidates every pass
+    def compact(self):
+        self._lookup = None
+
+    monkeypatch.setattr(IdSet, 'compact', compact)
+    after = stage_keys()
+    assert all(key_after != key_before for key_after, key_before in zip(after, before))
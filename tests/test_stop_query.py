@@ -0,0 +1,177 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from stop_query import METERS_PER_DEGREE, StopIndex, make_server
+
+# Sphere with the index's length of a degree
+EARTH_RADIUS = np.degrees(METERS_PER_DEGREE)
+# The index measures equirectangular distances, within a few km they differ from haversine by far less than this
+TOLERANCE = 1e-4
+
+
+def haversine(lat_a, lon_a, lat_b, lon_b):
+    lat_a, lon_a, lat_b, lon_b = map(np.radians, (lat_a, lon_a, lat_b, lon_b))
+    h = np.sin((lat_b - lat_a) / 2) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
+
+@pytest.fixture(scope='module')
+def frame():
+    rng = np.random.default_rng(3)
+    count = 2000
+    return pd.DataFrame({
+        'osm_id': np.arange(count) + 1,
+        'osm_object_type': rng.choice(['node', 'way', 'relation'], count),
+        'lat': 48.7 + rng.random(count) * 0.1,
+        'lon': 9.1 + rng.random(count) * 0.15,
+        'general_type': rng.choice(['bus', 'rail', 'tram', None], count),
+        'specific_type': rng.choice(['bus', 'regional', 'light_rail'], count),
+        'name': [f'Stop {i}' for i in range(count)],
+    })
+
+
+@pytest.fixture(scope='module')
+def index(frame):
+    return StopIndex.from_frame(frame, cell_size=200.0)
+
+
+@pytest.fixture(scope='module')
+def queries():
+    rng = np.random.default_rng(4)
+    # Inside the stops, around them and far outside of the grid
+    lat = np.r_[48.7 + rng.random(50) * 0.1, 48.6 + rng.random(10) * 0.3, 47.0]
+    lon = np.r_[9.1 + rng.random(50) * 0.15, 9.0 + rng.random(10) * 0.35, 8.0]
+    return lat, lon
+
+
+def selection(frame, general_type, specific_type):
+    selected = np.ones(len(frame), dtype=bool)
+    if general_type is not None:
+        selected &= frame['general_type'].fillna('unknown').to_numpy() == general_type
+    if specific_type is not None:
+        selected &= frame['specific_type'].to_numpy() == specific_type
+    return selected
+
+
+TYPE_FILTERS = [(None, None), ('bus', None), (None, 'regional'), ('unknown', 'light_rail'), ('ferry', None)]
+
+
+@pytest.mark.parametrize('general_type, specific_type', TYPE_FILTERS)
+def test_nearest_matches_brute_force(frame, index, queries, general_type, specific_type):
+    selected = selection(frame, general_type, specific_type)
+    k = 5
+    indices, distances = index.nearest(*queries, k=k, general_type=general_type, specific_type=specific_type)
+    assert indices.shape == distances.shape == (len(queries[0]), k)
+    for lat, lon, query_indices, query_distances in zip(*queries, indices, distances):
+        expected = np.sort(haversine(lat, lon, frame['lat'].to_numpy()[selected], frame['lon'].to_numpy()[selected]))[:k]
+        found = query_indices >= 0
+        assert found.sum() == len(expected)
+        np.testing.assert_allclose(query_distances[found], expected, rtol=TOLERANCE)
+        assert np.all(np.isinf(query_distances[~found]))
+        # The stops are the ones found and of the requested types
+        stops = index.stops(query_indices[found])
+        np.testing.assert_allclose(haversine(lat, lon, stops['lat'].to_numpy(), stops['lon'].to_numpy()), expected, rtol=TOLERANCE)
+        assert selected[stops['osm_id'].to_numpy(dtype=np.int64) - 1].all()
+
+
+def test_nearest_max_distance(frame, index, queries):
+    _, distances = index.nearest(*queries, k=20, max_distance=500.0)
+    for lat, lon, query_distances in zip(*queries, distances):
+        expected = haversine(lat, lon, frame['lat'].to_numpy(), frame['lon'].to_numpy())
+        assert np.isfinite(query_distances).sum() == min(20, (expected <= 500.0).sum())
+
+
+@pytest.mark.parametrize('general_type, specific_type', TYPE_FILTERS)
+def test_within_matches_brute_force(frame, index, queries, general_type, specific_type):
+    selected = selection(frame, general_type, specific_type)
+    radius = 800.0
+    offsets, indices, distances = index.within(*queries, radius, general_type=general_type, specific_type=specific_type)
+    assert len(offsets) == len(queries[0]) + 1
+    for i, (lat, lon) in enumerate(zip(*queries)):
+        expected = haversine(lat, lon, frame['lat'].to_numpy(), frame['lon'].to_numpy())
+        found_ids = set(index.stops(indices[offsets[i]:offsets[i + 1]])['osm_id'].tolist())
+        # Everything clearly within the radius, nothing clearly outside
+        assert set((np.flatnonzero(selected & (expected < radius * (1 - TOLERANCE))) + 1).tolist()) <= found_ids
+        assert found_ids <= set((np.flatnonzero(selected & (expected <= radius * (1 + TOLERANCE))) + 1).tolist())
+        assert np.all(np.diff(distances[offsets[i]:offsets[i + 1]]) >= 0)
+
+
+def test_nan_and_empty_queries(index):
+    indices, distances = index.nearest([np.nan, 48.75], [9.15, np.nan], k=2)
+    assert (indices == -1).all() and np.isinf(distances).all()
+    indices, distances = index.nearest([], [], k=3)
+    assert indices.shape == (0, 3)
+    offsets, indices, _ = index.within([np.nan], [9.15], 500.0)
+    assert offsets.tolist() == [0, 0] and len(indices) == 0
+
+
+@pytest.mark.parametrize('k', [0, -1])
+def test_nearest_rejects_k_below_one(index, k):
+    with pytest.raises(ValueError, match='k must be at least 1'):
+        index.nearest(48.75, 9.15, k=k)
+
+
+def test_save_load_round_trip(index, queries, tmp_path):
+    index.save(tmp_path / 'index')
+    loaded = StopIndex.load(tmp_path / 'index')
+    assert isinstance(loaded.lat, np.memmap)
+    assert loaded.types() == index.types()
+    for original, reloaded in zip(index.nearest(*queries, k=3), loaded.nearest(*queries, k=3)):
+        np.testing.assert_array_equal(original, reloaded)
+    for original, reloaded in zip(index.within(*queries, 600.0, general_type='bus'), loaded.within(*queries, 600.0, general_type='bus')):
+        np.testing.assert_array_equal(original, reloaded)
+    pd.testing.assert_frame_equal(loaded.stops(np.arange(10)), index.stops(np.arange(10)))
+
+
+@pytest.fixture(scope='module')
+def server_url(index):
+    server = make_server(index, '127.0.0.1', 0, cache_size=100)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def request(url, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_serve_get_nearest(index, server_url):
+    status, stops = request(f'{server_url}/nearest?lat=48.75&lon=9.15&k=3&general_type=bus')
+    assert status == 200
+    indices, distances = index.nearest(48.75, 9.15, k=3, general_type='bus')
+    assert [stop['osm_id'] for stop in stops] == index.stops(indices[0])['osm_id'].tolist()
+    np.testing.assert_allclose([stop['distance'] for stop in stops], distances[0])
+    assert {stop['general_type'] for stop in stops} == {'bus'}
+
+
+def test_serve_post_within(index, server_url):
+    status, results = request(f'{server_url}/within', {'lat': [48.75, 48.72], 'lon': [9.15, 9.2], 'radius': 400})
+    assert status == 200
+    offsets, indices, _ = index.within([48.75, 48.72], [9.15, 9.2], 400.0)
+    assert [[stop['osm_id'] for stop in stops] for stops in results] == [
+        index.stops(indices[offsets[i]:offsets[i + 1]])['osm_id'].tolist() for i in range(2)]
+
+
+@pytest.mark.parametrize('url, body', [
+    ('/nearest?lat=48.75&lon=9.15&k=0', None),
+    ('/nearest?lat=48.75', None),
+    ('/nearest', {'lat': [48.75], 'lon': [9.15], 'k': -1}),
+    ('/within', {'lat': [48.75], 'lon': [9.15]}),
+])
+def test_serve_rejects_invalid_queries(server_url, url, body):
+    status, response = request(server_url + url, body)
+    assert status == 400
+    assert response['error'].startswith('Invalid query')